@@ -0,0 +1,103 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Runs N copies of a guest program that waits on an awaitable builtin several times, all concurrently on
+# one event loop, and compares the wall time with running the same copies one after the other. The serial
+# runs take waits * delay seconds per copy, --skip-serial leaves them out.
+#
+#   python benchmarks/async_concurrency.py --tasks 1 10 100 1000
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.async_runner import run_async
+from src.code_cache import CodeCache
+from src.loader import ScriptCompiler
+from src.vm import BytecodeVM
+
+GUEST_SOURCE = """
+def handle_request(request_id, waits, delay):
+    total = 0
+    n = 0
+    while n < waits:
+        sleep(delay)
+        total += request_id * n
+        n += 1
+    return total
+
+handle_request(7, WAITS, DELAY)
+"""
+
+async def run_tasks(num_tasks, code, source_lines, waits, delay, serial=False):
+    """
+    Runs the tasks concurrently, or one after the other with serial, and returns the wall time and the
+    instructions executed.
+    """
+    # One VM per task, all of them share the decoded code
+    code_cache = CodeCache()
+    vms = [BytecodeVM(code, source_lines, "<guest>", code_cache=code_cache) for i in range(num_tasks)]
+
+    def run(vm):
+        guest_globals = {"sleep": asyncio.sleep, "WAITS": waits, "DELAY": delay}
+        return run_async(vm, code, guest_globals, source_lines, "<guest>")
+
+    start = time.perf_counter()
+    if serial:
+        results = []
+        for vm in vms:
+            results.append(await run(vm))
+    else:
+        results = await asyncio.gather(*[run(vm) for vm in vms])
+    elapsed = time.perf_counter() - start
+    return elapsed, sum(result.instructions for result in results)
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrency scaling of guest programs on one event loop")
+    parser.add_argument("--tasks", type=int, nargs="+", default=[1, 10, 100, 1000], help="Concurrent guest programs")
+    parser.add_argument("--waits", type=int, default=5, help="Awaits per guest program")
+    parser.add_argument("--delay", type=float, default=0.01, help="Seconds per await")
+    parser.add_argument("--skip-serial", action="store_true", help="Don't time the tasks run one after the other")
+    args = parser.parse_args()
+
+    code, source_lines = ScriptCompiler().compile_source(GUEST_SOURCE, "<guest>")
+
+    loop = asyncio.get_event_loop()
+    print("%8s %12s %14s %10s %14s" % ("tasks", "wall (s)", "serial (s)", "speedup", "instructions"))
+    for num_tasks in args.tasks:
+        elapsed, instructions = loop.run_until_complete(run_tasks(num_tasks, code, source_lines, args.waits, args.delay))
+        if args.skip_serial:
+            print("%8d %12.3f %14s %10s %14d" % (num_tasks, elapsed, "-", "-", instructions))
+            continue
+
+        serial = loop.run_until_complete(run_tasks(num_tasks, code, source_lines, args.waits, args.delay,
+                                                   serial=True))[0]
+        print("%8d %12.3f %14.3f %9.1fx %14d" % (num_tasks, elapsed, serial, serial / elapsed, instructions))
+
+if __name__ == "__main__":
+    main()
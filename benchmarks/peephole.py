@@ -0,0 +1,86 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Runs guest programs as compiled and after the peephole optimizer, checks both print and return the same and
+# reports how much code and how many executed instructions the optimizer saved.
+#
+#   python benchmarks/peephole.py tests/*.py
+
+import argparse
+import contextlib
+import glob
+import io
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from src.loader import format_source_lines, read_source
+from src.optimizer import optimize
+from src.vm import BytecodeVM
+
+def code_size(code):
+    return len(code.co_code) + sum(code_size(const) for const in code.co_consts if hasattr(const, "co_code"))
+
+def run(code, source_lines, filename):
+    """
+    Returns what the program printed, its outcome and the number of instructions it executed.
+    """
+    vm = BytecodeVM(code, source_lines, filename)
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            result = vm.run(code, source=source_lines, filename=filename)
+    except Exception as e:
+        return output.getvalue(), "%s: %s" % (type(e).__name__, e), vm.instruction_count
+    return output.getvalue(), "returned %r" % (result.return_value,), result.instructions
+
+def main():
+    parser = argparse.ArgumentParser(description="Peephole optimizer equivalence and savings")
+    parser.add_argument("filenames", nargs="*", help="Guest programs. Defaults to tests/*.py")
+    args = parser.parse_args()
+
+    filenames = args.filenames or sorted(glob.glob(os.path.join(ROOT_DIR, "tests", "*.py")))
+    mismatches = 0
+    print("%-25s %8s %8s %12s %12s  %s" % ("program", "bytes", "opt", "executed", "opt", "result"))
+    for filename in filenames:
+        source = read_source(filename)
+        source_lines = format_source_lines(source.splitlines())
+        code = compile(source, filename, "exec")
+        optimized = optimize(code)
+
+        output, outcome, executed = run(code, source_lines, filename)
+        optimized_output, optimized_outcome, optimized_executed = run(optimized, source_lines, filename)
+        same = output == optimized_output and outcome == optimized_outcome
+        if not same:
+            mismatches += 1
+
+        print("%-25s %8d %8d %12d %12d  %s" % (os.path.basename(filename), code_size(code), code_size(optimized),
+                                               executed, optimized_executed, "same" if same else "MISMATCH"))
+
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Load test client for the VM server. Start the server first:
+#
+#   python -m src.server /tmp/pyvym.sock
+#   python benchmarks/server_load.py /tmp/pyvym.sock tests/fibonacci.py tests/while_loop.py -n 2000 -c 8
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.loader import read_source
+from src.server import VMClient
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def client_worker(socket_path, requests, latencies, errors):
+    client = VMClient(socket_path)
+    try:
+        for request in requests:
+            start = time.perf_counter()
+            response = client.request(request)
+            latencies.append(time.perf_counter() - start)
+            if response.get("status") != "ok":
+                errors.append(response.get("error"))
+    finally:
+        client.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="PyVyM server load test")
+    parser.add_argument("socket_path", help="Socket the server is listening on")
+    parser.add_argument("scripts", nargs="+", help="Guest scripts to send, round robin")
+    parser.add_argument("-n", "--requests", type=int, default=1000, help="Total number of requests")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="Number of concurrent connections")
+    parser.add_argument("--send-source", action="store_true", help="Send the script source instead of its path")
+    args = parser.parse_args()
+
+    if args.send_source:
+        templates = [{"source": read_source(path), "filename": path} for path in args.scripts]
+    else:
+        templates = [{"path": os.path.abspath(path)} for path in args.scripts]
+
+    all_requests = [templates[i % len(templates)] for i in range(args.requests)]
+
+    latencies = []
+    errors = []
+    threads = []
+    for i in range(args.concurrency):
+        requests = all_requests[i::args.concurrency]
+        thread = threading.Thread(target=client_worker, args=(args.socket_path, requests, latencies, errors))
+        threads.append(thread)
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print("requests:    %d (%d errors)" % (len(latencies), len(errors)))
+    print("concurrency: %d" % args.concurrency)
+    print("elapsed:     %.3fs" % elapsed)
+    print("throughput:  %.1f req/s" % (len(latencies) / elapsed))
+    print("latency p50: %.3fms" % (percentile(latencies, 50) * 1000))
+    print("latency p99: %.3fms" % (percentile(latencies, 99) * 1000))
+    print("latency max: %.3fms" % (latencies[-1] * 1000 if latencies else 0.0))
+    if errors:
+        print("first error: %s" % errors[0])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Runs guest scripts on N BytecodeVMs in N threads that all share one CodeCache, checks every run executes
+# exactly the instructions a lone VM does and that each code object got decoded only once.
+#
+#   python benchmarks/shared_cache_threads.py tests/*.py --threads 8 --rounds 50
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.code_cache import CodeCache
+from src.loader import ScriptCompiler
+from src.vm import BytecodeVM
+
+def run_scripts(scripts, code_cache, rounds):
+    """
+    Runs every script rounds times on a fresh VM and returns the instruction counts of each script.
+    """
+    vm = None
+    counts = {}
+    for i in range(rounds):
+        for filename, (code, source_lines) in scripts:
+            if vm is None:
+                vm = BytecodeVM(code, source_lines, filename, code_cache=code_cache)
+
+            try:
+                result = vm.run(code, source=source_lines, filename=filename)
+                count = result.instructions
+            except Exception as e:
+                count = "%s: %s" % (type(e).__name__, e)
+
+            counts.setdefault(filename, set()).add(count)
+
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Many VMs in threads sharing one code cache")
+    parser.add_argument("scripts", nargs="+", help="Guest scripts to run")
+    parser.add_argument("--threads", type=int, default=8, help="Number of VMs/threads")
+    parser.add_argument("--rounds", type=int, default=20, help="Times each thread runs every script")
+    args = parser.parse_args()
+
+    compiler = ScriptCompiler()
+    scripts = [(filename, compiler.compile_file(filename)) for filename in args.scripts]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        reference_cache = CodeCache()
+        reference = run_scripts(scripts, reference_cache, 1)
+
+        shared_cache = CodeCache()
+        results = [None] * args.threads
+
+        def worker(index):
+            results[index] = run_scripts(scripts, shared_cache, args.rounds)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+    failures = 0
+    for index, counts in enumerate(results):
+        if counts != reference:
+            failures += 1
+            print("VM %s diverged: %s != %s" % (index, counts, reference))
+
+    print("%s VMs x %s rounds x %s scripts in %.3fs" % (args.threads, args.rounds, len(scripts), elapsed))
+    print("code objects decoded: shared cache %s, lone VM %s" % (shared_cache.misses, reference_cache.misses))
+    if shared_cache.misses != reference_cache.misses:
+        failures += 1
+        print("Shared cache decoded some code objects more than once")
+
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Measures the time from spawning the interpreter until the VM is about to dispatch the first
+# instruction of the guest program, for the default (verbose) and the headless modes.
+#
+#   python benchmarks/startup.py tests/fibonacci.py
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The child stops the run as soon as BytecodeVM.execute is entered and reports the wall clock
+# time on stderr, so everything measured is startup work: imports, reading and compiling the
+# source, building the VM and any eager printing.
+CHILD_DRIVER = """
+import sys
+import time
+
+sys.path.insert(0, %r)
+
+from src import main as vm_main
+from src.vm import BytecodeVM
+
+def first_instruction(self, *args, **kwargs):
+    sys.stderr.write("%%r\\n" %% time.time())
+    sys.stderr.flush()
+    raise SystemExit(0)
+
+BytecodeVM.execute = first_instruction
+vm_main.main(sys.argv[1:])
+"""
+
+def time_to_first_instruction(filename, extra_args):
+    driver = CHILD_DRIVER % ROOT_DIR
+    start = time.time()
+    proc = subprocess.run([sys.executable, "-c", driver, filename] + extra_args, cwd=ROOT_DIR,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        raise Exception("Startup benchmark run failed:\n%s" % proc.stderr)
+
+    first_instruction = float(proc.stderr.strip().splitlines()[-1])
+    return first_instruction - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Time to first instruction benchmark")
+    parser.add_argument("filename", help="Guest program to start")
+    parser.add_argument("-n", "--runs", type=int, default=20, help="Number of process launches per mode")
+    args = parser.parse_args()
+
+    modes = [("verbose", []), ("headless", ["--headless"])]
+    print("%-10s %10s %10s %10s" % ("mode", "min (ms)", "median", "max"))
+    for mode, extra_args in modes:
+        timings = [time_to_first_instruction(args.filename, extra_args) * 1000 for i in range(args.runs)]
+        print("%-10s %10.2f %10.2f %10.2f" % (mode, min(timings), statistics.median(timings), max(timings)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Times a branchy numeric guest function over N inputs with BytecodeVM.vmap against calling it once per
+# input in the VM, and checks both give the same results. Needs numpy.
+#
+#   python benchmarks/vmap.py --inputs 1000000
+#
+# The per input loop is slow, --loop-inputs times it on the first few inputs only and extrapolates.
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+
+from src.loader import ScriptCompiler
+from src.vm import BytecodeVM
+
+GUEST_SOURCE = """
+OFFSET = 7
+
+def score(x, y):
+    a = x * 3 + OFFSET
+    if a > y:
+        d = a - y
+        if d % 2 == 0:
+            return d // 2
+        return d * 5
+    elif x < 0 and y < 0:
+        return -a
+    return a + y * y
+"""
+
+def main():
+    parser = argparse.ArgumentParser(description="Vectorized vmap against a per input loop")
+    parser.add_argument("--inputs", type=int, default=1000000, help="Number of inputs")
+    parser.add_argument("--loop-inputs", type=int, default=None,
+                        help="Only time the per input loop on this many inputs and extrapolate")
+    args = parser.parse_args()
+
+    code, source_lines = ScriptCompiler().compile_source(GUEST_SOURCE, "<vmap benchmark>")
+    vm = BytecodeVM(code, source_lines, "<vmap benchmark>")
+    vm.execute()
+    score = vm.module_frame.globals["score"]
+
+    x = numpy.arange(args.inputs, dtype=numpy.int64) % 2001 - 1000
+    y = (numpy.arange(args.inputs, dtype=numpy.int64) * 7919) % 3001 - 1500
+
+    start = time.perf_counter()
+    vectorized = vm.vmap("score", x, y, fallback=False)
+    vmap_time = time.perf_counter() - start
+
+    loop_inputs = args.inputs if args.loop_inputs is None else min(args.loop_inputs, args.inputs)
+    xs = x[:loop_inputs].tolist()
+    ys = y[:loop_inputs].tolist()
+    start = time.perf_counter()
+    looped = [vm.call_function(score, [xi, yi]) for xi, yi in zip(xs, ys)]
+    loop_time = (time.perf_counter() - start) * args.inputs / max(loop_inputs, 1)
+
+    print("vmap: %s inputs in %.3fs" % (args.inputs, vmap_time))
+    print("loop: %s inputs in %.3fs%s" % (args.inputs, loop_time,
+                                          " (extrapolated from %s)" % loop_inputs if loop_inputs < args.inputs else ""))
+    print("speedup: %.0fx" % (loop_time / vmap_time))
+
+    if vectorized[:loop_inputs].tolist() != looped:
+        print("vmap results differ from the per input loop")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import asyncio
+import inspect
+import time
+
+from src.vm import RunResult, TerminateStates
+
+async def run_async(vm, code, globals=None, source=None, filename=None, time_slice=0.002, check_interval=500):
+    """
+    Executes a module on the VM without blocking the event loop. The VM yields back to the loop whenever a
+    guest calls a builtin returning an awaitable (which is awaited and its result handed to the guest), and
+    whenever it has been running for time_slice seconds. The clock is looked at every check_interval
+    instructions.
+    """
+    if source is None:
+        source = []
+    if filename is None:
+        filename = code.co_filename
+
+    vm.reset(code, source, filename, globals)
+    vm.awaitable_check = inspect.isawaitable
+
+    start_count = vm.instruction_count
+    start = time.perf_counter()
+    try:
+        slice_start = time.perf_counter()
+        while True:
+            state, value = vm.execute_slice(check_interval)
+
+            if state == TerminateStates.TERMINATE_PROGRAM:
+                return RunResult(value, vm.instruction_count - start_count, time.perf_counter() - start)
+            elif state == TerminateStates.TERMINATE_AWAIT:
+                vm.complete_await(await value)
+                slice_start = time.perf_counter()
+            elif time.perf_counter() - slice_start >= time_slice:
+                await asyncio.sleep(0)
+                slice_start = time.perf_counter()
+    finally:
+        vm.awaitable_check = None
@@ -0,0 +1,87 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import glob
+import json
+import multiprocessing
+import os
+import sys
+
+from src.runner import ScriptRunner
+
+# Every pool worker keeps one ScriptRunner for its lifetime, so its VM caches stay warm across scripts
+worker_runner = None
+
+def init_worker(config):
+    global worker_runner
+    worker_runner = ScriptRunner(config)
+
+def run_script(filename):
+    try:
+        return worker_runner.run_file(filename)
+    except BaseException as e:
+        # ScriptRunner already reports guest errors, this catches whatever escapes it (recursion errors
+        # while reporting...) so one script never takes the worker down.
+        return {"script": filename, "status": "error", "error": "%s: %s" % (type(e).__name__, e)}
+
+def expand_scripts(patterns):
+    """
+    Expands directories (every *.py inside them) and glob patterns into a sorted list of script paths.
+    """
+    scripts = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = glob.glob(os.path.join(pattern, "*.py"))
+        else:
+            matches = glob.glob(pattern)
+
+        for match in sorted(matches):
+            if match not in scripts:
+                scripts.append(match)
+
+    return scripts
+
+def run_batch(scripts, processes=None, output=None, config=None):
+    """
+    Runs the scripts across a process pool and writes one JSON line per script to output as soon as it
+    finishes, so results stream in completion order. Every worker's VM runs with config. Returns the number
+    of scripts that failed.
+    """
+    if output is None:
+        output = sys.stdout
+
+    failures = 0
+    pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(config,))
+    try:
+        for result in pool.imap_unordered(run_script, scripts):
+            if result["status"] != "ok":
+                failures += 1
+
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    return failures
@@ -0,0 +1,156 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Chrome trace-event export. Guest function calls, class builds and VM phases (compile, decode, execute) are
+# buffered in memory as tuples while the guest runs and only turned into trace events by save(), which writes
+# the JSON object format chrome://tracing, Perfetto and speedscope load. Guest calls show up on one track per
+# green thread, VM phases on a track of their own.
+
+import json
+import os
+from contextlib import contextmanager
+
+from src.profiler import FrameTracker, perf_counter_ns
+
+# Track the VM phases go on, green threads are numbered by the id of their bottom frame
+VM_TRACK = 0
+
+class ChromeTracer(FrameTracker):
+    """
+    Records a timeline of the guest's function calls and class builds. Enable with
+    vm.timeline = ChromeTracer(), which also records the VM phases run through it, and write it out with
+    save(filename).
+    """
+    def __init__(self):
+        FrameTracker.__init__(self)
+        self.__vm = None
+        self.__origin = perf_counter_ns()
+        self.__pid = os.getpid()
+
+        # ("B", code, ns, track), ("E", code, ns, track) or ("X", name, category, start ns, end ns, track, args)
+        self.__events = []
+        # track -> name
+        self.__tracks = {VM_TRACK: "VM"}
+
+    @property
+    def events(self):
+        return self.__events
+
+    def instrument(self, vm, dispatch):
+        """
+        Returns dispatch with every handler wrapped to follow guest calls, and LOAD_BUILD_CLASS to time the
+        class builds.
+        """
+        self.__vm = vm
+        dispatch = FrameTracker.instrument(self, vm, dispatch)
+        return dispatch.instrument(self.__wrap_build_class, ["execute_LOAD_BUILD_CLASS"])
+
+    def __wrap_build_class(self, opmethod, handler):
+        vm = self.__vm
+        complete = self.complete
+
+        def traced():
+            terminate = handler()
+
+            # Swap the builtin CALL_FUNCTION is going to call for one that times the class body
+            build_class = vm.exec_frame.pop()
+            def timed_build_class(*args):
+                start = perf_counter_ns()
+                try:
+                    return build_class(*args)
+                finally:
+                    complete(args[0].klass.name, "class", start, perf_counter_ns(), self.thread_id)
+            vm.exec_frame.append(timed_build_class)
+
+            return terminate
+
+        return traced
+
+    def on_enter(self, record, now):
+        track = self.thread_id
+        if track not in self.__tracks:
+            # The first stack seen is the main program's, the others belong to spawned green threads
+            self.__tracks[track] = "Main" if len(self.__tracks) == 1 else "Thread %s" % record.code.co_name
+        self.__events.append(("B", record.code, now, track))
+
+    def on_exit(self, record, caller, now, outermost):
+        # The bottom frame of a stack is the one naming its track
+        track = self.thread_id if caller is not None else record.frame.id
+        self.__events.append(("E", record.code, now, track))
+
+    def complete(self, name, category, start, end, track=VM_TRACK, args=None):
+        """
+        Records an event that ran from start to end, in perf_counter_ns() nanoseconds.
+        """
+        self.__events.append(("X", name, category, start, end, track, args))
+
+    @contextmanager
+    def phase(self, name, **args):
+        """
+        Records the time spent in the with block as a VM phase.
+        """
+        start = perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.complete(name, "vm", start, perf_counter_ns(), VM_TRACK, args or None)
+
+    def trace_events(self):
+        """
+        Returns the recorded events as a list of trace event dicts, timestamps in microseconds.
+        """
+        self.flush()
+
+        origin = self.__origin
+        pid = self.__pid
+        events = []
+        for track, name in sorted(self.__tracks.items()):
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": track, "args": {"name": name}})
+
+        for event in self.__events:
+            if event[0] == "X":
+                _, name, category, start, end, track, args = event
+                trace_event = {"name": name, "cat": category, "ph": "X", "ts": (start - origin) / 1000.0,
+                               "dur": (end - start) / 1000.0, "pid": pid, "tid": track}
+                if args:
+                    trace_event["args"] = args
+            elif event[0] == "B":
+                _, code, now, track = event
+                trace_event = {"name": code.co_name, "cat": "guest", "ph": "B", "ts": (now - origin) / 1000.0,
+                               "pid": pid, "tid": track,
+                               "args": {"file": code.co_filename, "line": code.co_firstlineno}}
+            else:
+                _, code, now, track = event
+                trace_event = {"name": code.co_name, "cat": "guest", "ph": "E", "ts": (now - origin) / 1000.0,
+                               "pid": pid, "tid": track}
+            events.append(trace_event)
+
+        return events
+
+    def write(self, file):
+        json.dump({"traceEvents": self.trace_events(), "displayTimeUnit": "ms"}, file)
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            self.write(f)
@@ -0,0 +1,196 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 <Satyajit Sarangi>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import threading
+import types
+
+from opcode import opname, HAVE_ARGUMENT
+
+# Typed handlers the VM can run in place of a generic one, see src.inference, and the handler each stands in
+# for. Tools go by the generic one to tell whether a handler takes an argument or which opcode it runs.
+SPECIALIZED_OPMETHODS = {
+    "execute_BINARY_ADD_TYPED": "execute_BINARY_ADD",
+    "execute_BINARY_SUBTRACT_TYPED": "execute_BINARY_SUBTRACT",
+    "execute_BINARY_MULTIPLY_TYPED": "execute_BINARY_MULTIPLY",
+    "execute_BINARY_TRUE_DIVIDE_TYPED": "execute_BINARY_TRUE_DIVIDE",
+    "execute_BINARY_FLOOR_DIVIDE_TYPED": "execute_BINARY_FLOOR_DIVIDE",
+    "execute_BINARY_MODULO_TYPED": "execute_BINARY_MODULO",
+    "execute_COMPARE_OP_TYPED": "execute_COMPARE_OP",
+}
+
+def generic_opmethod(opmethod):
+    return SPECIALIZED_OPMETHODS.get(opmethod, opmethod)
+
+def code_key(code):
+    """
+    Key for caching what is derived from a code object. Code objects compare by value without their filename
+    or line table, so equal code from two files, or laid out on different lines, would otherwise share one
+    entry.
+    """
+    return (code, code.co_filename, code.co_lnotab)
+
+def code_objects(code):
+    """
+    Yields code and every code object nested in its constants: functions, class bodies, comprehensions.
+    """
+    yield code
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            for nested in code_objects(const):
+                yield nested
+
+def decode_instructions(code):
+    """
+    Decodes co_code once into a table indexed by the byte offset of every instruction. Each entry is
+    (opmethod, oparg, size) where opmethod is the name of the VM method implementing the opcode. The
+    offsets of the argument bytes map to None.
+    """
+    program = code.co_code
+    instructions = [None] * len(program)
+
+    ip = 0
+    while ip < len(program):
+        op = program[ip]
+        oparg = None
+        size = 1
+        if op >= HAVE_ARGUMENT:
+            low = program[ip + 1]
+            high = program[ip + 2]
+            oparg = (high << 8) | low
+            size = 3
+
+        instructions[ip] = ("execute_%s" % opname[op], oparg, size)
+        ip += size
+
+    return tuple(instructions)
+
+def build_line_table(code):
+    """
+    Expands co_lnotab into a table mapping every byte offset to its source line. Gives the same answer as
+    LineNo.line_number but costs a single list index per lookup.
+    """
+    lnotab = code.co_lnotab
+    num_offsets = len(code.co_code)
+    lines = []
+
+    lineno = code.co_firstlineno
+    addr = 0
+    for addr_incr, line_incr in zip(lnotab[0::2], lnotab[1::2]):
+        addr += addr_incr
+        lines.extend([lineno] * (min(addr, num_offsets) - len(lines)))
+        lineno += line_incr
+
+    lines.extend([lineno] * (num_offsets - len(lines)))
+    return tuple(lines)
+
+class BindingPlan:
+    """
+    How call arguments map onto the locals of a code object. Computed once per code object instead of on
+    every call.
+    """
+    __slots__ = ("__argcount", "__varnames", "__param_names")
+
+    def __init__(self, code):
+        self.__argcount = code.co_argcount
+        self.__varnames = code.co_varnames
+        self.__param_names = code.co_varnames[:code.co_argcount]
+
+    def bind(self, locals, defaults, args, kwargs):
+        if defaults:
+            locals.update(zip(self.__param_names[self.__argcount - len(defaults):], defaults))
+
+        locals.update(zip(self.__varnames, args))
+        if kwargs:
+            locals.update(kwargs)
+
+class DecodedCode:
+    """
+    Everything the VM derives from a code object that never changes: the instruction stream, the line table
+    and the binding plan. Instances are never mutated after construction, so any number of VMs in any number
+    of threads can share them. State a VM mutates (inline caches, patched instructions) lives in the VM's
+    own copy of the instruction stream, see BytecodeVM.instructions_for.
+    """
+    __slots__ = ("__code", "__instructions", "__lines", "__binding_plan")
+
+    def __init__(self, code):
+        self.__code = code
+        self.__instructions = decode_instructions(code)
+        self.__lines = build_line_table(code)
+        self.__binding_plan = BindingPlan(code)
+
+    @property
+    def code(self):
+        return self.__code
+
+    @property
+    def instructions(self):
+        return self.__instructions
+
+    @property
+    def lines(self):
+        return self.__lines
+
+    @property
+    def binding_plan(self):
+        return self.__binding_plan
+
+class CodeCache:
+    """
+    Decoded instruction streams and line tables keyed by code_key. Code objects compare by value, so
+    recompiling the same source hits the cache as well. Safe to share between VMs running in different
+    threads: lookups are a plain dict read and a miss decodes under a lock, so each code object is decoded
+    once.
+    """
+    def __init__(self):
+        self.__decoded = {}
+        self.__lock = threading.Lock()
+        self.__misses = 0
+
+    def decode(self, code):
+        key = code_key(code)
+        decoded = self.__decoded.get(key)
+        if decoded is None:
+            with self.__lock:
+                decoded = self.__decoded.get(key)
+                if decoded is None:
+                    decoded = DecodedCode(code)
+                    self.__misses += 1
+
+                    # Publish a new dict instead of mutating the one readers may be looking at
+                    decoded_map = dict(self.__decoded)
+                    decoded_map[key] = decoded
+                    self.__decoded = decoded_map
+
+        return decoded
+
+    @property
+    def misses(self):
+        return self.__misses
+
+    def clear(self):
+        with self.__lock:
+            self.__decoded = {}
+
+    def __len__(self):
+        return len(self.__decoded)
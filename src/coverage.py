@@ -0,0 +1,109 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import sys
+
+from src.code_cache import code_key, code_objects
+from src.hooks import LINE
+from src.profiler import function_label
+
+def line_ranges(lines):
+    """
+    Formats sorted line numbers as ranges, like "3-5, 9".
+    """
+    ranges = []
+    for lineno in lines:
+        if ranges and ranges[-1][1] == lineno - 1:
+            ranges[-1][1] = lineno
+        else:
+            ranges.append([lineno, lineno])
+
+    return ", ".join(str(first) if first == last else "%s-%s" % (first, last) for first, last in ranges)
+
+class Coverage:
+    """
+    Line coverage of the guest program, recorded from the VM's line events. Wrap the run between start() and
+    stop(); nothing is hooked in while stopped.
+    """
+    def __init__(self, vm):
+        self.__vm = vm
+        # code_key -> set of executed line numbers
+        self.__lines = {}
+
+    @property
+    def lines(self):
+        return self.__lines
+
+    def start(self):
+        self.__vm.hooks.subscribe(LINE, self.__line)
+
+    def stop(self):
+        self.__vm.hooks.unsubscribe(LINE, self.__line)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def __line(self, frame, lineno):
+        key = code_key(frame.code)
+        executed = self.__lines.get(key)
+        if executed is None:
+            executed = self.__lines[key] = set()
+        executed.add(lineno)
+
+    def missing(self, code):
+        """
+        Returns the sorted line numbers of code that never executed.
+        """
+        executable = set(self.__vm.code_cache.decode(code).lines)
+        return sorted(executable - self.__lines.get(code_key(code), set()))
+
+    def report(self, code=None, file=None):
+        """
+        Prints the executed and missed lines of every code object in the module, code defaults to the
+        module the VM ran.
+        """
+        if file is None:
+            file = sys.stdout
+        if code is None:
+            code = self.__vm.module_frame.code
+
+        file.write("%-56s %7s %7s %7s  %s\n" % ("Name", "Lines", "Miss", "Cover", "Missing"))
+
+        total_lines = total_missing = 0
+        for nested in code_objects(code):
+            num_lines = len(set(self.__vm.code_cache.decode(nested).lines))
+            missing = self.missing(nested)
+            total_lines += num_lines
+            total_missing += len(missing)
+
+            file.write("%-56s %7d %7d %6.1f%%  %s\n" %
+                       (function_label(nested), num_lines, len(missing),
+                        100.0 * (num_lines - len(missing)) / max(num_lines, 1), line_ranges(missing)))
+
+        file.write("%-56s %7d %7d %6.1f%%\n" % ("TOTAL", total_lines, total_missing,
+                                                100.0 * (total_lines - total_missing) / max(total_lines, 1)))
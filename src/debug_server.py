@@ -0,0 +1,327 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Remote debugging. The debugger listens on a Unix domain socket and a front end, like an editor, drives it
+# with one JSON object per line, each answered by one line with the same id:
+#
+#   {"id": 1, "command": "set_breakpoint", "line": 14, "condition": "i > 0"}
+#   {"id": 1, "ok": true}
+#
+# Whenever the program stops, and once before it first runs, the server sends an event line without an id.
+# A stop carries everything a front end shows at once (all frames with their locals, the globals, the
+# breakpoints and watches) so it never has to go back and forth frame by frame:
+#
+#   {"event": "stopped", "reason": "breakpoint", "filename": ..., "line": 14, "snapshot": {...}}
+#   {"event": "exited", "return_value": {...}}
+#
+#   python -m src.debug_server /tmp/pyvym-debug.sock tests/fibonacci.py
+#
+# Commands: run, step, next and finish resume the program. set_breakpoint (line, condition, after),
+# disable_breakpoint and clear_breakpoint (line), clear_all_breakpoints, breakpoints, watch and unwatch
+# (expression), watches, snapshot, source (line, context), set_local (name, value), record (interval), rstep,
+# goto (instruction) and quit.
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+from src.debugger import Debugger, UNSET
+from src.loader import ScriptCompiler
+from src.replay import Rewind
+
+# Longest repr sent for a value
+MAX_REPR = 200
+
+def describe(value):
+    if value is UNSET:
+        return {"type": None, "repr": "<undefined>"}
+
+    text = repr(value)
+    if len(text) > MAX_REPR:
+        text = text[:MAX_REPR - 3] + "..."
+    return {"type": type(value).__name__, "repr": text}
+
+def describe_all(variables):
+    return dict((str(name), describe(value)) for name, value in variables.items())
+
+def frame_line(vm, exec_frame, offset=None):
+    if offset is None:
+        # Frames below the top are past the call they are waiting on
+        offset = max(exec_frame.ip - 3, 0)
+    lines = vm.code_cache.decode(exec_frame.code).lines
+    return lines[min(offset, len(lines) - 1)]
+
+class RemoteDebugger(Debugger):
+    """
+    Debugger driven over a Unix domain socket instead of the console. Serves one front end, execute() waits
+    for it to connect.
+    """
+    def __init__(self, code, source, filename, socket_path, config=None):
+        Debugger.__init__(self, code, source, filename, config)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        self.__socket_path = socket_path
+        self.__listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__listener.bind(socket_path)
+        self.__listener.listen(1)
+        self.__connection = None
+        self.__reader = None
+        self.__started = False
+
+    @property
+    def socket_path(self):
+        return self.__socket_path
+
+    def execute(self, call_from_vm=True):
+        self.__connection, address = self.__listener.accept()
+        self.__reader = self.__connection.makefile("rb")
+        try:
+            Debugger.execute(self, call_from_vm)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.__reader is not None:
+            self.__reader.close()
+            self.__connection.close()
+            self.__reader = None
+        self.__listener.close()
+        if os.path.exists(self.__socket_path):
+            os.unlink(self.__socket_path)
+
+    def __send(self, message):
+        self.__connection.sendall(json.dumps(message).encode("utf-8") + b"\n")
+
+    def __event(self):
+        if self.running:
+            reason, exec_frame, lineno, details = self.stopped
+            event = {"event": "stopped", "reason": reason, "filename": exec_frame.code.co_filename,
+                     "line": lineno, "snapshot": self.snapshot()}
+            for name, value in details.items():
+                # The watched expression is the front end's own text, values are described
+                event[name] = value if name == "expression" else describe(value)
+            return event
+        elif self.__started:
+            return {"event": "exited", "return_value": describe(self.return_value)}
+
+        self.__started = True
+        return {"event": "initialized", "breakpoints": self.breakpoint_list(), "watches": self.watches}
+
+    def snapshot(self):
+        """
+        All the frames, innermost first, with their locals merged over their loop blocks, the globals, the
+        breakpoints and the watches.
+        """
+        vm = self.vm
+        stopped = self.stopped
+        exec_frames = list(vm.exec_frame_stack) + [vm.exec_frame]
+
+        frames = []
+        for exec_frame in exec_frames:
+            if exec_frame.parent_exec_frame is not None and frames:
+                # A loop block of the function below it
+                frame = frames[-1]
+            else:
+                frame = {"id": exec_frame.id, "function": exec_frame.code.co_name,
+                         "filename": exec_frame.code.co_filename, "locals": {}}
+                frames.append(frame)
+
+            frame["locals"].update(describe_all(exec_frame.locals))
+            if stopped is not None and exec_frame is stopped[1]:
+                frame["line"] = stopped[2]
+            else:
+                frame["line"] = frame_line(vm, exec_frame)
+
+        frames.reverse()
+        return {"frames": frames, "globals": describe_all(vm.module_frame.globals), "instruction": vm.instruction_count,
+                "breakpoints": self.breakpoint_list(), "watches": self.watches}
+
+    def breakpoint_list(self):
+        return [{"line": line_no, "enabled": bp.enabled, "condition": bp.condition, "after": bp.after,
+                 "hits": bp.hits} for line_no, bp in sorted(self.breakpoints.items())]
+
+    def source(self, line=None, context=5):
+        source = self.vm.source
+        if line is None:
+            first, last = 1, len(source)
+        else:
+            first, last = max(1, line - context), min(len(source), line + context)
+
+        return [{"line": lineno, "text": source[lineno - 1].rstrip("\n")} for lineno in range(first, last + 1)]
+
+    def interact(self):
+        """
+        Sends where the program is and serves requests until one resumes it.
+        """
+        self.__send(self.__event())
+        while True:
+            line = self.__reader.readline()
+            if not line:
+                # The front end went away
+                self.close()
+                sys.exit(0)
+            if not line.strip():
+                continue
+
+            try:
+                request = json.loads(line.decode("utf-8"))
+                command = request["command"]
+            except (ValueError, KeyError, TypeError) as e:
+                self.__send({"id": None, "ok": False, "error": "Invalid request: %s" % e})
+                continue
+
+            response = {"id": request.get("id"), "ok": True}
+            try:
+                resume = self.__serve(command, request, response)
+            except Rewind:
+                # Going back unwinds out of this stop, the next event is sent from where the replay stops
+                self.__send(response)
+                raise
+            except Exception as e:
+                response["ok"] = False
+                response["error"] = "%s: %s" % (type(e).__name__, e)
+                resume = False
+
+            self.__send(response)
+            if command == "quit":
+                self.close()
+                sys.exit(0)
+            if resume:
+                return
+
+    def __serve(self, command, request, response):
+        """
+        Runs command, filling in response. Returns whether the program resumes.
+        """
+        if command == "run":
+            return True
+        elif command in ("step", "next", "finish"):
+            if not self.running:
+                raise Exception("The program is not running")
+            return {"step": self.step_inst, "next": self.next_inst, "finish": self.finish}[command]()
+        elif command == "set_breakpoint":
+            if not self.set_breakpoint(int(request["line"]), request.get("condition"),
+                                       int(request.get("after", 0))):
+                raise Exception("Invalid breakpoint condition %s" % request.get("condition"))
+        elif command == "disable_breakpoint":
+            self.disable_breakpoint(int(request["line"]))
+        elif command == "clear_breakpoint":
+            self.clear_breakpoint(int(request["line"]))
+        elif command == "clear_all_breakpoints":
+            self.clear_all_breakpoints()
+        elif command == "breakpoints":
+            response["breakpoints"] = self.breakpoint_list()
+        elif command == "watch":
+            if not self.watch(request["expression"]):
+                raise Exception("Can only watch a name or name.attribute")
+        elif command == "unwatch":
+            self.unwatch(request["expression"])
+        elif command == "watches":
+            response["watches"] = self.watches
+        elif command == "snapshot":
+            if not self.running:
+                raise Exception("The program is not running")
+            response["snapshot"] = self.snapshot()
+        elif command == "source":
+            line = request.get("line")
+            response["lines"] = self.source(int(line) if line is not None else None, int(request.get("context", 5)))
+        elif command == "set_local":
+            if not self.running:
+                raise Exception("The program is not running")
+            self.set_local(request["name"], request["value"])
+        elif command == "record":
+            self.record(request.get("interval"))
+        elif command in ("rstep", "goto"):
+            error = self.rewind_error()
+            if error is not None:
+                raise Exception(error)
+            if command == "rstep":
+                self.reverse_step()
+            else:
+                self.goto(int(request["instruction"]))
+        elif command != "quit":
+            raise Exception("Unknown command %s" % command)
+
+        return False
+
+class DebugClient:
+    """
+    Front end side of the protocol. request() returns the response to a command, events arriving in the
+    meantime are queued for next_event().
+    """
+    def __init__(self, socket_path):
+        self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__sock.connect(socket_path)
+        self.__reader = self.__sock.makefile("rb")
+        self.__next_id = 1
+        self.__events = []
+
+    def __read(self):
+        line = self.__reader.readline()
+        if not line:
+            raise Exception("Debugger closed the connection")
+        return json.loads(line.decode("utf-8"))
+
+    def request(self, command, **args):
+        request_id = self.__next_id
+        self.__next_id += 1
+        args["id"] = request_id
+        args["command"] = command
+        self.__sock.sendall(json.dumps(args).encode("utf-8") + b"\n")
+
+        while True:
+            message = self.__read()
+            if "event" in message:
+                self.__events.append(message)
+            elif message.get("id") == request_id:
+                return message
+
+    def next_event(self):
+        """
+        Waits for the next stop, or for the program to exit.
+        """
+        if self.__events:
+            return self.__events.pop(0)
+        return self.__read()
+
+    def close(self):
+        self.__reader.close()
+        self.__sock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="PyVyM debugger driven over a Unix domain socket")
+    parser.add_argument("socket_path", help="Path of the Unix domain socket to listen on")
+    parser.add_argument("filename", help="Program to debug")
+    args = parser.parse_args()
+
+    code, source_lines = ScriptCompiler().compile_file(args.filename)
+    debugger = RemoteDebugger(code, source_lines, args.filename, args.socket_path)
+    print("PyVyM debugger listening on %s" % args.socket_path)
+    debugger.execute(False)
+
+if __name__ == "__main__":
+    main()
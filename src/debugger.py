@@ -22,11 +22,16 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+from collections import ChainMap
 from enum import Enum
+from opcode import opmap, hasjabs
 
 from src.vmconfig import VMConfig
 from src.log import draw_header
-from src.vm import BytecodeVM
+from src.vm import BytecodeVM, Block
+from src.code_cache import code_objects
+from src.hooks import LINE
+from src.replay import Recorder, Rewind
 
 import sys
 
@@ -46,48 +51,580 @@ class DebuggerCmds(Enum):
     VM_SET_LOCAL = 12
     VM_VIEW_BACKTRACE = 14
     VM_VIEW_BREAKPOINTS = 15
+    VM_STEP = 16
+    VM_FINISH = 17
+    VM_WATCH = 18
+    VM_UNWATCH = 19
+    VM_VIEW_WATCHES = 20
+    VM_RECORD = 21
+    VM_REVERSE_STEP = 22
+    VM_GOTO = 23
     HELP = 90
     QUIT = 100
 
+def breakpoint_offsets(decoded, lineno):
+    """
+    Returns the offsets to trap for a breakpoint on lineno: the start of every stretch of instructions of the
+    line, or the loop head within it if there is one so a loop line stops once per iteration.
+    """
+    instructions = decoded.instructions
+    lines = decoded.lines
+
+    loop_heads = set()
+    for offset, instruction in enumerate(instructions):
+        if instruction is not None:
+            opmethod, oparg, size = instruction
+            if opmap.get(opmethod[len("execute_"):]) in hasjabs and oparg <= offset:
+                loop_heads.add(oparg)
+
+    offsets = []
+    start = None
+    for offset, instruction in enumerate(instructions):
+        if instruction is None:
+            continue
+        if lines[offset] != lineno:
+            start = None
+        elif start is None:
+            start = offset
+            offsets.append(offset)
+        elif offset in loop_heads and offsets[-1] == start:
+            offsets[-1] = offset
+
+    return offsets
+
+def function_depth(vm):
+    """
+    Number of function frames on the VM's stack, loop blocks don't count.
+    """
+    frames = vm.exec_frame_stack + [vm.exec_frame]
+    return sum(1 for frame in frames if not isinstance(frame.callable, Block))
+
+def return_frame(vm, depth):
+    """
+    Returns the frame that called the function at depth + 1, the one execution continues in once the
+    functions deeper than depth are done. None if there is no deeper function.
+    """
+    count = 0
+    previous = None
+    for frame in vm.exec_frame_stack + [vm.exec_frame]:
+        if not isinstance(frame.callable, Block):
+            count += 1
+            if count == depth + 1:
+                return previous
+        previous = frame
+
+    return None
+
+# Value of a variable or attribute that doesn't exist (yet)
+UNSET = object()
+
+def lookup(exec_frame, name):
+    """
+    Returns the value name has in exec_frame: its locals, the locals of the function a loop block runs in,
+    then the globals. UNSET if it isn't defined.
+    """
+    frame = exec_frame
+    while frame is not None:
+        if name in frame.locals:
+            return frame.locals[name]
+        frame = frame.parent_exec_frame
+
+    return exec_frame.globals.get(name, UNSET)
+
+def changed(old, new):
+    if old is new:
+        return False
+
+    try:
+        return not (old == new)
+    except Exception:
+        # Values without a plain truth value for ==, like arrays
+        return True
+
+class Watchpoints:
+    """
+    Stops the debugger when a watched variable, attribute or item changes. A VM tool wrapping only the store
+    handlers, hooked in only while something is watched:
+
+        x        STORE_FAST and STORE_NAME of x, STORE_SUBSCR into the object x is bound to
+        obj.y    STORE_ATTR of y on the object obj is bound to in the storing frame, like self.y
+
+    on_change(exec_frame, offset, description, old, new) is called after the store.
+    """
+    def __init__(self, on_change):
+        self.__on_change = on_change
+        self.__vm = None
+        self.__names = set()
+        # attribute -> set of the names the object is bound to
+        self.__attributes = {}
+
+    @property
+    def watching(self):
+        return bool(self.__names or self.__attributes)
+
+    def expressions(self):
+        watches = sorted(self.__names)
+        for attribute, names in sorted(self.__attributes.items()):
+            watches.extend("%s.%s" % (name, attribute) for name in sorted(names))
+        return watches
+
+    def add(self, expression):
+        """
+        Returns False if expression is neither a name nor name.attribute.
+        """
+        parts = expression.split(".")
+        if len(parts) > 2 or not all(part.isidentifier() for part in parts):
+            return False
+
+        # The wrappers hold on to these containers, update them in place
+        if len(parts) == 1:
+            self.__names.add(expression)
+        else:
+            self.__attributes.setdefault(parts[1], set()).add(parts[0])
+        return True
+
+    def remove(self, expression):
+        parts = expression.split(".")
+        if len(parts) == 1:
+            self.__names.discard(expression)
+        elif parts[1] in self.__attributes:
+            self.__attributes[parts[1]].discard(parts[0])
+            if not self.__attributes[parts[1]]:
+                del self.__attributes[parts[1]]
+
+    def instrument(self, vm, dispatch):
+        """
+        Returns dispatch with the store handlers wrapped to check the watches.
+        """
+        self.__vm = vm
+        dispatch = dispatch.instrument(self.__wrap_store_name, ["execute_STORE_FAST", "execute_STORE_NAME"])
+        dispatch = dispatch.instrument(self.__wrap_store_attr, ["execute_STORE_ATTR"])
+        return dispatch.instrument(self.__wrap_store_subscr, ["execute_STORE_SUBSCR"])
+
+    def __wrap_store_name(self, opmethod, handler):
+        vm = self.__vm
+        names = self.__names
+        on_change = self.__on_change
+        fast = opmethod == "execute_STORE_FAST"
+
+        def watched(oparg):
+            exec_frame = vm.exec_frame
+            name = exec_frame.get_local_var_name(oparg) if fast else exec_frame.names[oparg]
+            if name not in names:
+                return handler(oparg)
+
+            old = lookup(exec_frame, name)
+            terminate = handler(oparg)
+            new = lookup(exec_frame, name)
+            if changed(old, new):
+                on_change(exec_frame, exec_frame.ip - 3, name, old, new)
+            return terminate
+
+        return watched
+
+    def __wrap_store_attr(self, opmethod, handler):
+        vm = self.__vm
+        attributes = self.__attributes
+        on_change = self.__on_change
+
+        def watched(namei):
+            exec_frame = vm.exec_frame
+            attribute = exec_frame.names[namei]
+            if attribute not in attributes:
+                return handler(namei)
+
+            obj = exec_frame.top()
+            names = [name for name in attributes[attribute] if lookup(exec_frame, name) is obj]
+            if not names:
+                return handler(namei)
+
+            old = getattr(obj, attribute, UNSET)
+            terminate = handler(namei)
+            new = getattr(obj, attribute, UNSET)
+            if changed(old, new):
+                on_change(exec_frame, exec_frame.ip - 3, "%s.%s" % (names[0], attribute), old, new)
+            return terminate
+
+        return watched
+
+    def __wrap_store_subscr(self, opmethod, handler):
+        vm = self.__vm
+        names = self.__names
+        on_change = self.__on_change
+
+        def watched():
+            if not names:
+                return handler()
+
+            # TOS1[TOS] = TOS2
+            exec_frame = vm.exec_frame
+            key, obj = exec_frame.stack[-1], exec_frame.stack[-2]
+            watched_names = [name for name in names if lookup(exec_frame, name) is obj]
+            if not watched_names:
+                return handler()
+
+            try:
+                old = obj[key]
+            except Exception:
+                old = UNSET
+            terminate = handler()
+            if changed(old, obj[key]):
+                on_change(exec_frame, exec_frame.ip - 1, "%s[%r]" % (watched_names[0], key), old, obj[key])
+            return terminate
+
+        return watched
+
+class Breakpoint:
+    """
+    A breakpoint on a source line. The condition is compiled once and only evaluated when the line's trap
+    fires. Hits count the times the line was reached with the condition true, the first after hits don't stop.
+    """
+    def __init__(self, line_no, condition=None, after=0):
+        self.line_no = line_no
+        self.enabled = True
+        self.condition = condition
+        self.code = compile(condition, "<breakpoint %s>" % line_no, "eval") if condition else None
+        self.__eval_globals = {}
+        self.after = after
+        self.hits = 0
+
+    def should_stop(self, exec_frame):
+        if self.code is not None:
+            # Loop blocks are frames of their own, the function's locals live further up the chain. Names are
+            # looked up through the frames' own dicts, eval only gets a dict of its own for globals to put
+            # __builtins__ in, so nothing is copied per hit and the guest's globals stay untouched.
+            scopes = []
+            frame = exec_frame
+            while frame is not None:
+                scopes.append(frame.locals)
+                frame = frame.parent_exec_frame
+            scopes.append(exec_frame.globals)
+
+            try:
+                if not eval(self.code, self.__eval_globals, ChainMap(*scopes)):
+                    return False
+            except Exception as e:
+                print("Breakpoint condition %s raised %s: %s" % (self.condition, type(e).__name__, e))
+                return True
+
+        self.hits += 1
+        return self.hits > self.after
+
+    def __str__(self):
+        description = "Enabled" if self.enabled else "Disabled"
+        if self.condition:
+            description += " if %s" % self.condition
+        if self.after:
+            description += " after %s" % self.after
+        return "%s, %s hits" % (description, self.hits)
+
 class Debugger:
-    def __init__(self, code, source, filename):
+    """
+    Interactive debugger. The program runs at full speed in the VM: breakpoints are traps patched over the
+    first instruction of their line, stepping subscribes to the VM's line events only while a step is in
+    progress. Stopping prompts for commands from inside the trap or event callback, the program resumes when
+    the callback returns.
+
+    Stepping over or out of a call doesn't watch the callee's lines. A trap goes on the instruction the caller
+    resumes at and the call runs at full speed until it fires in the caller's frame.
+
+    Going back in time needs the run recorded from the start (see src.replay): a rewind unwinds out of the
+    callback with Rewind, run_vm restores the checkpoint and replays up to the instruction asked for.
+    """
+    def __init__(self, code, source, filename, config=None):
         self.__breakpoints = {}
         self.__prompt = ">>> "
         self.__debugger_broken = False
+        self.__step_mode = None
+        self.__hooked = False
+        self.__watchpoints = Watchpoints(self.__on_watch)
+        # Checkpoint interval while recording, None when not
+        self.__record_interval = None
 
         self.__code = code
         self.__source = source
         self.__filename = filename
+        # The caller's VMConfig, every VM the debugger (re)starts runs with it
+        self.__config = config if config is not None else VMConfig()
 
         self.initialize_vm(code, source, filename)
         draw_header("Initializing Debugger...")
 
         self.__breakpoint_hit = None
         self.__vm_running = False
+        # (reason, frame, line, details) of the last stop
+        self.__stopped = None
+        self.__return_value = None
+
+    @property
+    def vm(self):
+        return self.__vm
+
+    @property
+    def running(self):
+        return self.__vm_running
+
+    @property
+    def stopped(self):
+        """
+        (reason, exec_frame, lineno, details) of where the program is stopped: reason is one of "step",
+        "return", "breakpoint", "watch" and "replay", details has the return value or the watched expression
+        with its old and new value. None when the program isn't running.
+        """
+        return self.__stopped
+
+    @property
+    def return_value(self):
+        """
+        What the last run of the program returned.
+        """
+        return self.__return_value
+
+    @property
+    def breakpoints(self):
+        return self.__breakpoints
+
+    @property
+    def watches(self):
+        return self.__watchpoints.expressions()
 
     def initialize_vm(self, code, source, filename):
         self.__vm = BytecodeVM(code, source, filename)
-        config = VMConfig()
-        self.__vm.config = config
-        config.show_disassembly = True
-        self.__vm.execute = self.execute
+        self.__vm.config = self.__config
+
+        self.__step_mode = None
+        self.__step_depth = 0
+        self.__step_origin = None
+        # (frame, code, offset) of the trap waiting for a call to return during next or finish
+        self.__return_trap = None
+        self.__hooked = False
+        self.__update_hooks()
+
+        # line -> [(code, offset)] of the traps patched for the breakpoint
+        self.__traps = {}
+        for line_no, bp in self.__breakpoints.items():
+            bp.hits = 0
+            if bp.enabled:
+                self.__patch(line_no)
+
+        if self.__watchpoints.watching:
+            self.__vm.hooks.use_tool("watchpoints", self.__watchpoints)
+
+        # A recording covers one run
+        self.__recorder = None
+        if self.__record_interval is not None:
+            self.__recorder = Recorder(self.__on_replayed, self.__record_interval)
+            self.__vm.hooks.use_tool("recorder", self.__recorder)
+
+    def __patch(self, line_no):
+        traps = self.__traps.setdefault(line_no, [])
+        for code in code_objects(self.__code):
+            for offset in breakpoint_offsets(self.__vm.code_cache.decode(code), line_no):
+                self.__vm.set_trap(code, offset, self.__on_breakpoint)
+                traps.append((code, offset))
+
+    def __unpatch(self, line_no):
+        for code, offset in self.__traps.pop(line_no, []):
+            self.__vm.clear_trap(code, offset, self.__on_breakpoint)
+
+    def __update_hooks(self):
+        """
+        Listens to line events only while a step is in progress and not waiting for a call to return.
+        """
+        needed = self.__step_mode is not None and self.__return_trap is None
+        if needed and not self.__hooked:
+            self.__vm.hooks.subscribe(LINE, self.__on_line)
+        elif self.__hooked and not needed:
+            self.__vm.hooks.unsubscribe(LINE, self.__on_line)
+        self.__hooked = needed
+
+    def __set_return_trap(self, frame):
+        self.__return_trap = (frame, frame.code, frame.ip)
+        self.__vm.set_trap(frame.code, frame.ip, self.__on_return)
+        self.__update_hooks()
+
+    def __clear_return_trap(self):
+        if self.__return_trap is not None:
+            frame, code, offset = self.__return_trap
+            self.__vm.clear_trap(code, offset, self.__on_return)
+            self.__return_trap = None
+
+    def __end_step(self):
+        self.__step_mode = None
+        self.__clear_return_trap()
+        self.__update_hooks()
+
+    def __on_line(self, exec_frame, lineno):
+        # Stepping off a breakpoint starts on the line the breakpoint stopped at
+        if self.__step_origin == (exec_frame, lineno):
+            return
+
+        if self.__step_mode == "next" and function_depth(self.__vm) > self.__step_depth:
+            # Entered a call: let it run and pick up stepping when it returns
+            self.__set_return_trap(return_frame(self.__vm, self.__step_depth))
+            return
+
+        self.__end_step()
+        print(exec_frame.line_no_obj.get_source_sorrounding_line(lineno))
+        self.__stop(exec_frame, lineno, "step")
+
+    def __on_return(self, exec_frame, offset):
+        # Recursive calls run the same instruction in frames of their own
+        if exec_frame is not self.__return_trap[0]:
+            return
+
+        self.__clear_return_trap()
+        if self.__step_mode == "next":
+            self.__update_hooks()
+            return
+
+        lineno = self.__vm.code_cache.decode(exec_frame.code).lines[offset]
+        self.__end_step()
+        draw_header("Returned to %s" % exec_frame.code.co_name)
+        details = {}
+        if exec_frame.stack:
+            details["return_value"] = exec_frame.top()
+            print("Return value: %s" % (exec_frame.top(),))
+        print(exec_frame.line_no_obj.get_source_sorrounding_line(lineno))
+        self.__stop(exec_frame, lineno, "return", **details)
+
+    def __replaying(self):
+        return self.__recorder is not None and self.__recorder.replaying
+
+    def __on_breakpoint(self, exec_frame, offset):
+        if self.__replaying():
+            return
+
+        lineno = self.__vm.code_cache.decode(exec_frame.code).lines[offset]
+        if not self.__breakpoints[lineno].should_stop(exec_frame):
+            return
 
-    def set_breakpoint(self, line_no):
-        self.__breakpoints[line_no] = True
+        # Hitting a breakpoint ends a step in progress
+        self.__end_step()
+
+        breakpoint_hit = exec_frame.line_no_obj.get_source_line(lineno)
+        draw_header("Breakpoint Hit: %s" % breakpoint_hit)
+        print(exec_frame.line_no_obj.get_source_sorrounding_line(lineno))
+        self.__breakpoint_hit = lineno
+        self.__stop(exec_frame, lineno, "breakpoint")
+
+    def __on_watch(self, exec_frame, offset, description, old, new):
+        if self.__replaying():
+            return
+
+        lineno = self.__vm.code_cache.decode(exec_frame.code).lines[offset]
+        self.__end_step()
+
+        draw_header("Watchpoint: %s" % description)
+        print("Old value: %s" % ("<undefined>" if old is UNSET else old,))
+        print("New value: %s" % ("<undefined>" if new is UNSET else new,))
+        print(exec_frame.line_no_obj.get_source_sorrounding_line(lineno))
+        self.__stop(exec_frame, lineno, "watch", expression=description, old=old, new=new)
+
+    def __on_replayed(self, exec_frame, offset):
+        lineno = self.__vm.code_cache.decode(exec_frame.code).lines[offset]
+        draw_header("Replayed")
+        print(exec_frame.line_no_obj.get_source_sorrounding_line(lineno))
+        self.__stop(exec_frame, lineno, "replay")
+
+    def record(self, interval=None):
+        """
+        Records the program from its next run, or from here on if it's running, taking a checkpoint every
+        interval instructions.
+        """
+        self.__record_interval = interval if interval is not None else 1000
+        self.__recorder = Recorder(self.__on_replayed, self.__record_interval)
+        self.__vm.hooks.use_tool("recorder", self.__recorder)
+
+    def rewind_error(self):
+        """
+        Why the program can't go back or forward in time right now, None if it can.
+        """
+        if self.__vm_running is False:
+            return "App is not running. Run it with 'run'"
+        if self.__recorder is None or self.__recorder.first is None:
+            return "Nothing recorded. Start recording with 'record' before running"
+        if self.__vm.scheduler.active:
+            return "Can't go back in a program running green threads"
+        return None
+
+    def __can_rewind(self):
+        error = self.rewind_error()
+        if error is not None:
+            print(error)
+        return error is None
+
+    def reverse_step(self):
+        """
+        Goes back to the start of the line executed before the current one.
+        """
+        if self.__can_rewind():
+            self.__end_step()
+            raise Rewind(self.__vm.instruction_count, line=True)
+
+    def goto(self, count):
+        """
+        Goes back, or forward, to just before instruction count runs.
+        """
+        if self.__can_rewind():
+            self.__end_step()
+            raise Rewind(count)
+
+    def watch(self, expression):
+        if not self.__watchpoints.add(expression):
+            print("Can only watch a name or name.attribute: %s" % expression)
+            return False
+
+        self.__vm.hooks.use_tool("watchpoints", self.__watchpoints)
+        return True
+
+    def unwatch(self, expression):
+        self.__watchpoints.remove(expression)
+        if not self.__watchpoints.watching:
+            self.__vm.hooks.use_tool("watchpoints", None)
+
+    def view_watches(self):
+        draw_header("Watches")
+        for expression in self.__watchpoints.expressions():
+            print(expression)
+
+    def __stop(self, exec_frame, lineno, reason, **details):
+        # Paused: the program carries on once a command resumes it
+        self.__step_origin = (exec_frame, lineno)
+        self.__stopped = (reason, exec_frame, lineno, details)
+        if self.__recorder is not None:
+            print("Instruction %s" % self.__vm.instruction_count)
+        self.interact()
+
+    def set_breakpoint(self, line_no, condition=None, after=0):
+        try:
+            bp = Breakpoint(line_no, condition, after)
+        except SyntaxError as e:
+            print("Invalid breakpoint condition %s: %s" % (condition, e))
+            return False
+
+        if line_no not in self.__traps:
+            self.__patch(line_no)
+        self.__breakpoints[line_no] = bp
+        return True
 
     def disable_breakpoint(self, line_no):
         if line_no not in self.__breakpoints.keys():
             return
 
-        self.__breakpoints[line_no] = False
+        self.__breakpoints[line_no].enabled = False
+        self.__unpatch(line_no)
 
     def clear_breakpoint(self, line_no):
         if line_no not in self.__breakpoints.keys():
             return
 
         del self.__breakpoints[line_no]
+        self.__unpatch(line_no)
 
     def clear_all_breakpoints(self):
+        for line_no in list(self.__traps):
+            self.__unpatch(line_no)
         self.__breakpoints = {}
 
     def view_locals(self, local_var=None):
@@ -118,6 +655,10 @@ class Debugger:
         except:
             exec_frame.set_local_var_value(local_var, val_to_set)
 
+        if self.__recorder is not None:
+            # The program won't take the recorded path from here on
+            self.__recorder.discard_after(self.__vm.instruction_count)
+
         draw_header("Locals Changed")
         val, exec_frame = self.__vm.exec_frame.get_local_var_value(local_var)
         print("%s: %s" % (local_var, val))
@@ -137,14 +678,10 @@ class Debugger:
 
     def view_breakpoints(self):
         draw_header("Breakpoints Set")
-        for bp, status in self.__breakpoints.items():
-            breakpoint_hit = self.__vm.exec_frame.line_no_obj.get_source_line(bp)
+        for line_no, bp in self.__breakpoints.items():
+            breakpoint_hit = self.__vm.exec_frame.line_no_obj.get_source_line(line_no)
             breakpoint_hit = breakpoint_hit.strip()
-            if status == True:
-                status = "Enabled"
-            else:
-                status = "Disabled"
-            print("Breakpoint Line %s: %s ---> %s" % (bp, status, breakpoint_hit))
+            print("Breakpoint Line %s: %s ---> %s" % (line_no, bp, breakpoint_hit))
 
     def view_source(self, lineno):
         if lineno > 0:
@@ -155,12 +692,23 @@ class Debugger:
         print(lines)
 
     def display_help(self):
-        print("\tnext - Execute Next Instruction")
+        print("\tstep - Execute until the next line, stepping into calls")
+        print("\tnext - Execute until the next line of this function, stepping over calls")
+        print("\tfinish - Execute until the current function returns")
         print("\trun - Run VM")
         print("\tset bp <loc> - Set Breakpoint at loc")
+        print("\tset bp <loc> if <expr> - Only break when expr is true in the frame reaching loc")
+        print("\tset bp <loc> after <n> - Only break once loc was reached n times")
         print("\tdisable bp <loc> - Disable Breakpoint at loc")
         print("\tclear bp <loc> - Disable Breakpoint at loc")
         print("\tclear all bps - Clear all Breakpoints")
+        print("\twatch <var> - Stop when var, or an item stored into it, changes")
+        print("\twatch <var>.<attr> - Stop when attr of the object var is bound to changes")
+        print("\tunwatch <expr> - Remove a watch")
+        print("\tview watches - View the watches")
+        print("\trecord [<n>] - Record the run, with a checkpoint every n instructions, to be able to go back")
+        print("\trstep - Go back to the start of the previous line (needs record)")
+        print("\tgoto <n> - Go back or forward to instruction n (needs record)")
         print("\tview source <loc> - View Source. If no loc is specified entire source is shown")
         print("\tview locals - View the Local variables")
         print("\tview globals - View the Global variables")
@@ -174,13 +722,25 @@ class Debugger:
     def parse_command(self, cmd):
         if cmd == "next":
             return DebuggerCmds.VM_NEXT_INST
+        elif cmd == "step":
+            return DebuggerCmds.VM_STEP
+        elif cmd == "finish":
+            return DebuggerCmds.VM_FINISH
         elif cmd == "run":
             return DebuggerCmds.VM_RUN
         elif "set bp" in cmd:
-            parts = cmd.split(" ")
+            # set bp <loc> [after <n>] [if <expr>]
+            parts = cmd.split(None, 3)
             bp_location = int(parts[2])
+            rest = parts[3] if len(parts) > 3 else ""
+            after = 0
+            if rest.startswith("after"):
+                after_parts = rest.split(None, 2)
+                after = int(after_parts[1])
+                rest = after_parts[2] if len(after_parts) > 2 else ""
+            condition = rest[len("if"):].strip() if rest.startswith("if") else None
             cmd = DebuggerCmds.VM_SET_BP
-            return (cmd, bp_location)
+            return (cmd, bp_location, condition, after)
         elif "disable bp" in cmd:
             parts = cmd.split(" ")
             bp_location = int(parts[2])
@@ -191,6 +751,19 @@ class Debugger:
             bp_location = int(parts[2])
             cmd = DebuggerCmds.VM_CLEAR_BP
             return (cmd, bp_location)
+        elif cmd.startswith("watch "):
+            return (DebuggerCmds.VM_WATCH, cmd[len("watch "):].strip())
+        elif cmd.startswith("unwatch "):
+            return (DebuggerCmds.VM_UNWATCH, cmd[len("unwatch "):].strip())
+        elif cmd == "view watches":
+            return DebuggerCmds.VM_VIEW_WATCHES
+        elif cmd == "record" or cmd.startswith("record "):
+            parts = cmd.split()
+            return (DebuggerCmds.VM_RECORD, int(parts[1]) if len(parts) > 1 else None)
+        elif cmd == "rstep":
+            return DebuggerCmds.VM_REVERSE_STEP
+        elif cmd.startswith("goto "):
+            return (DebuggerCmds.VM_GOTO, int(cmd.split()[1]))
         elif cmd == "clear all bps":
             cmd = DebuggerCmds.VM_CLEAR_ALL_BP
             return cmd
@@ -243,53 +816,72 @@ class Debugger:
         return cmd_res
 
     def run_vm(self):
-        # Run until any breakpoint is hit
+        # Run until the program exits, stopping at breakpoints along the way
         self.__vm_running = True
+        run = self.__vm.execute
         while True:
-            opmethod, oparg, current_lineno = self.__vm.get_opcode()
-
-            # Check if any breakpoint got hit
-            if current_lineno in self.__breakpoints.keys():
-                if self.__breakpoints[current_lineno] is True:
-                    breakpoint_hit = self.__vm.exec_frame.line_no_obj.get_source_line(current_lineno)
-                    draw_header("Breakpoint Hit: %s" % breakpoint_hit)
-                    lines = self.__vm.exec_frame.line_no_obj.get_source_sorrounding_line(current_lineno)
-                    print(lines)
-                    self.__breakpoint_hit = current_lineno
-                    return
-
-            terminate = self.__vm.execute_opcode(opmethod, oparg)
-            if terminate:
+            try:
+                self.__return_value = run()
                 break
+            except Rewind as rewind:
+                # Unwound out of the stop, put the program back and replay from the checkpoint
+                self.__recorder.seek(rewind.target, rewind.line, rewind.before)
+                run = self.__vm.resume
 
         # Reinitialize for next execution
         self.initialize_vm(self.__code, self.__source, self.__filename)
         print("App exited...")
         self.__vm_running = False
+        self.__stopped = None
         return
 
-    def next_inst(self):
+    def __start_step(self, mode):
+        """
+        Returns whether the program is running to step at all.
+        """
         if self.__vm_running is False:
             print("App is not running. Run it with 'run'")
-            return
+            return False
 
-        current_lineno = self.__vm.exec_frame.line_no_obj.line_number(self.__vm.exec_frame.ip)
-        lineno = current_lineno
+        self.__step_mode = mode
+        self.__step_depth = function_depth(self.__vm)
+        return True
 
-        while lineno == current_lineno:
-            opmethod, oparg, lineno = self.__vm.get_opcode()
-            terminate = self.__vm.execute_opcode(opmethod, oparg)
+    def step_inst(self):
+        """
+        Stops again at the next line executed, in this function or a function it calls.
+        """
+        if not self.__start_step("step"):
+            return False
 
-            if terminate:
-                # Reinitialize for next execution
-                self.initialize_vm(self.__code, self.__source, self.__filename)
-                print("App exited...")
-                self.__vm_running = False
-                return
-
-        lines = self.__vm.exec_frame.line_no_obj.get_source_sorrounding_line(lineno)
-        print(lines)
+        self.__update_hooks()
+        return True
 
+    def next_inst(self):
+        """
+        Stops again at the next line of this function, or of its caller once it returns. Calls run at full
+        speed.
+        """
+        if not self.__start_step("next"):
+            return False
+
+        self.__update_hooks()
+        return True
+
+    def finish(self):
+        """
+        Runs until the current function returns and stops in its caller.
+        """
+        if not self.__start_step("finish"):
+            return False
+
+        frame = return_frame(self.__vm, self.__step_depth - 1)
+        if frame is None:
+            # Finishing the module runs the program to the end
+            self.__step_mode = None
+        else:
+            self.__set_return_trap(frame)
+        return True
 
     def view_asm(self):
         if self.__breakpoint_hit is None:
@@ -298,52 +890,86 @@ class Debugger:
         else:
             self.__vm.exec_frame.line_no_obj.get_source_sorrounding_line(self.__breakpoint_hit)
 
-    def execute(self, call_from_vm = True):
+    def interact(self):
+        """
+        Prompts for commands until one resumes the program.
+        """
         while True:
-            arg1 = None
-
-            if not call_from_vm:
-                cmd_res = self.display_prompt()
-                if isinstance(cmd_res, tuple):
-                    cmd = cmd_res[0]
-                    arg1 = cmd_res[1]
-                else:
-                    cmd = cmd_res
+            cmd_res = self.display_prompt()
+            if isinstance(cmd_res, tuple):
+                cmd = cmd_res[0]
             else:
-                cmd = DebuggerCmds.VM_RUN
+                cmd = cmd_res
 
             if cmd is DebuggerCmds.VM_RUN:
-                self.run_vm()
+                return cmd
             elif cmd is DebuggerCmds.VM_NEXT_INST:
-                self.next_inst()
-            elif cmd is DebuggerCmds.VM_SET_BP:
-                self.set_breakpoint(arg1)
-            elif cmd is DebuggerCmds.VM_DISABLE_BP:
-                self.disable_breakpoint(arg1)
-            elif cmd is DebuggerCmds.VM_CLEAR_BP:
-                self.clear_breakpoint(arg1)
-            elif cmd is DebuggerCmds.VM_CLEAR_ALL_BP:
-                self.clear_all_breakpoints()
-            elif cmd is DebuggerCmds.VM_VIEW_LOCALS:
-                self.view_locals()
-            elif cmd is DebuggerCmds.VM_VIEW_LOCAL:
-                self.view_locals(arg1)
-            elif cmd is DebuggerCmds.VM_SET_LOCAL:
-                val = cmd_res[2]
-                self.set_local(arg1, val)
-            elif cmd is DebuggerCmds.VM_VIEW_GLOBALS:
-                self.view_globals()
-            elif cmd is DebuggerCmds.VM_VIEW_GLOBAL:
-                self.view_globals(arg1)
-            elif cmd is DebuggerCmds.VM_VIEW_BACKTRACE:
-                self.view_backtrace()
-            elif cmd is DebuggerCmds.VM_VIEW_BREAKPOINTS:
-                self.view_breakpoints()
-            elif cmd is DebuggerCmds.VM_VIEW_SOURCE:
-                self.view_source(arg1)
-            elif cmd is DebuggerCmds.HELP:
-                self.display_help()
-            elif cmd is DebuggerCmds.QUIT:
-                sys.exit(0)
-
-            call_from_vm = False
\ No newline at end of file
+                if self.next_inst():
+                    return cmd
+            elif cmd is DebuggerCmds.VM_STEP:
+                if self.step_inst():
+                    return cmd
+            elif cmd is DebuggerCmds.VM_FINISH:
+                if self.finish():
+                    return cmd
+            else:
+                self.run_command(cmd_res)
+
+    def run_command(self, cmd_res):
+        arg1 = None
+        if isinstance(cmd_res, tuple):
+            cmd = cmd_res[0]
+            arg1 = cmd_res[1]
+        else:
+            cmd = cmd_res
+
+        if cmd is DebuggerCmds.VM_SET_BP:
+            self.set_breakpoint(arg1, cmd_res[2], cmd_res[3])
+        elif cmd is DebuggerCmds.VM_DISABLE_BP:
+            self.disable_breakpoint(arg1)
+        elif cmd is DebuggerCmds.VM_CLEAR_BP:
+            self.clear_breakpoint(arg1)
+        elif cmd is DebuggerCmds.VM_CLEAR_ALL_BP:
+            self.clear_all_breakpoints()
+        elif cmd is DebuggerCmds.VM_WATCH:
+            self.watch(arg1)
+        elif cmd is DebuggerCmds.VM_UNWATCH:
+            self.unwatch(arg1)
+        elif cmd is DebuggerCmds.VM_VIEW_WATCHES:
+            self.view_watches()
+        elif cmd is DebuggerCmds.VM_RECORD:
+            self.record(arg1)
+        elif cmd is DebuggerCmds.VM_REVERSE_STEP:
+            self.reverse_step()
+        elif cmd is DebuggerCmds.VM_GOTO:
+            self.goto(arg1)
+        elif cmd is DebuggerCmds.VM_VIEW_LOCALS:
+            self.view_locals()
+        elif cmd is DebuggerCmds.VM_VIEW_LOCAL:
+            self.view_locals(arg1)
+        elif cmd is DebuggerCmds.VM_SET_LOCAL:
+            val = cmd_res[2]
+            self.set_local(arg1, val)
+        elif cmd is DebuggerCmds.VM_VIEW_GLOBALS:
+            self.view_globals()
+        elif cmd is DebuggerCmds.VM_VIEW_GLOBAL:
+            self.view_globals(arg1)
+        elif cmd is DebuggerCmds.VM_VIEW_BACKTRACE:
+            self.view_backtrace()
+        elif cmd is DebuggerCmds.VM_VIEW_BREAKPOINTS:
+            self.view_breakpoints()
+        elif cmd is DebuggerCmds.VM_VIEW_SOURCE:
+            self.view_source(arg1)
+        elif cmd is DebuggerCmds.HELP:
+            self.display_help()
+        elif cmd is DebuggerCmds.QUIT:
+            sys.exit(0)
+
+    def execute(self, call_from_vm = True):
+        while True:
+            # Only run gets past the prompt while the program isn't running
+            if not call_from_vm:
+                self.interact()
+
+            self.run_vm()
+            call_from_vm = False
@@ -0,0 +1,280 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Event hooks. Tools and event callbacks plug into a VM through vm.hooks, which owns the dispatch table its
+# loops run through:
+#
+#   vm.hooks.subscribe(LINE, callback)           callback(frame, lineno)
+#   vm.hooks.use_tool("call_profiler", tool)     tool.instrument(vm, dispatch) returns the wrapped table
+#
+# The dispatch loops never check whether anything is subscribed. Instead the handlers of the tools in use and
+# of the subscribed events are wrapped around the base handlers and copied into the live table, so events
+# nobody listens to cost nothing.
+
+from src.profiler import FrameTracker, takes_argument
+
+CALL = "call"
+RETURN = "return"
+LINE = "line"
+INSTRUCTION = "instruction"
+EXCEPTION = "exception"
+
+EVENTS = (CALL, RETURN, LINE, INSTRUCTION, EXCEPTION)
+
+class FrameEvents(FrameTracker):
+    """
+    Fires the call and return events from the frame changes a FrameTracker follows.
+    """
+    def __init__(self, callbacks):
+        FrameTracker.__init__(self)
+        self.__callbacks = callbacks
+
+    def on_enter(self, record, now):
+        for callback in self.__callbacks[CALL]:
+            callback(record.frame)
+
+    def on_exit(self, record, caller, now, outermost):
+        for callback in self.__callbacks[RETURN]:
+            callback(record.frame)
+
+class LineTracker:
+    """
+    Follows the line a VM executes, one instruction at a time. A line starts when execution moves to another
+    line of the function, loop blocks included, jumps back within the line or enters a new frame at its first
+    instruction, not when a call returns into the middle of one.
+    """
+    def __init__(self, vm):
+        self.__vm = vm
+        self.reset()
+
+    def reset(self, exec_frame=None):
+        """
+        Forgets the previous instruction. Given the frame execution continues in, the next instruction starts
+        a line even mid line.
+        """
+        # The frame of the previous instruction, the function frame it belongs to, its line table, line and
+        # offset
+        self.__frame = None
+        self.__function_frame = None
+        self.__line_table = None
+        self.__lineno = None
+        self.__offset = 0
+
+        if exec_frame is not None:
+            self.__function_frame = self.__function_frame_of(exec_frame)
+
+    def __function_frame_of(self, exec_frame):
+        # Loop blocks are frames of their own running the code of the function frame they're in
+        while exec_frame.parent_exec_frame is not None:
+            exec_frame = exec_frame.parent_exec_frame
+        return exec_frame
+
+    def step(self, exec_frame, offset):
+        """
+        Returns the line number if the instruction at offset starts a line, None otherwise.
+        """
+        if exec_frame is self.__frame:
+            lineno = self.__line_table[offset]
+            new_line = lineno != self.__lineno or offset < self.__offset
+        else:
+            function_frame = self.__function_frame_of(exec_frame)
+            self.__frame = exec_frame
+            self.__line_table = self.__vm.decoded(exec_frame.code).lines
+            lineno = self.__line_table[offset]
+            if function_frame is self.__function_frame:
+                new_line = lineno != self.__lineno or offset < self.__offset
+            else:
+                self.__function_frame = function_frame
+                new_line = offset == 0
+
+        self.__lineno = lineno
+        self.__offset = offset
+        return lineno if new_line else None
+
+class Hooks:
+    """
+    The events and tools hooked into a VM's dispatch table. Events and their callbacks:
+
+        call         callback(frame)                          a function frame starts or resumes executing
+        return       callback(frame)                          a function frame returns or yields
+        line         callback(frame, lineno)                  before the first instruction of a line
+        instruction  callback(frame, offset, opmethod, oparg) before every instruction
+        exception    callback(frame, offset, exception)       an instruction raised
+
+    Lines start as LineTracker finds them. Subscribing to call or return while the guest runs reports the
+    frames already on the stack as calls. Exceptions are reported once, for the frame they were raised in.
+
+    Tools are objects with an instrument(vm, dispatch) method, like the profilers, chained in the order they
+    were first used. Changes take effect from the next instruction on, callbacks can subscribe and
+    unsubscribe while they run.
+    """
+    def __init__(self, vm, base_dispatch):
+        self.__vm = vm
+        self.__base_dispatch = base_dispatch
+        self.__dispatch = base_dispatch.copy()
+        self.__tools = []
+        self.__callbacks = dict((event, ()) for event in EVENTS)
+        self.__frame_events = None
+        self.__line_tracker = LineTracker(vm)
+        self.__exception = None
+
+    @property
+    def dispatch(self):
+        """
+        The table the dispatch loops run through. Stays the same object, updated in place.
+        """
+        return self.__dispatch
+
+    def subscribe(self, event, callback):
+        if event not in self.__callbacks:
+            raise Exception("Unknown event %s" % event)
+
+        if callback not in self.__callbacks[event]:
+            self.__callbacks[event] += (callback,)
+            self.__update()
+
+    def unsubscribe(self, event, callback):
+        callbacks = self.__callbacks[event]
+        if callback in callbacks:
+            self.__callbacks[event] = tuple(c for c in callbacks if c != callback)
+            self.__update()
+
+    def subscribed(self, event):
+        return len(self.__callbacks[event]) > 0
+
+    def tool(self, name):
+        for tool_name, tool in self.__tools:
+            if tool_name == name:
+                return tool
+
+        return None
+
+    def use_tool(self, name, tool):
+        """
+        Hooks tool in under name, replacing the tool in use under that name. None removes it.
+        """
+        for i, (tool_name, _) in enumerate(self.__tools):
+            if tool_name == name:
+                if tool is None:
+                    del self.__tools[i]
+                else:
+                    self.__tools[i] = (name, tool)
+                break
+        else:
+            if tool is not None:
+                self.__tools.append((name, tool))
+
+        self.__update()
+
+    def __update(self):
+        vm = self.__vm
+        callbacks = self.__callbacks
+
+        dispatch = self.__base_dispatch
+        for name, tool in self.__tools:
+            dispatch = tool.instrument(vm, dispatch)
+
+        if callbacks[EXCEPTION]:
+            dispatch = dispatch.instrument(self.__wrap_exception)
+        if callbacks[LINE] or callbacks[INSTRUCTION]:
+            self.__line_tracker.reset()
+            dispatch = dispatch.instrument(self.__wrap_instruction)
+
+        if callbacks[CALL] or callbacks[RETURN]:
+            if self.__frame_events is None:
+                self.__frame_events = FrameEvents(callbacks)
+            dispatch = self.__frame_events.instrument(vm, dispatch)
+        else:
+            # Start from the current stack again the next time somebody subscribes
+            self.__frame_events = None
+
+        self.__dispatch.update(dispatch)
+
+    def __wrap_instruction(self, opmethod, handler):
+        vm = self.__vm
+        before = self.__before_instruction
+
+        if takes_argument(opmethod):
+            def hooked(oparg):
+                exec_frame = vm.exec_frame
+                before(exec_frame, exec_frame.ip - 3, opmethod, oparg)
+                return handler(oparg)
+        else:
+            def hooked():
+                exec_frame = vm.exec_frame
+                before(exec_frame, exec_frame.ip - 1, opmethod, None)
+                return handler()
+
+        return hooked
+
+    def __before_instruction(self, exec_frame, offset, opmethod, oparg):
+        callbacks = self.__callbacks
+
+        # A frame entered from inside a handler, like a resumed generator, runs before the handler returns
+        # and the call event fires. Fire it first.
+        if self.__frame_events is not None:
+            self.__frame_events.follow()
+
+        if callbacks[LINE]:
+            lineno = self.__line_tracker.step(exec_frame, offset)
+            if lineno is not None:
+                for callback in callbacks[LINE]:
+                    callback(exec_frame, lineno)
+
+        for callback in callbacks[INSTRUCTION]:
+            callback(exec_frame, offset, opmethod, oparg)
+
+    def __wrap_exception(self, opmethod, handler):
+        vm = self.__vm
+        raised = self.__raised
+
+        if takes_argument(opmethod):
+            def hooked(oparg):
+                exec_frame = vm.exec_frame
+                offset = exec_frame.ip - 3
+                try:
+                    return handler(oparg)
+                except BaseException as e:
+                    raised(exec_frame, offset, e)
+                    raise
+        else:
+            def hooked():
+                exec_frame = vm.exec_frame
+                offset = exec_frame.ip - 1
+                try:
+                    return handler()
+                except BaseException as e:
+                    raised(exec_frame, offset, e)
+                    raise
+
+        return hooked
+
+    def __raised(self, exec_frame, offset, exception):
+        # Handlers that run guest code, like calls resuming a generator, see the exception again on its way out
+        if exception is self.__exception:
+            return
+        self.__exception = exception
+
+        for callback in self.__callbacks[EXCEPTION]:
+            callback(exec_frame, offset, exception)
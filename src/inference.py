@@ -0,0 +1,396 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Static type inference. A dataflow pass over the decoded instructions of a code object works out, before it
+# runs, which values on the stack and in the locals are always an int, a float, a str or a bool, and how deep
+# the value stack gets. Arithmetic and comparisons whose operands are proven to be of those types get a typed
+# handler (see SPECIALIZED_OPMETHODS in src.code_cache) that applies the host operator straight to the stack.
+#
+# In module code the names only the module itself assigns are tracked like locals. Parameters, globals,
+# attributes and call results are of any type. Code using try, with or break is left alone, the VM doesn't
+# run those yet.
+
+import sys
+
+from opcode import opmap, hasjrel, hasjabs
+
+from src.code_cache import code_objects, decode_instructions
+from src.profiler import function_label
+
+# A value of any type, and a local nothing was stored into yet on some path
+ANY = None
+UNDEFINED = object()
+
+TRACKED_TYPES = (int, float, str, bool)
+
+# Typed handler and result type for each pair of operand types the handler is exact for. The VM's % converts
+# the right operand to the type of the left one, the host % agrees only where that changes nothing.
+NUMBER_RESULTS = {(int, int): int, (int, float): float, (float, int): float, (float, float): float}
+TYPED_BINARY_OPS = {
+    "ADD": ("execute_BINARY_ADD_TYPED", dict(list(NUMBER_RESULTS.items()) + [((str, str), str)])),
+    "SUBTRACT": ("execute_BINARY_SUBTRACT_TYPED", NUMBER_RESULTS),
+    "MULTIPLY": ("execute_BINARY_MULTIPLY_TYPED",
+                 dict(list(NUMBER_RESULTS.items()) + [((str, int), str), ((int, str), str)])),
+    "TRUE_DIVIDE": ("execute_BINARY_TRUE_DIVIDE_TYPED", dict((types, float) for types in NUMBER_RESULTS)),
+    "FLOOR_DIVIDE": ("execute_BINARY_FLOOR_DIVIDE_TYPED", NUMBER_RESULTS),
+    "MODULO": ("execute_BINARY_MODULO_TYPED", {(int, int): int, (float, int): float, (float, float): float}),
+    # No typed handler, the result type still helps the instructions after them
+    "LSHIFT": (None, {(int, int): int}),
+    "RSHIFT": (None, {(int, int): int}),
+    "AND": (None, {(int, int): int, (bool, bool): bool}),
+    "OR": (None, {(int, int): int, (bool, bool): bool}),
+    "XOR": (None, {(int, int): int, (bool, bool): bool}),
+}
+
+# <, <=, ==, !=, > and >= between these always give a bool, in, not in, is and is not give one for anything
+ORDERED_COMPARE_OPS = range(6)
+BOOL_COMPARE_OPS = range(6, 10)
+
+# How many values these pop, each pushes a value of any type if its stack effect says so
+POPS = {
+    "LOAD_NAME": 0, "LOAD_GLOBAL": 0, "LOAD_DEREF": 0, "LOAD_CLOSURE": 0, "LOAD_BUILD_CLASS": 0,
+    "STORE_NAME": 1, "STORE_GLOBAL": 1, "STORE_DEREF": 1, "STORE_ATTR": 2, "STORE_SUBSCR": 3,
+    "DELETE_SUBSCR": 2, "PRINT_EXPR": 1,
+}
+
+# The VM doesn't implement these, code using them isn't analyzed
+UNSUPPORTED_OPS = frozenset(["SETUP_EXCEPT", "SETUP_FINALLY", "SETUP_WITH", "BREAK_LOOP", "CONTINUE_LOOP",
+                             "IMPORT_STAR"])
+TERMINATORS = frozenset(["RETURN_VALUE", "JUMP_ABSOLUTE", "JUMP_FORWARD", "RAISE_VARARGS"])
+
+class Unanalyzable(Exception):
+    pass
+
+def type_name(value_type):
+    if value_type is ANY or value_type is UNDEFINED:
+        return "?"
+    return value_type.__name__
+
+def join(a, b):
+    if a is UNDEFINED:
+        return b
+    if b is UNDEFINED or a is b:
+        return a
+    return ANY
+
+def join_states(a, b):
+    """
+    Returns the state holding what is certain after either a or b, raises when the stacks don't line up.
+    """
+    if len(a[0]) != len(b[0]):
+        raise Unanalyzable("Stack depths %d and %d meet" % (len(a[0]), len(b[0])))
+
+    stack = tuple(join(x, y) for x, y in zip(a[0], b[0]))
+    local_types = tuple(join(x, y) for x, y in zip(a[1], b[1]))
+    return stack, local_types
+
+def const_type(value):
+    return type(value) if type(value) in TRACKED_TYPES else ANY
+
+def module_names(code):
+    """
+    Names module code can track: ones it assigns itself that no function or class anywhere in it assigns too,
+    and that nothing deletes.
+    """
+    stored = set()
+    shared = set()
+    for nested in code_objects(code):
+        for instruction in decode_instructions(nested):
+            if instruction is None:
+                continue
+            opmethod, oparg, size = instruction
+            if opmethod == "execute_STORE_NAME" and nested is code:
+                stored.add(code.co_names[oparg])
+            elif opmethod in ("execute_STORE_GLOBAL", "execute_DELETE_GLOBAL", "execute_STORE_NAME",
+                              "execute_DELETE_NAME"):
+                shared.add(nested.co_names[oparg])
+
+    return sorted(stored - shared)
+
+class TypeInfo:
+    """
+    What the analysis found out about one code object: the inferred type of every local, the deepest the value
+    stack gets and the typed handler to run at each offset. Never mutated after construction.
+    """
+    __slots__ = ("__code", "__local_names", "__local_types", "__max_stack_depth", "__specializations",
+                 "__error")
+
+    def __init__(self, code, local_names, local_types, max_stack_depth, specializations, error=None):
+        self.__code = code
+        self.__local_names = local_names
+        self.__local_types = local_types
+        self.__max_stack_depth = max_stack_depth
+        self.__specializations = specializations
+        self.__error = error
+
+    @property
+    def code(self):
+        return self.__code
+
+    @property
+    def local_types(self):
+        """
+        The type every local is known to have, ANY if it may hold different types. Locals never assigned
+        are left out.
+        """
+        return dict((name, value_type) for name, value_type in zip(self.__local_names, self.__local_types)
+                    if value_type is not UNDEFINED)
+
+    @property
+    def max_stack_depth(self):
+        return self.__max_stack_depth
+
+    @property
+    def specializations(self):
+        """
+        Maps the offset of every instruction with a typed handler to the handler's opmethod.
+        """
+        return self.__specializations
+
+    @property
+    def error(self):
+        """
+        Why the code wasn't analyzed, None if it was.
+        """
+        return self.__error
+
+class Inference:
+    """
+    Runs the dataflow pass over one code object. A state is the types on the value stack and the types of the
+    tracked locals, the pass keeps the state at the start of each instruction and joins the states of every
+    path reaching it until nothing changes.
+    """
+    def __init__(self, code, names=()):
+        self.__code = code
+        self.__instructions = decode_instructions(code)
+
+        # Tracked locals: the fast locals in functions, the names given in module code
+        if names:
+            self.__local_names = tuple(names)
+            self.__name_index = dict((name, i) for i, name in enumerate(names))
+        else:
+            self.__local_names = code.co_varnames
+            self.__name_index = {}
+
+        self.__states = {}
+        self.__max_stack_depth = 0
+        self.__specializations = {}
+
+    def run(self):
+        for instruction in self.__instructions:
+            if instruction is not None and instruction[0][len("execute_"):] in UNSUPPORTED_OPS:
+                raise Unanalyzable("Uses %s" % instruction[0][len("execute_"):])
+
+        # Parameters can be anything, every other local starts out unassigned
+        num_params = self.__code.co_argcount + self.__code.co_kwonlyargcount
+        if self.__code.co_flags & 0x04:
+            num_params += 1
+        if self.__code.co_flags & 0x08:
+            num_params += 1
+        local_types = tuple(ANY if i < num_params and not self.__name_index else UNDEFINED
+                            for i in range(len(self.__local_names)))
+
+        self.__states = {0: ((), local_types)}
+        pending = [0]
+        while pending:
+            ip = pending.pop()
+            for target, state in self.__step(ip, self.__states[ip]):
+                if target >= len(self.__instructions) or self.__instructions[target] is None:
+                    raise Unanalyzable("Jump to %d is not an instruction" % target)
+
+                old_state = self.__states.get(target)
+                new_state = state if old_state is None else join_states(old_state, state)
+                if new_state != old_state:
+                    self.__states[target] = new_state
+                    pending.append(target)
+
+        # The state at every instruction is final now, pick the typed handlers
+        for ip, (stack, local_types) in self.__states.items():
+            self.__max_stack_depth = max(self.__max_stack_depth, len(stack))
+            opmethod, oparg, size = self.__instructions[ip]
+            typed = self.__typed_handler(opmethod[len("execute_"):], oparg, stack)
+            if typed is not None:
+                self.__specializations[ip] = typed
+
+    def type_info(self):
+        local_types = [UNDEFINED] * len(self.__local_names)
+        for stack, state_locals in self.__states.values():
+            local_types = [join(a, b) for a, b in zip(local_types, state_locals)]
+
+        return TypeInfo(self.__code, self.__local_names, tuple(local_types), self.__max_stack_depth,
+                        self.__specializations)
+
+    def __typed_handler(self, op, oparg, stack):
+        if op.startswith("BINARY_") or op.startswith("INPLACE_"):
+            typed = TYPED_BINARY_OPS.get(op.split("_", 1)[1])
+            if typed is not None and typed[0] is not None and (stack[-2], stack[-1]) in typed[1]:
+                return typed[0]
+        elif op == "COMPARE_OP" and oparg in ORDERED_COMPARE_OPS:
+            if stack[-2] in TRACKED_TYPES and stack[-1] in TRACKED_TYPES:
+                return "execute_COMPARE_OP_TYPED"
+        return None
+
+    def __step(self, ip, state):
+        """
+        Returns (offset, state) for every instruction the one at ip can go to next.
+        """
+        stack, local_types = state
+        stack = list(stack)
+        opmethod, oparg, size = self.__instructions[ip]
+        op = opmethod[len("execute_"):]
+        following = ip + size
+
+        if op == "LOAD_CONST":
+            stack.append(const_type(self.__code.co_consts[oparg]))
+        elif op == "LOAD_FAST" or (op == "LOAD_NAME" and self.__code.co_names[oparg] in self.__name_index):
+            index = oparg if op == "LOAD_FAST" else self.__name_index[self.__code.co_names[oparg]]
+            value_type = local_types[index]
+            # Loading an unassigned local fails, or in module code finds a builtin
+            stack.append(ANY if value_type is UNDEFINED else value_type)
+        elif op == "STORE_FAST" or (op == "STORE_NAME" and self.__code.co_names[oparg] in self.__name_index):
+            index = oparg if op == "STORE_FAST" else self.__name_index[self.__code.co_names[oparg]]
+            local_types = local_types[:index] + (stack.pop(),) + local_types[index + 1:]
+        elif op == "DELETE_FAST":
+            local_types = local_types[:oparg] + (UNDEFINED,) + local_types[oparg + 1:]
+        elif op.startswith("BINARY_") or op.startswith("INPLACE_"):
+            right = stack.pop()
+            left = stack.pop()
+            typed = TYPED_BINARY_OPS.get(op.split("_", 1)[1])
+            stack.append(typed[1].get((left, right), ANY) if typed is not None else ANY)
+        elif op == "UNARY_NOT":
+            stack[-1] = bool
+        elif op in ("UNARY_POSITIVE", "UNARY_NEGATIVE"):
+            stack[-1] = stack[-1] if stack[-1] in (int, float) else ANY
+        elif op == "UNARY_INVERT":
+            stack[-1] = int if stack[-1] is int else ANY
+        elif op == "COMPARE_OP":
+            right = stack.pop()
+            left = stack.pop()
+            if oparg in BOOL_COMPARE_OPS or (oparg in ORDERED_COMPARE_OPS and left in TRACKED_TYPES and
+                                             right in TRACKED_TYPES):
+                stack.append(bool)
+            else:
+                stack.append(ANY)
+        elif op == "POP_TOP":
+            stack.pop()
+        elif op == "DUP_TOP":
+            stack.append(stack[-1])
+        elif op == "DUP_TOP_TWO":
+            stack.extend(stack[-2:])
+        elif op == "ROT_TWO":
+            stack[-2:] = [stack[-1], stack[-2]]
+        elif op == "ROT_THREE":
+            stack[-3:] = [stack[-1], stack[-3], stack[-2]]
+        elif op in ("POP_JUMP_IF_TRUE", "POP_JUMP_IF_FALSE"):
+            stack.pop()
+            state = (tuple(stack), local_types)
+            return [(oparg, state), (following, state)]
+        elif op in ("JUMP_IF_TRUE_OR_POP", "JUMP_IF_FALSE_OR_POP"):
+            jumped = (tuple(stack), local_types)
+            stack.pop()
+            return [(oparg, jumped), (following, (tuple(stack), local_types))]
+        elif op == "FOR_ITER":
+            exhausted = (tuple(stack[:-1]), local_types)
+            stack.append(ANY)
+            return [(following + oparg, exhausted), (following, (tuple(stack), local_types))]
+        elif op in ("JUMP_ABSOLUTE", "JUMP_FORWARD", "SETUP_LOOP", "POP_BLOCK", "NOP", "RETURN_VALUE",
+                    "RAISE_VARARGS", "GET_ITER", "LOAD_ATTR", "YIELD_VALUE"):
+            if op in ("GET_ITER", "LOAD_ATTR", "YIELD_VALUE"):
+                stack[-1] = ANY
+            elif op == "RETURN_VALUE":
+                stack.pop()
+            elif op == "RAISE_VARARGS":
+                del stack[len(stack) - oparg:]
+        else:
+            # dis is slow to import, keep it off the startup path of VMs that never specialize
+            import dis
+            try:
+                effect = dis.stack_effect(opmap[op], oparg)
+            except ValueError:
+                raise Unanalyzable("No stack effect for %s" % op)
+
+            if op in ("CALL_FUNCTION", "BUILD_TUPLE", "BUILD_LIST", "BUILD_SET") or op in POPS:
+                if op == "CALL_FUNCTION":
+                    pops = (oparg & 0xFF) + 2 * (oparg >> 8) + 1
+                elif op in POPS:
+                    pops = POPS[op]
+                else:
+                    pops = oparg
+                if pops > len(stack):
+                    raise Unanalyzable("Stack underflow at %d" % ip)
+                del stack[len(stack) - pops:]
+                stack.extend([ANY] * (pops + effect))
+            else:
+                # Only the net effect is known, nothing left on the stack is of a known type anymore
+                depth = len(stack) + effect
+                if depth < 0:
+                    raise Unanalyzable("Stack underflow at %d" % ip)
+                stack = [ANY] * depth
+
+        self.__max_stack_depth = max(self.__max_stack_depth, len(stack))
+        state = (tuple(stack), local_types)
+
+        successors = []
+        if opmap[op] in hasjrel:
+            successors.append((following + oparg, state))
+        elif opmap[op] in hasjabs:
+            successors.append((oparg, state))
+        if op not in TERMINATORS:
+            successors.append((following, state))
+        return successors
+
+def infer_types(code, module=False):
+    """
+    Returns the TypeInfo of code. module says code is the module code run by the VM, not a function or class
+    body. Code that can't be analyzed gets a TypeInfo without types or typed handlers saying why.
+    """
+    inference = Inference(code, module_names(code) if module else ())
+    try:
+        inference.run()
+    except Unanalyzable as e:
+        return TypeInfo(code, (), (), code.co_stacksize, {}, str(e))
+    except IndexError:
+        return TypeInfo(code, (), (), code.co_stacksize, {}, "Stack underflow")
+
+    return inference.type_info()
+
+def report(code, file=None):
+    """
+    Prints the inferred types of the locals of every code object in the module, with the stack depth the
+    analysis found next to the one the compiler recorded.
+    """
+    if file is None:
+        file = sys.stdout
+
+    file.write("%-56s %6s %6s %6s  %s\n" % ("Name", "Stack", "Max", "Typed", "Locals"))
+    for nested in code_objects(code):
+        info = infer_types(nested, nested is code)
+        if info.error is not None:
+            details = "not analyzed: %s" % info.error
+        else:
+            details = ", ".join("%s: %s" % (name, type_name(value_type))
+                                for name, value_type in sorted(info.local_types.items()))
+
+        file.write("%-56s %6d %6d %6d  %s\n" % (function_label(nested), info.max_stack_depth, nested.co_stacksize,
+                                              len(info.specializations), details))
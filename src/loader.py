@@ -0,0 +1,72 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+def format_source_lines(source_lines):
+    new_source_lines = []
+    for line in source_lines:
+        line = line.replace("\n", "")
+        new_source_lines.append(line)
+
+    return new_source_lines
+
+def read_source(filename):
+    fptr = open(filename, "r")
+    source = fptr.read()
+    fptr.close()
+    return source
+
+class ScriptCompiler:
+    """
+    Compiles guest scripts, caching the code objects so a long running VM only pays for compile() the first
+    time it sees a script. Only the latest source of each filename is kept, an edited script replaces its stale
+    entry. With optimize the cached code has been through the peephole optimizer.
+    """
+    def __init__(self, optimize=False):
+        # filename -> (source, (code, source lines))
+        self.__compiled = {}
+        self.__optimize = optimize
+
+    def compile_source(self, source, filename="<string>"):
+        entry = self.__compiled.get(filename)
+        if entry is not None and entry[0] == source:
+            return entry[1]
+
+        code = compile(source, filename, "exec")
+        if self.__optimize:
+            from src.optimizer import optimize
+            code = optimize(code)
+        source_lines = format_source_lines(source.splitlines())
+        compiled = (code, source_lines)
+        self.__compiled[filename] = (source, compiled)
+
+        return compiled
+
+    def compile_file(self, filename):
+        return self.compile_source(read_source(filename), filename)
+
+    def clear(self):
+        self.__compiled = {}
+
+    def __len__(self):
+        return len(self.__compiled)
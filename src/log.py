@@ -25,4 +25,11 @@ THE SOFTWARE.
 def draw_header(txt):
     print("-" * 100)
     print(" " * 40 + txt + " " * 40)
-    print("-" * 100)
\ No newline at end of file
+    print("-" * 100)
+
+def draw_disassembly(txt, code):
+    # dis is only needed when disassembly is requested, so keep it off the startup path
+    import dis
+
+    draw_header(txt)
+    dis.dis(code)
\ No newline at end of file
@@ -22,56 +22,216 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-import dis
+import argparse
 import sys
 
 from src.vm import BytecodeVM
 from src.vmconfig import VMConfig
-from src.log import draw_header
-from src.debugger import Debugger
-
-def configure_vm():
+from src.log import draw_header, draw_disassembly
+from src.loader import format_source_lines
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="PyVyM - A simple Python Virtual Machine")
+    parser.add_argument("filenames", nargs="+", metavar="filename",
+                        help="Python source file to execute. With --batch, any number of files, directories or globs")
+    parser.add_argument("-q", "--headless", action="store_true",
+                        help="Don't print the source or the disassembly before executing")
+    parser.add_argument("--show-line-execution", action="store_true",
+                        help="Print every source line as it gets executed")
+    parser.add_argument("-d", "--debugger", action="store_true",
+                        help="Run the program under the interactive debugger")
+    parser.add_argument("--profile-opcodes", action="store_true",
+                        help="Count and time every executed instruction and print the table at exit")
+    parser.add_argument("--profile-lines", action="store_true",
+                        help="Time every source line and print an annotated listing at exit")
+    parser.add_argument("--profile-calls", action="store_true",
+                        help="Time every guest function call and print the call profile at exit")
+    parser.add_argument("--collapsed-stacks", metavar="FILE",
+                        help="Profile calls and write the stacks in collapsed format for flamegraph.pl")
+    parser.add_argument("--pstats", metavar="FILE",
+                        help="Profile calls and write a pstats compatible dump")
+    parser.add_argument("--sample", metavar="FILE",
+                        help="Profile by sampling the guest stack and write collapsed stacks for flamegraph.pl")
+    parser.add_argument("--sample-interval", type=float, default=0.005,
+                        help="Seconds between samples for --sample")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="Record every executed instruction into a binary ring buffer mapped from FILE. "
+                             "Decode it with python -m src.trace FILE")
+    parser.add_argument("--trace-capacity", type=int, default=1 << 20,
+                        help="Number of most recent instructions --trace keeps")
+    parser.add_argument("--coverage", action="store_true",
+                        help="Report the executed and missed lines of every function at exit")
+    parser.add_argument("--chrome-trace", metavar="FILE",
+                        help="Write a Chrome trace-event timeline of guest calls, class builds and VM phases to FILE")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="Fold constants, thread jumps and drop dead code before executing")
+    parser.add_argument("--specialize", action="store_true",
+                        help="Run typed handlers where static type inference proved the operand types")
+    parser.add_argument("--type-report", action="store_true",
+                        help="Print the inferred types of the locals and the stack depth of every function")
+    parser.add_argument("-b", "--batch", action="store_true",
+                        help="Run every matching script on a process pool and stream JSON lines results")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Number of worker processes for --batch. Defaults to the number of CPUs")
+    args = parser.parse_args(argv)
+
+    if not args.batch and len(args.filenames) > 1:
+        parser.error("only one filename can be executed at a time, use --batch for more")
+
+    if args.batch:
+        # The tools report on a single run, the batch workers only honour the VMConfig flags
+        single_run = [("--debugger", args.debugger), ("--profile-opcodes", args.profile_opcodes),
+                      ("--profile-lines", args.profile_lines), ("--profile-calls", args.profile_calls),
+                      ("--collapsed-stacks", args.collapsed_stacks), ("--pstats", args.pstats),
+                      ("--sample", args.sample), ("--trace", args.trace), ("--coverage", args.coverage),
+                      ("--chrome-trace", args.chrome_trace), ("--type-report", args.type_report)]
+        given = [flag for flag, value in single_run if value]
+        if given:
+            parser.error("%s can't be used with --batch" % ", ".join(given))
+
+    return args
+
+def configure_vm(args):
     config = VMConfig()
+    config.show_source = not args.headless
+    config.show_disassembly = not args.headless
+    config.show_line_execution = args.show_line_execution
+    config.optimize = args.optimize
+    config.specialize = args.specialize
     return config
 
-def format_source_lines(source_lines):
-    new_source_lines = []
-    for line in source_lines:
-        line = line.replace("\n", "")
-        new_source_lines.append(line)
-
-    return new_source_lines
-
 def display_source(source_lines):
     for i, line in enumerate(source_lines):
         print("%s\t\t%s" % (i+1, line))
 
-def main():
-    filename = sys.argv[1]
+def main(argv=None):
+    args = parse_args(argv)
+
+    config = configure_vm(args)
+
+    if args.batch:
+        # Batch mode is always headless, results go out as JSON lines
+        from src.batch import expand_scripts, run_batch
+
+        config.show_source = False
+        config.show_disassembly = False
+        failures = run_batch(expand_scripts(args.filenames), args.jobs, config=config)
+        sys.exit(1 if failures else 0)
+
+    filename = args.filenames[0]
     fptr = open(filename, "r")
     source = fptr.read()
     fptr.seek(0)
     source_lines = format_source_lines(fptr.readlines())
     fptr.close()
 
-    draw_header("Source")
-    display_source(source_lines)
-    code = compile(source, filename, "exec")
-
-    vm = BytecodeVM(code, source_lines, filename)
-
-    WITH_DEBUGGER = False
-
-    if not WITH_DEBUGGER:
-        draw_header("Disassembly")
-        dis.dis(code)
-        #  Configure the VM and set the settings based on command line. For now use defaults
-        config = configure_vm()
-        config.show_disassembly = True
+    if config.show_source:
+        draw_header("Source")
+        display_source(source_lines)
+    timeline = None
+    if args.chrome_trace and not args.debugger:
+        from src.chrome_trace import ChromeTracer
+        timeline = ChromeTracer()
+
+    if config.optimize:
+        from src.optimizer import optimize
+
+    if timeline is None:
+        code = compile(source, filename, "exec")
+        if config.optimize:
+            code = optimize(code)
+    else:
+        with timeline.phase("compile", filename=filename):
+            code = compile(source, filename, "exec")
+            if config.optimize:
+                code = optimize(code)
+
+    if args.type_report:
+        from src.inference import report
+        draw_header("Type Inference")
+        report(code)
+
+    if not args.debugger:
+        vm = BytecodeVM(code, source_lines, filename)
+        if config.show_disassembly:
+            draw_disassembly("Disassembly", code)
         vm.config = config
-        vm.execute()
+        if args.profile_opcodes:
+            from src.profiler import OpcodeProfiler
+            vm.opcode_profiler = OpcodeProfiler()
+        if args.profile_lines:
+            from src.profiler import LineProfiler
+            vm.line_profiler = LineProfiler()
+        if args.profile_calls or args.collapsed_stacks or args.pstats:
+            from src.profiler import CallProfiler
+            vm.call_profiler = CallProfiler()
+
+        if args.trace:
+            from src.trace import ExecutionTracer
+            vm.tracer = ExecutionTracer(args.trace_capacity, args.trace)
+        if timeline is not None:
+            vm.timeline = timeline
+
+        coverage = None
+        if args.coverage:
+            from src.coverage import Coverage
+            coverage = Coverage(vm)
+            coverage.start()
+
+        sampler = None
+        if args.sample:
+            from src.profiler import SamplingProfiler
+            sampler = SamplingProfiler(vm, args.sample_interval)
+            sampler.start()
+
+        if timeline is None:
+            return_val = vm.execute()
+        else:
+            with timeline.phase("execute", filename=filename):
+                return_val = vm.execute()
+        if sampler is not None:
+            sampler.stop()
+        if coverage is not None:
+            coverage.stop()
+
+        print("Program Terminated:")
+        print("Program Return Value: %s" % return_val)
+
+        if vm.opcode_profiler is not None:
+            draw_header("Opcode Profile")
+            vm.opcode_profiler.report()
+        if vm.line_profiler is not None:
+            draw_header("Line Profile")
+            vm.line_profiler.report()
+        if vm.call_profiler is not None:
+            if args.profile_calls:
+                draw_header("Call Profile")
+                vm.call_profiler.report()
+            if args.collapsed_stacks:
+                with open(args.collapsed_stacks, "w") as f:
+                    vm.call_profiler.write_collapsed(f)
+            if args.pstats:
+                vm.call_profiler.dump_stats(args.pstats)
+        if vm.tracer is not None:
+            vm.tracer.close()
+            print("Traced %s instructions to %s" % (vm.tracer.count, args.trace))
+        if sampler is not None:
+            draw_header("Sampling Profile")
+            sampler.report()
+            with open(args.sample, "w") as f:
+                sampler.write_collapsed(f)
+        if coverage is not None:
+            draw_header("Coverage")
+            coverage.report()
+        if timeline is not None:
+            timeline.save(args.chrome_trace)
+            print("Wrote %s trace events to %s" % (len(timeline.events), args.chrome_trace))
+        sys.exit(return_val)
     else:
-        debugger = Debugger(code, source_lines, filename)
+        # The debugger pulls in the interactive machinery, only load it when asked for
+        from src.debugger import Debugger
+
+        debugger = Debugger(code, source_lines, filename, config)
         debugger.execute(False)
 
 if __name__ == "__main__":
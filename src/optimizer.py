@@ -0,0 +1,415 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Peephole optimizer. Rewrites a code object, and every code object nested in its constants, before the VM
+# runs it:
+#
+#   LOAD_CONST a, LOAD_CONST b, BINARY_x       -> LOAD_CONST (a x b)
+#   LOAD_CONST a, UNARY_x                      -> LOAD_CONST (x a)
+#   LOAD_CONST a, ..., BUILD_TUPLE n           -> LOAD_CONST (a, ...)
+#   LOAD_CONST a, POP_TOP                      -> nothing
+#   jump to an unconditional jump              -> jump to where that one goes
+#   unconditional jump to the next instruction -> nothing
+#   instructions no path reaches, like the ones after a return
+#
+# The result is a new code object with the instructions laid out again, the jumps pointing to their new
+# offsets and co_lnotab rebuilt, so line numbers, breakpoints and profilers keep working on it. Folding
+# evaluates with the VM's own operators and gives up on anything that raises or would make a large constant,
+# those stay for run time.
+
+import operator
+import types
+
+from opcode import opname, opmap, hasjrel, hasjabs, HAVE_ARGUMENT, EXTENDED_ARG
+
+from src.code_cache import build_line_table
+from src.vm import BINARY_OPERATORS, UNARY_OPERATORS
+
+# Folding goes through the VM's own operator tables so a folded constant is exactly what executing the
+# instructions would have produced
+BINARY_OPS = {
+    "BINARY_POWER": BINARY_OPERATORS["**"],
+    "BINARY_MULTIPLY": BINARY_OPERATORS["*"],
+    "BINARY_FLOOR_DIVIDE": BINARY_OPERATORS["//"],
+    "BINARY_TRUE_DIVIDE": BINARY_OPERATORS["/"],
+    "BINARY_MODULO": BINARY_OPERATORS["%"],
+    "BINARY_ADD": BINARY_OPERATORS["+"],
+    "BINARY_SUBTRACT": BINARY_OPERATORS["-"],
+    "BINARY_SUBSCR": operator.getitem,
+    "BINARY_LSHIFT": BINARY_OPERATORS["<<"],
+    "BINARY_RSHIFT": BINARY_OPERATORS[">>"],
+    "BINARY_AND": BINARY_OPERATORS["&"],
+    "BINARY_XOR": BINARY_OPERATORS["^"],
+    "BINARY_OR": BINARY_OPERATORS["|"],
+}
+
+UNARY_OPS = {
+    "UNARY_POSITIVE": UNARY_OPERATORS["+"],
+    "UNARY_NEGATIVE": UNARY_OPERATORS["-"],
+    "UNARY_NOT": UNARY_OPERATORS["!"],
+    "UNARY_INVERT": UNARY_OPERATORS["~"],
+}
+
+# Constants worth folding, and the longest string, bytes or tuple folding may create
+FOLDABLE_TYPES = (int, float, complex, str, bytes, bool, tuple)
+MAX_FOLDED_LENGTH = 20
+MAX_FOLDED_BITS = 128
+
+# Execution never falls through these to the next instruction
+TERMINATORS = frozenset(["RETURN_VALUE", "JUMP_ABSOLUTE", "JUMP_FORWARD", "RAISE_VARARGS", "BREAK_LOOP",
+                         "CONTINUE_LOOP"])
+UNCONDITIONAL_JUMPS = frozenset(["JUMP_ABSOLUTE", "JUMP_FORWARD"])
+# Jumps that may go straight to the end of a chain of unconditional jumps. Loop and block setup is left alone,
+# the VM keys its blocks on those
+THREADABLE_JUMPS = frozenset(["JUMP_ABSOLUTE", "JUMP_FORWARD", "POP_JUMP_IF_TRUE", "POP_JUMP_IF_FALSE",
+                              "JUMP_IF_TRUE_OR_POP", "JUMP_IF_FALSE_OR_POP"])
+
+class Instruction:
+    """
+    One instruction of the code being optimized. Jumps refer to the instruction they go to, offsets are only
+    worked out again when the code is assembled.
+    """
+    __slots__ = ("name", "arg", "line", "target", "offset")
+
+    def __init__(self, name, arg, line):
+        self.name = name
+        self.arg = arg
+        self.line = line
+        self.target = None
+        self.offset = None
+
+    @property
+    def size(self):
+        return 3 if opmap[self.name] >= HAVE_ARGUMENT else 1
+
+def disassemble(code):
+    """
+    Returns the instructions of code with their jump targets resolved, None for code this optimizer doesn't
+    handle.
+    """
+    program = code.co_code
+    lines = build_line_table(code)
+    by_offset = {}
+    instructions = []
+
+    ip = 0
+    while ip < len(program):
+        op = program[ip]
+        if op == EXTENDED_ARG:
+            return None
+
+        arg = None
+        size = 1
+        if op >= HAVE_ARGUMENT:
+            arg = program[ip + 1] | (program[ip + 2] << 8)
+            size = 3
+
+        instruction = Instruction(opname[op], arg, lines[ip])
+        instruction.offset = ip
+        by_offset[ip] = instruction
+        instructions.append(instruction)
+        ip += size
+
+    for instruction in instructions:
+        op = opmap[instruction.name]
+        if op in hasjrel:
+            instruction.target = by_offset.get(instruction.offset + 3 + instruction.arg)
+        elif op in hasjabs:
+            instruction.target = by_offset.get(instruction.arg)
+        else:
+            continue
+
+        if instruction.target is None:
+            # Jumps past the end or into the middle of an instruction, leave the code as it is
+            return None
+
+    return instructions
+
+def add_const(consts, value):
+    # 1, 1.0 and True are equal but distinct constants, only reuse entries of the very same type
+    if type(value) in (int, str, bytes, bool):
+        for index, const in enumerate(consts):
+            if type(const) is type(value) and const == value:
+                return index
+
+    consts.append(value)
+    return len(consts) - 1
+
+def small_enough(value):
+    if isinstance(value, (str, bytes, tuple)):
+        return len(value) <= MAX_FOLDED_LENGTH
+    elif isinstance(value, int):
+        return value.bit_length() <= MAX_FOLDED_BITS
+    return True
+
+def fold_binary(name, left, right):
+    """
+    Returns (True, value) when name folds over the two constants, (False, None) when it has to wait until
+    run time.
+    """
+    if not isinstance(left, FOLDABLE_TYPES) or not isinstance(right, FOLDABLE_TYPES):
+        return False, None
+
+    # Don't evaluate something that ends up huge or takes long just to throw it away
+    if name == "BINARY_POWER" and isinstance(right, int) and not 0 <= right <= MAX_FOLDED_BITS:
+        return False, None
+    if name == "BINARY_LSHIFT" and isinstance(right, int) and not 0 <= right <= MAX_FOLDED_BITS:
+        return False, None
+    if name == "BINARY_MULTIPLY":
+        for sequence, count in ((left, right), (right, left)):
+            if isinstance(sequence, (str, bytes, tuple)) and isinstance(count, int) and \
+                    len(sequence) * count > MAX_FOLDED_LENGTH:
+                return False, None
+
+    try:
+        value = BINARY_OPS[name](left, right)
+    except Exception:
+        return False, None
+
+    return small_enough(value), value
+
+def fold_unary(name, operand):
+    if not isinstance(operand, FOLDABLE_TYPES):
+        return False, None
+
+    try:
+        value = UNARY_OPS[name](operand)
+    except Exception:
+        return False, None
+
+    return small_enough(value), value
+
+def jump_targets(instructions):
+    return set(id(instruction.target) for instruction in instructions if instruction.target is not None)
+
+def delete(instructions, start, count):
+    """
+    Removes count instructions from start, jumps that went to them go to the instruction after instead.
+    """
+    removed = set(id(instruction) for instruction in instructions[start:start + count])
+    following = instructions[start + count] if start + count < len(instructions) else None
+    del instructions[start:start + count]
+
+    for instruction in instructions:
+        if instruction.target is not None and id(instruction.target) in removed:
+            instruction.target = following
+
+def fold_constants(instructions, consts):
+    changed = False
+    targets = jump_targets(instructions)
+
+    i = 0
+    while i < len(instructions):
+        instruction = instructions[i]
+        if instruction.name != "LOAD_CONST":
+            i += 1
+            continue
+
+        # The longest run of constant loads starting here, none of them after the first jumped to
+        end = i + 1
+        while end < len(instructions) and instructions[end].name == "LOAD_CONST" and \
+                id(instructions[end]) not in targets:
+            end += 1
+        following = instructions[end] if end < len(instructions) else None
+        if following is None or id(following) in targets:
+            i += 1
+            continue
+
+        run = instructions[i:end]
+        folded = False
+        if following.name in BINARY_OPS and len(run) >= 2:
+            first = end - 2
+            folded, value = fold_binary(following.name, consts[run[-2].arg], consts[run[-1].arg])
+        elif following.name in UNARY_OPS:
+            first = end - 1
+            folded, value = fold_unary(following.name, consts[run[-1].arg])
+        elif following.name == "BUILD_TUPLE" and 0 < following.arg <= len(run):
+            first = end - following.arg
+            value = tuple(consts[load.arg] for load in instructions[first:end])
+            folded = True
+
+        if not folded:
+            i += 1
+            continue
+
+        # The first load of the folded ones stays, it may be jumped to
+        instructions[first].arg = add_const(consts, value)
+        delete(instructions, first + 1, end - first)
+        changed = True
+        # Look at the same run again, what it folded into may fold once more
+
+    return changed
+
+def remove_dead_loads(instructions):
+    changed = False
+    targets = jump_targets(instructions)
+
+    i = 0
+    while i + 1 < len(instructions):
+        if instructions[i].name == "LOAD_CONST" and instructions[i + 1].name == "POP_TOP" and \
+                id(instructions[i + 1]) not in targets:
+            delete(instructions, i, 2)
+            targets = jump_targets(instructions)
+            changed = True
+        else:
+            i += 1
+
+    return changed
+
+def thread_jumps(instructions):
+    changed = False
+    for instruction in instructions:
+        if instruction.name not in THREADABLE_JUMPS:
+            continue
+
+        target = instruction.target
+        seen = set()
+        while target.name in UNCONDITIONAL_JUMPS and id(target) not in seen:
+            seen.add(id(target))
+            target = target.target
+
+        if target is not instruction.target and target is not instruction:
+            instruction.target = target
+            changed = True
+
+    # A jump to the very next instruction does nothing
+    i = 0
+    while i + 1 < len(instructions):
+        if instructions[i].name in UNCONDITIONAL_JUMPS and instructions[i].target is instructions[i + 1]:
+            delete(instructions, i, 1)
+            changed = True
+        else:
+            i += 1
+
+    return changed
+
+def remove_unreachable(instructions):
+    index = dict((id(instruction), i) for i, instruction in enumerate(instructions))
+    reachable = set()
+    pending = [0]
+    while pending:
+        i = pending.pop()
+        if i >= len(instructions) or i in reachable:
+            continue
+
+        reachable.add(i)
+        instruction = instructions[i]
+        if instruction.target is not None:
+            pending.append(index[id(instruction.target)])
+        if instruction.name not in TERMINATORS:
+            pending.append(i + 1)
+
+    if len(reachable) == len(instructions):
+        return False
+
+    instructions[:] = [instruction for i, instruction in enumerate(instructions) if i in reachable]
+    return True
+
+def encode_lnotab(first_line, instructions):
+    """
+    Returns co_lnotab for the instructions, None when the lines go backwards, which co_lnotab can't say.
+    """
+    lnotab = bytearray()
+    last_offset = 0
+    last_line = first_line
+    for instruction in instructions:
+        if instruction.line == last_line:
+            continue
+
+        offset_delta = instruction.offset - last_offset
+        line_delta = instruction.line - last_line
+        if line_delta < 0:
+            return None
+
+        while offset_delta > 255:
+            lnotab.extend((255, 0))
+            offset_delta -= 255
+        while line_delta > 255:
+            lnotab.extend((offset_delta, 255))
+            offset_delta = 0
+            line_delta -= 255
+        lnotab.extend((offset_delta, line_delta))
+
+        last_offset = instruction.offset
+        last_line = instruction.line
+
+    return bytes(lnotab)
+
+def assemble(instructions):
+    """
+    Returns co_code for the instructions, None if an argument doesn't fit.
+    """
+    offset = 0
+    for instruction in instructions:
+        instruction.offset = offset
+        offset += instruction.size
+
+    program = bytearray()
+    for instruction in instructions:
+        if instruction.target is not None:
+            if instruction.name == "JUMP_FORWARD" and instruction.target.offset < instruction.offset + 3:
+                # Threading sent it backwards, relative jumps only go forwards
+                instruction.name = "JUMP_ABSOLUTE"
+
+            op = opmap[instruction.name]
+            if op in hasjrel:
+                instruction.arg = instruction.target.offset - (instruction.offset + 3)
+            else:
+                instruction.arg = instruction.target.offset
+
+        program.append(opmap[instruction.name])
+        if instruction.arg is not None:
+            if not 0 <= instruction.arg <= 0xFFFF:
+                return None
+            program.extend((instruction.arg & 0xFF, instruction.arg >> 8))
+
+    return bytes(program)
+
+def replace_code(code, co_code, co_consts, co_lnotab):
+    if hasattr(code, "replace"):
+        return code.replace(co_code=co_code, co_consts=co_consts, co_lnotab=co_lnotab)
+
+    return types.CodeType(code.co_argcount, code.co_kwonlyargcount, code.co_nlocals, code.co_stacksize,
+                          code.co_flags, co_code, co_consts, code.co_names, code.co_varnames, code.co_filename,
+                          code.co_name, code.co_firstlineno, co_lnotab, code.co_freevars, code.co_cellvars)
+
+def optimize(code):
+    """
+    Returns an optimized copy of code and of the code objects nested in it. Code the optimizer can't handle
+    comes back as it was, with only its nested code objects optimized.
+    """
+    consts = [optimize(const) if isinstance(const, types.CodeType) else const for const in code.co_consts]
+
+    instructions = disassemble(code)
+    if instructions is not None:
+        while (fold_constants(instructions, consts) | remove_dead_loads(instructions) |
+               thread_jumps(instructions) | remove_unreachable(instructions)):
+            pass
+
+        co_code = assemble(instructions)
+        co_lnotab = encode_lnotab(code.co_firstlineno, instructions)
+        if co_code is not None and co_lnotab is not None and len(consts) <= 0xFFFF:
+            return replace_code(code, co_code, tuple(consts), co_lnotab)
+
+    return replace_code(code, code.co_code, tuple(consts), code.co_lnotab)
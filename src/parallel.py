@@ -0,0 +1,143 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import marshal
+import multiprocessing
+import pickle
+
+from src.code_cache import code_objects
+from src.vm import BytecodeVM, Function, Generator
+
+def snapshot_globals(globals, func_name):
+    """
+    Makes a picklable copy of a guest module's globals for calling func_name. Guest functions are shipped as
+    marshalled code objects with their defaults, other values go as they are when they pickle. Values that
+    don't pickle (modules, open files...) are left out if nothing func_name calls uses their name, otherwise
+    it's an error rather than a NameError in the workers later on.
+    """
+    used = set()
+    pending = [func_name]
+    while pending:
+        name = pending.pop()
+        if name in used:
+            continue
+        used.add(name)
+
+        value = globals.get(name)
+        if isinstance(value, Function):
+            for code in code_objects(value.code):
+                pending.extend(code.co_names)
+
+    snapshot = {}
+    for name, value in globals.items():
+        if isinstance(value, Function):
+            snapshot[name] = ("function", value.name, marshal.dumps(value.code), list(value.defaults))
+            continue
+
+        try:
+            pickle.dumps(value)
+        except Exception as e:
+            if name in used:
+                raise Exception("Global %s can't be sent to the worker processes: %s: %s" %
+                                (name, type(e).__name__, e))
+            continue
+
+        snapshot[name] = ("value", value)
+
+    return snapshot
+
+def restore_globals(snapshot):
+    globals = {}
+    for name, entry in snapshot.items():
+        if entry[0] == "function":
+            kind, fn_name, code_bytes, defaults = entry
+            globals[name] = Function(fn_name, defaults, marshal.loads(code_bytes))
+        else:
+            globals[name] = entry[1]
+
+    return globals
+
+# Set up once in every pool worker by init_worker
+worker_vm = None
+worker_function = None
+
+def init_worker(snapshot, func_name, source, filename, config):
+    global worker_vm, worker_function
+
+    globals = restore_globals(snapshot)
+    module_code = compile("", filename, "exec")
+    worker_vm = BytecodeVM(module_code, source, filename)
+    worker_vm.config = config
+    worker_vm.reset(module_code, source, filename, globals)
+    worker_function = globals[func_name]
+
+def run_chunk(chunk):
+    results = []
+    for item in chunk:
+        result = worker_vm.call_function(worker_function, [item])
+        if isinstance(result, Generator):
+            # Its suspended frames live in the worker's VM
+            raise Exception("%s returned a generator, which can't be sent back from a worker process" %
+                            worker_function.name)
+        results.append(result)
+
+    return results
+
+def parallel_map(vm, func_name, iterable, processes=None, chunksize=None):
+    """
+    Calls the guest function func_name on every item of iterable across a pool of worker processes, each
+    running its own BytecodeVM with vm's config, and returns the results in input order. Items are sent in
+    chunks to amortize the IPC cost; by default each worker gets about four chunks. The function can't be a
+    generator, its results have to pickle.
+    """
+    globals = vm.module_frame.globals
+    fn = globals.get(func_name)
+    if not isinstance(fn, Function):
+        raise Exception("Guest function %s is not defined" % func_name)
+
+    items = list(iterable)
+    if not items:
+        return []
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    if chunksize is None:
+        chunksize = max(1, len(items) // (processes * 4))
+
+    chunks = [items[i:i + chunksize] for i in range(0, len(items), chunksize)]
+
+    initargs = (snapshot_globals(globals, func_name), func_name, vm.source, vm.filename, vm.config)
+    pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=initargs)
+    try:
+        chunk_results = pool.map(run_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+    results = []
+    for chunk_result in chunk_results:
+        results.extend(chunk_result)
+
+    return results
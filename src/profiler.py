@@ -0,0 +1,719 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import marshal
+import signal
+import sys
+import threading
+import time
+
+from opcode import opmap, HAVE_ARGUMENT
+
+from src.code_cache import generic_opmethod
+from src.debugger_support import LineNo
+
+try:
+    from time import perf_counter_ns
+except ImportError:
+    # Before 3.7
+    def perf_counter_ns():
+        return int(time.perf_counter() * 1000000000)
+
+def takes_argument(opmethod):
+    return opmap.get(generic_opmethod(opmethod)[len("execute_"):], 0) >= HAVE_ARGUMENT
+
+class OpcodeProfiler:
+    """
+    Counts and cumulative time of every executed instruction, kept per (code object, offset) and summed up
+    per opcode for the report. Enable with vm.opcode_profiler = OpcodeProfiler().
+
+    The time of an instruction is the time spent in its handler. Guest calls and returns only switch frames
+    so they don't include the callee, calls to builtins and generator resumption do include the host work.
+    """
+    def __init__(self):
+        self.__sites = {}
+        self.__vm = None
+
+    @property
+    def sites(self):
+        """
+        {(code, offset): [opmethod, count, nanoseconds]}
+        """
+        return self.__sites
+
+    def clear(self):
+        self.__sites.clear()
+
+    def instrument(self, vm, dispatch):
+        """
+        Returns dispatch with every handler wrapped to record into this profiler.
+        """
+        self.__vm = vm
+        return dispatch.instrument(self.__wrap)
+
+    def __wrap(self, opmethod, handler):
+        vm = self.__vm
+        sites = self.__sites
+
+        # The loop has moved ip past the instruction by the time the handler runs
+        if takes_argument(opmethod):
+            def profiled(oparg):
+                exec_frame = vm.exec_frame
+                key = (exec_frame.code, exec_frame.ip - 3)
+                start = perf_counter_ns()
+                terminate = handler(oparg)
+                elapsed = perf_counter_ns() - start
+
+                site = sites.get(key)
+                if site is None:
+                    sites[key] = [opmethod, 1, elapsed]
+                else:
+                    site[1] += 1
+                    site[2] += elapsed
+                return terminate
+        else:
+            def profiled():
+                exec_frame = vm.exec_frame
+                key = (exec_frame.code, exec_frame.ip - 1)
+                start = perf_counter_ns()
+                terminate = handler()
+                elapsed = perf_counter_ns() - start
+
+                site = sites.get(key)
+                if site is None:
+                    sites[key] = [opmethod, 1, elapsed]
+                else:
+                    site[1] += 1
+                    site[2] += elapsed
+                return terminate
+
+        return profiled
+
+    def opcode_totals(self):
+        """
+        Returns [(opname, count, nanoseconds)] sorted by time, most expensive first.
+        """
+        totals = {}
+        for opmethod, count, elapsed in self.__sites.values():
+            total = totals.setdefault(opmethod, [0, 0])
+            total[0] += count
+            total[1] += elapsed
+
+        rows = [(opmethod[len("execute_"):], count, elapsed) for opmethod, (count, elapsed) in totals.items()]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows
+
+    def report(self, file=None, limit=20):
+        """
+        Prints the per opcode table and the limit most expensive instructions.
+        """
+        if file is None:
+            file = sys.stdout
+
+        rows = self.opcode_totals()
+        total_time = sum(row[2] for row in rows) or 1
+
+        file.write("%-24s %12s %12s %10s %7s\n" % ("Opcode", "Count", "Total ms", "Avg ns", "%"))
+        for name, count, elapsed in rows:
+            file.write("%-24s %12d %12.3f %10d %6.2f%%\n" %
+                       (name, count, elapsed / 1000000.0, elapsed // count, 100.0 * elapsed / total_time))
+
+        sites = sorted(self.__sites.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+        file.write("\n%-40s %7s %-24s %12s %12s\n" % ("Instruction", "Offset", "Opcode", "Count", "Total ms"))
+        for (code, offset), (opmethod, count, elapsed) in sites:
+            location = "%s (%s:%s)" % (code.co_name, code.co_filename, self.__line_of(code, offset))
+            file.write("%-40s %7d %-24s %12d %12.3f\n" %
+                       (location, offset, opmethod[len("execute_"):], count, elapsed / 1000000.0))
+
+    def __line_of(self, code, offset):
+        if self.__vm is None:
+            return code.co_firstlineno
+
+        return self.__vm.code_cache.decode(code).lines[offset]
+
+class LineProfiler:
+    """
+    Hits and time per source line of every code object. Enable with vm.line_profiler = LineProfiler().
+
+    Built on the VM's line, call and return events, see src.hooks: every line event is a hit and the clock is
+    only read when execution moves to another line or frame. Time runs from entering a line until execution
+    moves elsewhere, so callees are charged to their own lines, not the caller's.
+    """
+    def __init__(self):
+        self.__lines = {}
+        self.__vm = None
+        self.__key = None
+        self.__start = 0
+
+    @property
+    def lines(self):
+        """
+        {(code, lineno): [hits, nanoseconds]}
+        """
+        return self.__lines
+
+    def clear(self):
+        self.__lines.clear()
+        self.__key = None
+
+    def start(self, vm):
+        """
+        Subscribes to vm's events, done by setting vm.line_profiler.
+        """
+        from src.hooks import CALL, RETURN, LINE
+
+        self.__vm = vm
+        self.__key = None
+        vm.hooks.subscribe(CALL, self.__switch)
+        vm.hooks.subscribe(RETURN, self.__switch)
+        vm.hooks.subscribe(LINE, self.__line)
+
+    def stop(self):
+        from src.hooks import CALL, RETURN, LINE
+
+        self.__charge(perf_counter_ns())
+        self.__key = None
+        hooks = self.__vm.hooks
+        hooks.unsubscribe(CALL, self.__switch)
+        hooks.unsubscribe(RETURN, self.__switch)
+        hooks.unsubscribe(LINE, self.__line)
+
+    def __charge(self, now):
+        if self.__key is not None:
+            self.__lines.setdefault(self.__key, [0, 0])[1] += now - self.__start
+        self.__start = now
+
+    def __line(self, exec_frame, lineno):
+        self.__charge(perf_counter_ns())
+        self.__key = (exec_frame.code, lineno)
+        self.__lines.setdefault(self.__key, [0, 0])[0] += 1
+
+    def __switch(self, frame):
+        # Returns land in the middle of the caller's line without a line event, the line comes from the frame
+        # executing now. Its ip is past the instruction about to run, or 0 in a call that's yet to start.
+        exec_frame = self.__vm.exec_frame
+        self.__charge(perf_counter_ns())
+        lines = self.__vm.code_cache.decode(exec_frame.code).lines
+        self.__key = (exec_frame.code, lines[max(exec_frame.ip - 1, 0)])
+
+    def report(self, file=None):
+        """
+        Prints every profiled code object as a source listing annotated with the hits and time of each line.
+        """
+        if file is None:
+            file = sys.stdout
+
+        by_code = {}
+        for (code, lineno), stats in self.__lines.items():
+            by_code.setdefault(code, {})[lineno] = stats
+
+        vm = self.__vm
+        total_time = sum(stats[1] for stats in self.__lines.values()) or 1
+        codes = sorted(by_code, key=lambda code: sum(stats[1] for stats in by_code[code].values()), reverse=True)
+        for code in codes:
+            line_stats = by_code[code]
+            code_time = sum(stats[1] for stats in line_stats.values())
+            file.write("\n%s (%s:%s) %.3f ms\n" % (code.co_name, code.co_filename, code.co_firstlineno,
+                                                    code_time / 1000000.0))
+            file.write("%6s %10s %12s %10s %7s  %s\n" % ("Line", "Hits", "Time ms", "Per hit ns", "%", "Source"))
+
+            line_no = LineNo(code.co_firstlineno, code.co_lnotab, vm.source, vm.filename)
+            code_lines = vm.code_cache.decode(code).lines
+            for lineno in range(min(code_lines), max(code_lines) + 1):
+                try:
+                    source_line = line_no.get_source_line(lineno)
+                except Exception:
+                    source_line = ""
+
+                hits, elapsed = line_stats.get(lineno, (0, 0))
+                if hits or elapsed:
+                    file.write("%6d %10d %12.3f %10d %6.2f%%  %s\n" %
+                               (lineno, hits, elapsed / 1000000.0, elapsed // max(hits, 1),
+                                100.0 * elapsed / total_time, source_line))
+                else:
+                    file.write("%6d %10s %12s %10s %7s  %s\n" % (lineno, "", "", "", "", source_line))
+
+def function_label(code):
+    return "%s (%s:%s)" % (code.co_name, code.co_filename, code.co_firstlineno)
+
+class CallRecord:
+    """
+    An active call on a FrameTracker's shadow stack.
+    """
+    __slots__ = ("frame", "code", "path", "start", "child_time", "primitive")
+
+    def __init__(self, frame, code, start, primitive):
+        self.frame = frame
+        self.code = code
+        self.path = None
+        self.start = start
+        self.child_time = 0
+        self.primitive = primitive
+
+class FrameTracker:
+    """
+    Follows guest function calls by keeping a shadow stack of the function frames on the VM's frame stack,
+    loop blocks aside, brought up to date whenever the executing frame changes. Subclasses implement
+    on_enter(record, now) and on_exit(record, caller, now, outermost), caller being the record of the calling
+    function and outermost telling whether no other call of the same code is active on the stack.
+
+    Generators enter and exit once per resumption. Each green thread has its own shadow stack, parked while
+    the thread is switched out; the time spent parked is taken out of its calls' start times.
+    """
+    def __init__(self):
+        self.__vm = None
+        self.__frame = None
+        self.__shadow = []
+        self.__suspended = {}
+        self.__active = {}
+
+    @property
+    def shadow(self):
+        return self.__shadow
+
+    @property
+    def thread_id(self):
+        """
+        Identifies the green thread being tracked: the id of the frame at the bottom of its stack.
+        """
+        return self.__shadow[0].frame.id if self.__shadow else 0
+
+    def on_enter(self, record, now):
+        pass
+
+    def on_exit(self, record, caller, now, outermost):
+        pass
+
+    def instrument(self, vm, dispatch):
+        """
+        Returns dispatch with every handler wrapped to follow frame changes.
+        """
+        self.__vm = vm
+        return dispatch.instrument(self.__wrap)
+
+    def __wrap(self, opmethod, handler):
+        vm = self.__vm
+        sync = self.__sync
+
+        if takes_argument(opmethod):
+            def tracked(oparg):
+                terminate = handler(oparg)
+                if vm.exec_frame is not self.__frame:
+                    sync()
+                return terminate
+        else:
+            def tracked():
+                terminate = handler()
+                if vm.exec_frame is not self.__frame:
+                    sync()
+                return terminate
+
+        return tracked
+
+    def follow(self):
+        """
+        Brings the shadow stack up to date if the executing frame changed since the last instruction.
+        """
+        if self.__vm.exec_frame is not self.__frame:
+            self.__sync()
+
+    def __function_frames(self):
+        """
+        Returns the function frame executing right now and the one that called it, skipping loop blocks.
+        """
+        from src.vm import Block
+
+        frames = self.__vm.exec_frame_stack
+        index = len(frames) - 1
+        frame = self.__vm.exec_frame
+        while isinstance(frame.callable, Block) and index >= 0:
+            frame = frames[index]
+            index -= 1
+
+        while index >= 0 and isinstance(frames[index].callable, Block):
+            index -= 1
+
+        caller = frames[index] if index >= 0 else None
+        return frame, caller
+
+    def __sync(self):
+        now = perf_counter_ns()
+        self.__frame = self.__vm.exec_frame
+        frame, caller = self.__function_frames()
+        shadow = self.__shadow
+
+        if shadow and shadow[-1].frame is frame:
+            # Entered or left a loop block
+            return
+        elif len(shadow) > 1 and shadow[-2].frame is frame:
+            self.__exit(now)
+            return
+        elif shadow and shadow[-1].frame is caller:
+            self.__enter(frame, now)
+            return
+
+        self.__resync(now)
+
+    def __resync(self, now):
+        """
+        Matches the shadow stack against the VM's whole stack of function frames. Needed when frames changed
+        without an instruction in between, like a generator resumed straight into a yield from, when
+        tracking starts mid-run, or when green threads switch stacks.
+        """
+        from src.vm import Block
+
+        vm = self.__vm
+        chain = [frame for frame in vm.exec_frame_stack + [vm.exec_frame] if not isinstance(frame.callable, Block)]
+
+        if self.__shadow and self.__shadow[0].frame is not chain[0]:
+            # Another green thread: park this thread's calls and pick up the ones of the thread switched to.
+            # Recursion is tracked per thread.
+            self.__suspended[self.__shadow[0].frame] = (self.__shadow, self.__active, now)
+            self.__shadow = []
+            self.__active = {}
+            if chain[0] in self.__suspended:
+                records, active, parked_at = self.__suspended.pop(chain[0])
+                for record in records:
+                    record.start += now - parked_at
+                self.__shadow = records
+                self.__active = active
+
+        shadow = self.__shadow
+        common = 0
+        while common < len(shadow) and common < len(chain) and shadow[common].frame is chain[common]:
+            common += 1
+
+        while len(shadow) > common:
+            self.__exit(now)
+        for frame in chain[common:]:
+            self.__enter(frame, now)
+
+    def __enter(self, frame, now):
+        code = frame.code
+        active = self.__active.get(code, 0)
+        self.__active[code] = active + 1
+
+        record = CallRecord(frame, code, now, active == 0)
+        self.__shadow.append(record)
+        self.on_enter(record, now)
+
+    def __exit(self, now):
+        record = self.__shadow.pop()
+        self.__active[record.code] -= 1
+        outermost = self.__active[record.code] == 0
+
+        caller = self.__shadow[-1] if self.__shadow else None
+        self.on_exit(record, caller, now, outermost)
+
+    def flush(self):
+        """
+        Closes the calls still open, the module frame never returns to a caller so it's always one of them.
+        """
+        now = perf_counter_ns()
+        while self.__shadow:
+            self.__exit(now)
+
+        # Green threads that never got switched back to stopped when they were parked
+        for records, active, parked_at in self.__suspended.values():
+            self.__shadow = records
+            self.__active = active
+            while self.__shadow:
+                self.__exit(parked_at)
+
+        self.__shadow = []
+        self.__active = {}
+        self.__suspended = {}
+        self.__frame = None
+
+class CallProfiler(FrameTracker):
+    """
+    Function level profiler. Records calls, inclusive and exclusive time per guest function and per
+    caller -> callee edge, and exclusive time per call stack for flamegraphs. Enable with
+    vm.call_profiler = CallProfiler().
+
+    Recursive calls only count once towards the inclusive time, like cProfile. Generators are charged as a
+    call per resumption and a green thread's calls don't include the time other threads ran.
+    """
+    def __init__(self):
+        FrameTracker.__init__(self)
+
+        # code -> [primitive calls, calls, exclusive ns, inclusive ns]
+        self.__functions = {}
+        # (caller code, callee code) -> [primitive calls, calls, exclusive ns, inclusive ns]
+        self.__edges = {}
+        # (label, label, ...) -> exclusive ns
+        self.__stacks = {}
+
+    @property
+    def functions(self):
+        return self.__functions
+
+    @property
+    def edges(self):
+        return self.__edges
+
+    @property
+    def stacks(self):
+        return self.__stacks
+
+    def on_enter(self, record, now):
+        shadow = self.shadow
+        parent_path = shadow[-2].path if len(shadow) > 1 else ()
+        record.path = parent_path + (function_label(record.code),)
+
+    def on_exit(self, record, caller, now, outermost):
+        code = record.code
+        elapsed = now - record.start
+        exclusive = elapsed - record.child_time
+
+        stats = self.__functions.setdefault(code, [0, 0, 0, 0])
+        stats[0] += record.primitive
+        stats[1] += 1
+        stats[2] += exclusive
+        if outermost:
+            stats[3] += elapsed
+
+        if caller is not None:
+            caller.child_time += elapsed
+            edge = self.__edges.setdefault((caller.code, code), [0, 0, 0, 0])
+            edge[0] += record.primitive
+            edge[1] += 1
+            edge[2] += exclusive
+            if outermost:
+                edge[3] += elapsed
+
+        self.__stacks[record.path] = self.__stacks.get(record.path, 0) + exclusive
+
+    def report(self, file=None, limit=30):
+        """
+        Prints the functions sorted by inclusive time with their callers.
+        """
+        self.flush()
+        if file is None:
+            file = sys.stdout
+
+        callers = {}
+        for (caller, callee), edge in self.__edges.items():
+            callers.setdefault(callee, []).append((caller, edge[1]))
+
+        rows = sorted(self.__functions.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+        file.write("%-50s %10s %12s %12s  %s\n" % ("Function", "Calls", "Incl ms", "Excl ms", "Called by"))
+        for code, (primitive, calls, exclusive, inclusive) in rows:
+            num_calls = str(calls) if primitive == calls else "%s/%s" % (calls, primitive)
+            called_by = ", ".join("%s x%s" % (caller.co_name, count) for caller, count in callers.get(code, []))
+            file.write("%-50s %10s %12.3f %12.3f  %s\n" %
+                       (function_label(code), num_calls, inclusive / 1000000.0, exclusive / 1000000.0, called_by))
+
+    def write_collapsed(self, file):
+        """
+        Writes Brendan Gregg's collapsed stack format, one "outer;...;inner microseconds" line per stack,
+        ready for flamegraph.pl.
+        """
+        self.flush()
+        for path, exclusive in sorted(self.__stacks.items()):
+            file.write("%s %d\n" % (";".join(path), exclusive // 1000))
+
+    def dump_stats(self, filename):
+        """
+        Writes the profile in the marshal format pstats.Stats and tools like snakeviz and gprof2dot read.
+        """
+        self.flush()
+
+        def key(code):
+            return (code.co_filename, code.co_firstlineno, code.co_name)
+
+        stats = {}
+        for code, (primitive, calls, exclusive, inclusive) in self.__functions.items():
+            stats[key(code)] = (primitive, calls, exclusive / 1e9, inclusive / 1e9, {})
+
+        for (caller, callee), (primitive, calls, exclusive, inclusive) in self.__edges.items():
+            # Caller entries put the total calls first, unlike the function entries
+            stats[key(callee)][4][key(caller)] = (calls, primitive, exclusive / 1e9, inclusive / 1e9)
+
+        with open(filename, "wb") as f:
+            marshal.dump(stats, f)
+
+class SamplingProfiler:
+    """
+    Statistical profiler. A timer snapshots the VM's frame chain, with the code and ip of every frame, into a
+    preallocated ring buffer at a fixed rate; the capacity most recent samples are kept. Nothing is added
+    to the dispatch loop, so the cost only depends on the sampling rate.
+
+    The timer is signal.setitimer(ITIMER_PROF) when available and start() is called from the main thread,
+    a host thread otherwise. A host thread only gets to sample when the interpreter switches threads, see
+    sys.setswitchinterval.
+
+        profiler = SamplingProfiler(vm, interval=0.005)
+        with profiler:
+            vm.execute()
+        profiler.write_collapsed(open("out.txt", "w"))
+    """
+    def __init__(self, vm, interval=0.005, capacity=100000, use_signal=None):
+        self.__vm = vm
+        self.__interval = interval
+        self.__samples = [None] * capacity
+        self.__num_samples = 0
+        self.__use_signal = use_signal
+        self.__running = False
+        self.__thread = None
+        self.__previous_handler = None
+
+    @property
+    def num_samples(self):
+        """
+        Samples taken since the last clear, including the ones the ring buffer has overwritten.
+        """
+        return self.__num_samples
+
+    def samples(self):
+        """
+        Returns the samples still in the ring buffer, oldest first. Each sample is a tuple with a
+        (code, ip, is_block) entry per frame, outermost first.
+        """
+        capacity = len(self.__samples)
+        if self.__num_samples <= capacity:
+            return self.__samples[:self.__num_samples]
+
+        split = self.__num_samples % capacity
+        return self.__samples[split:] + self.__samples[:split]
+
+    def clear(self):
+        self.__samples = [None] * len(self.__samples)
+        self.__num_samples = 0
+
+    def sample(self):
+        """
+        Takes one sample of the VM's current frame chain.
+        """
+        from src.vm import Block
+
+        vm = self.__vm
+        frames = list(vm.exec_frame_stack)
+        frames.append(vm.exec_frame)
+
+        snapshot = tuple((frame.code, frame.ip, isinstance(frame.callable, Block)) for frame in frames)
+        self.__samples[self.__num_samples % len(self.__samples)] = snapshot
+        self.__num_samples += 1
+
+    def start(self):
+        if self.__running:
+            return
+
+        self.__running = True
+        use_signal = self.__use_signal
+        if use_signal is None:
+            use_signal = hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+
+        if use_signal:
+            self.__previous_handler = signal.signal(signal.SIGPROF, self.__on_signal)
+            signal.setitimer(signal.ITIMER_PROF, self.__interval, self.__interval)
+        else:
+            self.__thread = threading.Thread(target=self.__run_timer, name="vm-sampler")
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def stop(self):
+        if not self.__running:
+            return
+
+        self.__running = False
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        else:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self.__previous_handler)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def __on_signal(self, signum, frame):
+        self.sample()
+
+    def __run_timer(self):
+        while self.__running:
+            time.sleep(self.__interval)
+            self.sample()
+
+    def __stacks(self, with_lines):
+        """
+        Folds the samples into {(label, ...): count}. A loop block carries the ip of the function it's in, so
+        it replaces the function frame below it instead of adding a level.
+        """
+        vm = self.__vm
+        stacks = {}
+        for snapshot in self.samples():
+            path = []
+            for code, ip, is_block in snapshot:
+                if is_block and path:
+                    path.pop()
+
+                if with_lines:
+                    lines = vm.code_cache.decode(code).lines
+                    lineno = lines[min(ip, len(lines) - 1)] if lines else code.co_firstlineno
+                    path.append("%s (%s:%s)" % (code.co_name, code.co_filename, lineno))
+                else:
+                    path.append(function_label(code))
+
+            path = tuple(path)
+            stacks[path] = stacks.get(path, 0) + 1
+
+        return stacks
+
+    def write_collapsed(self, file, with_lines=False):
+        """
+        Writes the samples in collapsed stack format for flamegraph.pl, one "outer;...;inner count" line per
+        distinct stack. with_lines labels every frame with the line it was on instead of where its function
+        starts.
+        """
+        for path, count in sorted(self.__stacks(with_lines).items()):
+            file.write("%s %d\n" % (";".join(path), count))
+
+    def report(self, file=None, limit=20):
+        """
+        Prints the functions seen most often, on top of the stack (self) and anywhere on it (total).
+        """
+        if file is None:
+            file = sys.stdout
+
+        self_counts = {}
+        total_counts = {}
+        stacks = self.__stacks(False)
+        for path, count in stacks.items():
+            self_counts[path[-1]] = self_counts.get(path[-1], 0) + count
+            for label in set(path):
+                total_counts[label] = total_counts.get(label, 0) + count
+
+        num_samples = sum(stacks.values()) or 1
+        file.write("%s samples\n" % num_samples)
+        file.write("%-50s %10s %7s %10s %7s\n" % ("Function", "Self", "%", "Total", "%"))
+        rows = sorted(total_counts.items(), key=lambda item: (self_counts.get(item[0], 0), item[1]), reverse=True)
+        for label, total in rows[:limit]:
+            own = self_counts.get(label, 0)
+            file.write("%-50s %10d %6.2f%% %10d %6.2f%%\n" %
+                       (label, own, 100.0 * own / num_samples, total, 100.0 * total / num_samples))
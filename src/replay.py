@@ -0,0 +1,411 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Record and replay. While recording, the VM's instruction counter is the program's clock: every interval
+# instructions a checkpoint snapshots the frames and everything reachable from them, and the results of
+# calls to host functions that can't be repeated (input, print, clocks, random numbers) are logged by
+# instruction. Going to instruction n restores the last checkpoint before n and replays from there, handing
+# back the logged results instead of calling those functions again, so the replay takes the same path.
+#
+# A snapshot is shallow per object: for every list, dict, set and object with a __dict__ it keeps the
+# object and a tuple of its contents, and restoring writes the contents back into the same object, so
+# identities between frames, globals and generators hold. Contents that didn't change since the previous
+# checkpoint are shared with it rather than copied again.
+
+import enum
+import io
+import types
+
+from src.hooks import LineTracker
+from src.profiler import takes_argument
+
+# Builtins, besides everything from these modules, whose results are logged and replayed
+LOGGED_BUILTINS = frozenset(["input", "print", "id", "hash", "open"])
+LOGGED_MODULES = frozenset(["time", "random", "os", "posix", "nt", "socket", "select"])
+
+# Values with nothing mutable inside
+ATOMIC_TYPES = frozenset([int, float, complex, bool, str, bytes, range, type(None)])
+# Iterators over builtin sequences keep their position out of reach, but hand it out by __reduce__ and take
+# it back by __setstate__
+ITERATOR_TYPES = frozenset(type(iterator) for iterator in [iter([]), iter(()), iter(range(0)), iter(range(1 << 64)),
+                                                          iter(""), iter("\u20ac"), iter(b""), reversed([]),
+                                                          reversed(range(0))])
+# Objects the snapshots don't look into
+OPAQUE_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType,
+                types.CodeType, enum.Enum, io.IOBase)
+
+# Guest functions and classes are never logged, their calls are replayed instruction by instruction
+HOST_FUNCTION_TYPES = (types.BuiltinFunctionType, types.FunctionType, types.MethodType)
+
+def logged(callable):
+    if not isinstance(callable, HOST_FUNCTION_TYPES):
+        return False
+    module = getattr(callable, "__module__", None)
+    if module == "builtins":
+        return callable.__name__ in LOGGED_BUILTINS
+    if module is None:
+        # Methods of C objects, like random.random of the module's Random instance
+        module = getattr(getattr(callable, "__self__", None), "__module__", None)
+    return module in LOGGED_MODULES
+
+class Rewind(Exception):
+    """
+    Raised from inside the program's execution to go to instruction target. The caller of the VM catches it
+    and hands it to Recorder.seek. With line set the target is the start of the line executed before it.
+    """
+    def __init__(self, target, line=False, before=None):
+        Exception.__init__(self, "Rewind to instruction %s" % target)
+        self.target = target
+        self.line = line
+        # Only use checkpoints taken before this instruction
+        self.before = before
+
+class Checkpoint:
+    """
+    The program's state before instruction count: the executing frame and the offset it resumes at, and
+    id -> (object, contents) of everything reachable from the frames.
+    """
+    __slots__ = ("count", "exec_frame", "offset", "objects")
+
+    def __init__(self, count, exec_frame, offset, objects):
+        self.count = count
+        self.exec_frame = exec_frame
+        self.offset = offset
+        self.objects = objects
+
+def contents_of(obj):
+    """
+    Returns (contents, children) of a mutable object, (None, children) of an immutable container and
+    (None, ()) of anything not to look into.
+    """
+    t = type(obj)
+    if t in ATOMIC_TYPES:
+        return None, ()
+    elif t is list:
+        contents = tuple(obj)
+        return contents, contents
+    elif t is dict:
+        contents = tuple(obj.items())
+        return contents, [item for pair in contents for item in pair]
+    elif t is set:
+        contents = frozenset(obj)
+        return contents, contents
+    elif t is tuple or t is frozenset:
+        return None, obj
+    elif t in ITERATOR_TYPES:
+        reduced = obj.__reduce__()
+        if len(reduced) < 3:
+            # Exhausted, it stays that way
+            return None, ()
+        return reduced, reduced[1]
+    elif isinstance(obj, OPAQUE_TYPES) or not hasattr(obj, "__dict__"):
+        return None, ()
+
+    contents = tuple(vars(obj).items())
+    return contents, [value for name, value in contents]
+
+def same_contents(a, b):
+    if len(a) != len(b):
+        return False
+    if type(a) is frozenset:
+        return a == b
+    for x, y in zip(a, b):
+        if type(x) is tuple:
+            # A dict item or an attribute
+            if x[0] is not y[0] or x[1] is not y[1]:
+                return False
+        elif x is not y:
+            return False
+    return True
+
+def restore_iterator(obj, contents):
+    """
+    Returns the iterator to use instead of obj, None if obj itself could be put back.
+    """
+    factory, args, state = contents
+    if len(obj.__reduce__()) == 3:
+        obj.__setstate__(state)
+        return None
+
+    # An exhausted iterator has let go of its sequence, start a new one over it
+    iterator = factory(*args)
+    iterator.__setstate__(state)
+    return iterator
+
+def restore_contents(obj, contents, replacements):
+    if replacements:
+        contents = replace(contents, replacements)
+
+    t = type(obj)
+    if t is list:
+        obj[:] = contents
+    elif t is dict:
+        obj.clear()
+        obj.update(contents)
+    elif t is set:
+        obj.clear()
+        obj.update(contents)
+    else:
+        attributes = vars(obj)
+        attributes.clear()
+        attributes.update(contents)
+
+def replace(contents, replacements):
+    if type(contents) is frozenset:
+        return frozenset(replacements.get(id(value), value) for value in contents)
+
+    replaced = []
+    for value in contents:
+        if type(value) is tuple:
+            # A dict item or an attribute
+            value = (replacements.get(id(value[0]), value[0]), replacements.get(id(value[1]), value[1]))
+        else:
+            value = replacements.get(id(value), value)
+        replaced.append(value)
+    return replaced
+
+class Recorder:
+    """
+    Records a program for replay: vm.hooks.use_tool("recorder", Recorder()). Checkpoints are taken every
+    interval instructions. Past max_checkpoints every other one is dropped and the interval doubles, so memory
+    stays bounded and jumps get slower the longer the recording.
+
+    seek(target) puts the VM back at the last checkpoint before target and vm.resume() then replays up to it,
+    where on_reached(exec_frame, offset) is called before the instruction runs. Programs running green threads
+    or stopped inside a generator can't be checkpointed, host objects like open files aren't restored.
+    """
+    def __init__(self, on_reached=None, interval=1000, max_checkpoints=64):
+        self.__on_reached = on_reached
+        self.__interval = interval
+        self.__max_checkpoints = max_checkpoints
+        self.__vm = None
+
+        self.__checkpoints = []
+        # instruction count of a call -> its logged result
+        self.__results = {}
+        self.__target = None
+        self.__next_checkpoint = 0
+        self.__next_event = 0
+
+        # While looking for the start of the line before the target: the instructions lines started at
+        self.__scanning = False
+        self.__scan_before = None
+        self.__line_starts = []
+        self.__line_tracker = None
+
+    @property
+    def replaying(self):
+        return self.__target is not None
+
+    @property
+    def first(self):
+        """
+        The earliest instruction that can be gone back to, None before the first checkpoint.
+        """
+        return self.__checkpoints[0].count if self.__checkpoints else None
+
+    def instrument(self, vm, dispatch):
+        """
+        Returns dispatch with every handler wrapped to check for checkpoints and the replay target, and calls
+        wrapped to log and replay their results.
+        """
+        self.__vm = vm
+        self.__line_tracker = LineTracker(vm)
+        dispatch = dispatch.instrument(self.__wrap_call, ["execute_CALL_FUNCTION"])
+        return dispatch.instrument(self.__wrap)
+
+    def __wrap(self, opmethod, handler):
+        vm = self.__vm
+        event = self.__event
+
+        if takes_argument(opmethod):
+            def recorded(oparg):
+                if vm.instruction_count >= self.__next_event:
+                    event(3)
+                return handler(oparg)
+        else:
+            def recorded():
+                if vm.instruction_count >= self.__next_event:
+                    event(1)
+                return handler()
+
+        return recorded
+
+    def __wrap_call(self, opmethod, handler):
+        vm = self.__vm
+        results = self.__results
+
+        def recorded(argc):
+            if vm.scheduler.active:
+                # Green threads count instructions a whole time slice at a time, calls can't be told apart
+                return handler(argc)
+
+            count = vm.instruction_count
+            exec_frame = vm.exec_frame
+            num_args = (argc & 0xF) + 2 * ((argc >> 8) & 0xF)
+            callable = exec_frame.stack[-num_args - 1]
+
+            if count in results:
+                # Replaying: the call happened already, hand back what it returned
+                exec_frame.popn(num_args + 1)
+                exec_frame.append(results[count])
+                return None
+
+            terminate = handler(argc)
+            if terminate is None and logged(callable):
+                results[count] = exec_frame.top()
+            return terminate
+
+        return recorded
+
+    def __event(self, size):
+        vm = self.__vm
+        count = vm.instruction_count
+        exec_frame = vm.exec_frame
+
+        if self.__scanning:
+            self.__scan(exec_frame, exec_frame.ip - size, count)
+        elif count >= self.__next_checkpoint and not vm.in_generator and not vm.scheduler.active:
+            self.__take(count, exec_frame, exec_frame.ip - size)
+
+        if count == self.__target:
+            self.__target = None
+            if self.__scanning:
+                self.__scanning = False
+                raise self.__line_before(count)
+
+            self.__update_next_event()
+            if self.__on_reached is not None:
+                self.__on_reached(exec_frame, exec_frame.ip - size)
+            return
+
+        self.__update_next_event()
+
+    def __update_next_event(self):
+        if self.__scanning:
+            self.__next_event = self.__vm.instruction_count + 1
+        elif self.__target is not None:
+            self.__next_event = min(self.__target, self.__next_checkpoint)
+        else:
+            self.__next_event = self.__next_checkpoint
+
+    def __take(self, count, exec_frame, offset):
+        vm = self.__vm
+        previous = self.__checkpoints[-1].objects if self.__checkpoints else {}
+        skip = set([id(vm), id(vm.code_cache), id(vm.scheduler), id(vm.hooks)])
+
+        objects = {}
+        pending = [vm.exec_frame_stack, exec_frame, vm.module_frame]
+        while pending:
+            obj = pending.pop()
+            key = id(obj)
+            if key in objects or key in skip:
+                continue
+
+            contents, children = contents_of(obj)
+            if contents is None:
+                skip.add(key)
+            else:
+                entry = previous.get(key)
+                if entry is None or entry[0] is not obj or not same_contents(entry[1], contents):
+                    entry = (obj, contents)
+                objects[key] = entry
+            pending.extend(children)
+
+        self.__checkpoints.append(Checkpoint(count, exec_frame, offset, objects))
+        if len(self.__checkpoints) > self.__max_checkpoints:
+            self.__checkpoints = self.__checkpoints[::2] + ([self.__checkpoints[-1]] if len(self.__checkpoints) % 2 == 0 else [])
+            self.__interval *= 2
+        self.__next_checkpoint = count + self.__interval
+
+    def seek(self, target, line=False, before=None):
+        """
+        Restores the last checkpoint before instruction target, or before instruction before when given, and
+        arms the replay to stop there. With line set the replay first looks for the instruction the line
+        executed before target started at and then seeks again to it by raising Rewind. Returns the
+        instruction the replay starts from.
+        """
+        if not self.__checkpoints:
+            raise Exception("Nothing recorded yet")
+        if self.__vm.scheduler.active:
+            raise Exception("Can't go back in a program running green threads")
+
+        limit = target if before is None else min(target, before - 1)
+        index = len([checkpoint for checkpoint in self.__checkpoints if checkpoint.count <= limit]) - 1
+        if index < 0:
+            # Earlier than the recording goes back: the first checkpoint is as far as it gets
+            index = 0
+            target = self.__checkpoints[0].count
+            line = False
+        elif line and index > 0:
+            # The first instruction scanned counts as a line start, even mid line. From a checkpoint further
+            # back it's rarely the last one before the target
+            index -= 1
+        checkpoint = self.__checkpoints[index]
+
+        replacements = {}
+        for obj, contents in checkpoint.objects.values():
+            if type(obj) in ITERATOR_TYPES:
+                iterator = restore_iterator(obj, contents)
+                if iterator is not None:
+                    replacements[id(obj)] = iterator
+
+        for obj, contents in checkpoint.objects.values():
+            if type(obj) not in ITERATOR_TYPES:
+                restore_contents(obj, contents, replacements)
+        checkpoint.exec_frame.ip = checkpoint.offset
+        self.__vm.restore_frame(checkpoint.exec_frame, checkpoint.count - 1)
+
+        self.__target = target
+        self.__scanning = line
+        self.__scan_before = checkpoint.count
+        self.__line_starts = []
+        self.__line_tracker.reset(checkpoint.exec_frame)
+        self.__next_checkpoint = self.__checkpoints[-1].count + self.__interval
+        self.__update_next_event()
+        return checkpoint.count
+
+    def __scan(self, exec_frame, offset, count):
+        if self.__line_tracker.step(exec_frame, offset) is not None and count < self.__target:
+            self.__line_starts.append(count)
+
+    def __line_before(self, target):
+        if self.__line_starts:
+            return Rewind(self.__line_starts[-1])
+
+        # No line started between the checkpoint and the target, look from the checkpoint before
+        return Rewind(target, line=True, before=self.__scan_before)
+
+    def discard_after(self, count):
+        """
+        Forgets the checkpoints and results recorded after instruction count, for when the program was changed
+        from outside and won't take the recorded path anymore.
+        """
+        self.__checkpoints = [checkpoint for checkpoint in self.__checkpoints if checkpoint.count <= count]
+        for call_count in [call_count for call_count in self.__results if call_count > count]:
+            del self.__results[call_count]
+
+        last = self.__checkpoints[-1].count if self.__checkpoints else 0
+        self.__next_checkpoint = max(last + self.__interval, count + 1)
+        self.__update_next_event()
@@ -0,0 +1,92 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import contextlib
+import io
+import time
+
+from src.vm import BytecodeVM
+from src.loader import ScriptCompiler
+
+class ScriptRunner:
+    """
+    Runs guest scripts one after the other on a single warm BytecodeVM. The compiled code objects, the
+    decoded code and the dispatch tables are all reused between scripts.
+    """
+    def __init__(self, config=None):
+        self.__compiler = ScriptCompiler(config is not None and config.optimize)
+        self.__vm = None
+        self.__config = config
+
+    @property
+    def vm(self):
+        return self.__vm
+
+    @property
+    def compiler(self):
+        return self.__compiler
+
+    def run_file(self, filename):
+        return self.__run(filename, None)
+
+    def run_source(self, source, filename="<string>"):
+        return self.__run(filename, source)
+
+    def __run(self, filename, source):
+        """
+        Returns a dict describing the run. Errors in the guest program are reported in the result rather
+        than raised, so one bad script doesn't take down the caller.
+        """
+        result = {"script": filename}
+        output = io.StringIO()
+
+        start = time.perf_counter()
+        try:
+            if source is None:
+                code, source_lines = self.__compiler.compile_file(filename)
+            else:
+                code, source_lines = self.__compiler.compile_source(source, filename)
+            result["compile_time"] = time.perf_counter() - start
+
+            if self.__vm is None:
+                self.__vm = BytecodeVM(code, source_lines, filename)
+                if self.__config is not None:
+                    self.__vm.config = self.__config
+
+            with contextlib.redirect_stdout(output):
+                run_result = self.__vm.run(code, source=source_lines, filename=filename)
+
+            result["status"] = "ok"
+            result["return_value"] = repr(run_result.return_value)
+            result["instructions"] = run_result.instructions
+            result["run_time"] = run_result.elapsed
+        except BaseException as e:
+            # SystemExit and KeyboardInterrupt raised by the guest included, they'd take down the server
+            # thread or pool worker running it
+            result["status"] = "error"
+            result["error"] = "%s: %s" % (type(e).__name__, e)
+
+        result["output"] = output.getvalue()
+        result["total_time"] = time.perf_counter() - start
+        return result
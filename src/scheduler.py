@@ -0,0 +1,238 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) 2015 <Satyajit Sarangi>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from collections import deque
+
+class ThreadSwitch:
+    """
+    Returned by the scheduling builtins. CALL_FUNCTION pushes result as the value of the call and ends the
+    current green thread's time slice.
+    """
+    def __init__(self, result=None):
+        self.result = result
+
+class GreenThread:
+    """
+    A guest level thread: its own exec frame and frame stack, multiplexed on the VM by the Scheduler.
+    """
+    def __init__(self, thread_id, name, exec_frame=None):
+        self.__id = thread_id
+        self.__name = name
+        self.__exec_frame = exec_frame
+        self.__exec_frame_stack = []
+        self.__blocked = False
+        self.__finished = False
+        self.__result = None
+        self.__joiners = []
+        self.__scheduler = None
+
+    @property
+    def id(self):
+        return self.__id
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def exec_frame(self):
+        return self.__exec_frame
+
+    @property
+    def exec_frame_stack(self):
+        return self.__exec_frame_stack
+
+    @property
+    def blocked(self):
+        return self.__blocked
+
+    @blocked.setter
+    def blocked(self, b):
+        self.__blocked = b
+
+    @property
+    def finished(self):
+        return self.__finished
+
+    @property
+    def result(self):
+        return self.__result
+
+    @property
+    def joiners(self):
+        return self.__joiners
+
+    def attach(self, scheduler):
+        self.__scheduler = scheduler
+
+    def save(self, exec_frame, exec_frame_stack):
+        self.__exec_frame = exec_frame
+        self.__exec_frame_stack = exec_frame_stack
+
+    def finish(self, result):
+        self.__finished = True
+        self.__result = result
+
+    def join(self):
+        """
+        Waits for the thread to finish and returns what its function returned.
+        """
+        if self.__finished:
+            return self.__result
+
+        return self.__scheduler.block_on(self.__joiners)
+
+    def __str__(self):
+        return "GreenThread %s: %s" % (self.__id, self.__name)
+
+class Channel:
+    """
+    Unbounded FIFO channel between green threads. recv() blocks the calling thread while the channel is empty.
+    """
+    def __init__(self, scheduler):
+        self.__scheduler = scheduler
+        self.__items = deque()
+        self.__receivers = []
+
+    def send(self, value):
+        if self.__receivers:
+            # Hand the value straight to the thread that has been waiting longest
+            self.__scheduler.wake(self.__receivers.pop(0), value)
+        else:
+            self.__items.append(value)
+
+    def recv(self):
+        if self.__items:
+            return self.__items.popleft()
+
+        return self.__scheduler.block_on(self.__receivers)
+
+    def __len__(self):
+        return len(self.__items)
+
+class Scheduler:
+    """
+    Round robin scheduler for green threads. The VM runs the thread returned by next_thread for a budget of
+    instructions, or until it blocks or yields, and then hands it back with requeue.
+    """
+    def __init__(self, vm):
+        self.__vm = vm
+        self.__runnable = deque()
+        self.__num_threads = 0
+        self.__num_blocked = 0
+        self.__main_thread = None
+        self.__current = None
+
+    @property
+    def main_thread(self):
+        return self.__main_thread
+
+    @property
+    def current(self):
+        if self.__current is None:
+            # The module's execution is the main thread, it gets an identity the first time a thread is needed
+            self.__main_thread = self.__new_thread("main")
+            self.__current = self.__main_thread
+
+        return self.__current
+
+    @property
+    def active(self):
+        return self.__main_thread is not None
+
+    @property
+    def pending(self):
+        return len(self.__runnable) > 0 or self.__num_blocked > 0
+
+    def __new_thread(self, name, exec_frame=None):
+        thread = GreenThread(self.__num_threads, name, exec_frame)
+        thread.attach(self)
+        self.__num_threads += 1
+        return thread
+
+    def spawn(self, fn, *args):
+        """
+        Builtin spawn(fn, *args): starts fn(*args) on a new green thread and returns the thread.
+        """
+        # Make sure the main thread exists before the first spawned one
+        self.current
+
+        exec_frame = self.__vm.new_frame(fn, args, {})
+        thread = self.__new_thread(str(fn), exec_frame)
+        self.__runnable.append(thread)
+        return ThreadSwitch(thread)
+
+    def yield_thread(self):
+        """
+        Builtin yield_thread(): gives up the rest of the current time slice.
+        """
+        self.current
+        return ThreadSwitch(None)
+
+    def channel(self):
+        """
+        Builtin Channel(): creates a new channel.
+        """
+        return Channel(self)
+
+    def block_on(self, waiters):
+        if self.__vm.in_generator:
+            raise RuntimeError("A green thread can't block while a generator is executing")
+
+        thread = self.current
+        thread.blocked = True
+        self.__num_blocked += 1
+        waiters.append(thread)
+
+        # The placeholder result gets replaced by wake once the thread has something to receive
+        return ThreadSwitch(None)
+
+    def wake(self, thread, value):
+        thread.blocked = False
+        self.__num_blocked -= 1
+        thread.exec_frame.pop()
+        thread.exec_frame.append(value)
+        self.__runnable.append(thread)
+
+    def finish(self, thread, result):
+        thread.finish(result)
+        for joiner in thread.joiners:
+            self.wake(joiner, result)
+
+    def requeue(self, thread):
+        if not thread.blocked and not thread.finished:
+            self.__runnable.append(thread)
+
+    def next_thread(self):
+        """
+        Returns the next runnable thread, None when every thread has finished.
+        """
+        if not self.__runnable:
+            if self.__num_blocked:
+                raise RuntimeError("Deadlock: all %s remaining green threads are blocked" % self.__num_blocked)
+
+            return None
+
+        self.__current = self.__runnable.popleft()
+        return self.__current
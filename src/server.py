@@ -0,0 +1,135 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Long lived VM server. Clients connect over a Unix domain socket and send one JSON object per line:
+#
+#   {"path": "tests/fibonacci.py"}
+#   {"source": "print(1 + 2)", "filename": "<client>"}
+#
+# Each request gets one JSON line back with the status, the captured output, the repr of the return
+# value, the instruction count and the compile/run timings. A connection can send any number of requests.
+#
+#   python -m src.server /tmp/pyvym.sock
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import threading
+
+from src.runner import ScriptRunner
+
+class VMRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                request = json.loads(line.decode("utf-8"))
+            except ValueError as e:
+                response = {"status": "error", "error": "Invalid request: %s" % e}
+            else:
+                response = self.server.execute_request(request)
+
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+class VMServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, config=None):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        socketserver.UnixStreamServer.__init__(self, socket_path, VMRequestHandler)
+        self.__socket_path = socket_path
+        self.__runner = ScriptRunner(config)
+
+        # Connections are served concurrently but there is one warm VM, and stdout capture is process
+        # wide, so guest programs are executed one at a time.
+        self.__vm_lock = threading.Lock()
+
+    @property
+    def socket_path(self):
+        return self.__socket_path
+
+    def execute_request(self, request):
+        if "source" in request:
+            filename = request.get("filename", "<string>")
+            with self.__vm_lock:
+                return self.__runner.run_source(request["source"], filename)
+        elif "path" in request:
+            with self.__vm_lock:
+                return self.__runner.run_file(request["path"])
+
+        return {"status": "error", "error": "Request needs either 'path' or 'source'"}
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.__socket_path):
+            os.unlink(self.__socket_path)
+
+class VMClient:
+    def __init__(self, socket_path):
+        self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__sock.connect(socket_path)
+        self.__reader = self.__sock.makefile("rb")
+
+    def request(self, request):
+        self.__sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        response = self.__reader.readline()
+        if not response:
+            raise Exception("VM server closed the connection")
+
+        return json.loads(response.decode("utf-8"))
+
+    def run_file(self, path):
+        return self.request({"path": os.path.abspath(path)})
+
+    def run_source(self, source, filename="<client>"):
+        return self.request({"source": source, "filename": filename})
+
+    def close(self):
+        self.__reader.close()
+        self.__sock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="PyVyM server listening on a Unix domain socket")
+    parser.add_argument("socket_path", help="Path of the Unix domain socket to listen on")
+    args = parser.parse_args()
+
+    server = VMServer(args.socket_path)
+    print("PyVyM server listening on %s" % args.socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
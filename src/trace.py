@@ -0,0 +1,234 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Binary execution trace. Every executed instruction is written as a fixed size record into a ring buffer
+# preallocated in an mmap, so tracing can stay on and always has the last N instructions at hand. A trace
+# file is laid out as:
+#
+#   header    magic, format version, record size, capacity, total records written
+#   records   capacity records: frame id (64 bit), offset, line, code index (32 bit each), opcode
+#   codes     JSON list of [name, filename, first line], indexed by the records' code index
+#
+# The records go straight into the mapped file, the header count and the code table are written by flush().
+# Decode a trace with:
+#
+#   python -m src.trace trace.bin --last 50 --source
+
+import argparse
+import json
+import linecache
+import mmap
+import os
+import struct
+import sys
+
+from opcode import opmap, opname
+
+from src.code_cache import generic_opmethod
+from src.profiler import takes_argument
+
+HEADER = struct.Struct("<8sHHIQ")
+RECORD = struct.Struct("<QIIIB3x")
+MAGIC = b"PYVYMTRC"
+VERSION = 2
+
+class ExecutionTracer:
+    """
+    Records every executed instruction into a ring buffer of capacity records. Enable with
+    vm.tracer = ExecutionTracer(). With a filename the ring buffer is a shared mapping of that file,
+    otherwise it's anonymous memory and save() writes it out.
+    """
+    def __init__(self, capacity=1 << 20, filename=None):
+        self.__capacity = capacity
+        self.__size = HEADER.size + capacity * RECORD.size
+
+        if filename is None:
+            self.__file = None
+            self.__buffer = mmap.mmap(-1, self.__size)
+        else:
+            self.__file = open(filename, "w+b")
+            self.__file.truncate(self.__size)
+            self.__buffer = mmap.mmap(self.__file.fileno(), self.__size)
+
+        self.__count = 0
+        self.__codes = {}
+        self.__vm = None
+
+        # The frame the previous instruction ran in and what was looked up for it
+        self.__frame = None
+        self.__frame_id = 0
+        self.__code_index = 0
+        self.__lines = None
+
+    @property
+    def capacity(self):
+        return self.__capacity
+
+    @property
+    def count(self):
+        """
+        Instructions recorded so far, including the ones the ring buffer has overwritten.
+        """
+        return self.__count
+
+    def instrument(self, vm, dispatch):
+        """
+        Returns dispatch with every handler wrapped to record a trace entry before it runs.
+        """
+        self.__vm = vm
+        return dispatch.instrument(self.__wrap)
+
+    def __wrap(self, opmethod, handler):
+        vm = self.__vm
+        record = self.__record
+        opcode = opmap.get(generic_opmethod(opmethod)[len("execute_"):], 0)
+
+        if takes_argument(opmethod):
+            def traced(oparg):
+                record(vm.exec_frame, 3, opcode)
+                return handler(oparg)
+        else:
+            def traced():
+                record(vm.exec_frame, 1, opcode)
+                return handler()
+
+        return traced
+
+    def __record(self, exec_frame, size, opcode):
+        if exec_frame is not self.__frame:
+            code = exec_frame.code
+            self.__frame = exec_frame
+            self.__frame_id = exec_frame.id
+            self.__lines = self.__vm.code_cache.decode(code).lines
+
+            code_index = self.__codes.get(code)
+            if code_index is None:
+                code_index = len(self.__codes)
+                self.__codes[code] = code_index
+            self.__code_index = code_index
+
+        ip = exec_frame.ip - size
+        position = HEADER.size + (self.__count % self.__capacity) * RECORD.size
+        RECORD.pack_into(self.__buffer, position, self.__frame_id, ip, self.__lines[ip], self.__code_index, opcode)
+        self.__count += 1
+
+    def __code_table(self):
+        codes = [None] * len(self.__codes)
+        for code, index in self.__codes.items():
+            codes[index] = [code.co_name, code.co_filename, code.co_firstlineno]
+
+        return json.dumps(codes).encode("utf-8")
+
+    def flush(self):
+        """
+        Brings the mapped file up to date: the header with the record count, and the code table after the
+        records.
+        """
+        HEADER.pack_into(self.__buffer, 0, MAGIC, VERSION, RECORD.size, self.__capacity, self.__count)
+        if self.__file is None:
+            return
+
+        self.__buffer.flush()
+        self.__file.seek(self.__size)
+        self.__file.truncate()
+        self.__file.write(self.__code_table())
+        self.__file.flush()
+
+    def save(self, filename):
+        """
+        Writes the trace to filename.
+        """
+        HEADER.pack_into(self.__buffer, 0, MAGIC, VERSION, RECORD.size, self.__capacity, self.__count)
+        with open(filename, "wb") as f:
+            f.write(self.__buffer[:self.__size])
+            f.write(self.__code_table())
+
+    def close(self):
+        self.flush()
+        self.__buffer.close()
+        if self.__file is not None:
+            self.__file.close()
+
+def read_trace(filename):
+    """
+    Returns (records, codes, count) from a trace file. records are the (frame id, offset, line, code index,
+    opcode) tuples still in the ring buffer, oldest first, codes the [name, filename, first line] table and
+    count the number of instructions recorded in total.
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    magic, version, record_size, capacity, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise Exception("%s is not a PyVyM trace" % filename)
+    if version != VERSION or record_size != RECORD.size:
+        raise Exception("Unsupported trace format version %s" % version)
+
+    records_end = HEADER.size + capacity * record_size
+    codes = json.loads(data[records_end:].decode("utf-8")) if len(data) > records_end else []
+
+    # Once the ring buffer has wrapped the oldest record sits right after the newest
+    num_records = min(count, capacity)
+    first = count % capacity if count > capacity else 0
+    records = []
+    for i in range(num_records):
+        position = HEADER.size + ((first + i) % capacity) * record_size
+        records.append(RECORD.unpack_from(data, position))
+
+    return records, codes, count
+
+def render(filename, file=None, last=None, show_source=False):
+    """
+    Prints the records of a trace file, one instruction per line.
+    """
+    if file is None:
+        file = sys.stdout
+
+    records, codes, count = read_trace(filename)
+    if last is not None:
+        records = records[-last:]
+
+    first_seq = count - len(records)
+    for seq, (frame_id, offset, lineno, code_index, opcode) in enumerate(records, first_seq):
+        if code_index < len(codes):
+            name, code_filename, first_line = codes[code_index]
+        else:
+            name, code_filename = "?", ""
+
+        file.write("%10d  frame %-6d %-24s %-30s line %-5d %5d  %s\n" %
+                   (seq, frame_id, name, os.path.basename(code_filename), lineno, offset, opname[opcode]))
+        if show_source:
+            file.write("%46s| %s\n" % ("", linecache.getline(code_filename, lineno).rstrip()))
+
+def main():
+    parser = argparse.ArgumentParser(description="Decodes a PyVyM binary execution trace")
+    parser.add_argument("trace", help="Trace file written by --trace or ExecutionTracer")
+    parser.add_argument("--last", type=int, default=None, help="Only show the last N instructions")
+    parser.add_argument("--source", action="store_true", help="Show the source line of every instruction")
+    args = parser.parse_args()
+
+    render(args.trace, last=args.last, show_source=args.source)
+
+if __name__ == "__main__":
+    main()
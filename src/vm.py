@@ -1,18 +1,29 @@
-import dis
+import itertools
 import operator
+import time
 
 # Very good explanation comes from this link. https://ep2013.europython.eu/conference/talks/all-singing-all-dancing-python-bytecode
 
 import sys
 from enum import Enum
-from src.log import draw_header
+from opcode import opname, HAVE_ARGUMENT
+from src.log import draw_disassembly
 from src.debugger_support import LineNo
+from src.code_cache import CodeCache, code_key
+from src.hooks import Hooks
+from src.scheduler import Scheduler, ThreadSwitch
 from src.vmconfig import VMConfig
 
 uninitialized = None
 
 class_exec_frame_attr = "ZZ__EXEC_FRAME__ZZ"
 
+# co_flags bit set by the compiler on generator functions
+CO_GENERATOR = 0x20
+
+# Hands out ExecutionFrame ids, unique for the life of the process
+frame_ids = itertools.count(1)
+
 COMPARE_OPERATORS = [
     operator.lt,
     operator.le,
@@ -43,7 +54,7 @@ BINARY_OPERATORS = {
 }
 
 UNARY_OPERATORS = {
-    '+': lambda x: abs(x),
+    '+': lambda x: +x,
     "-": lambda x: -x,
     "~": lambda x: ~x,
     "!": lambda x: not x,
@@ -52,6 +63,9 @@ UNARY_OPERATORS = {
 class TerminateStates(Enum):
     TERMINATE_PROGRAM = 1
     TERMINATE_FUNCTION = 2
+    TERMINATE_YIELD = 3
+    TERMINATE_SWITCH = 4
+    TERMINATE_AWAIT = 5
 
 class Base:
     def __init__(self):
@@ -199,6 +213,97 @@ class Block(Base):
 class Closure:
     pass
 
+class Generator:
+    """
+    A guest generator. Holds the suspended chain of ExecutionFrames (the generator function's frame plus any
+    loop blocks it is inside of). Resuming puts the same frames back on the VM's frame stack, so the value
+    stacks are never copied.
+    """
+    def __init__(self, vm, exec_frame):
+        self.__vm = vm
+        self.__name = str(exec_frame.callable)
+        self.__suspended_frames = [exec_frame]
+        self.__started = False
+        self.__running = False
+        self.__finished = False
+        self.__yielded_value = None
+        self.__return_value = None
+        exec_frame.generator = self
+
+    @property
+    def suspended_frames(self):
+        return self.__suspended_frames
+
+    @property
+    def started(self):
+        return self.__started
+
+    @property
+    def running(self):
+        return self.__running
+
+    @property
+    def finished(self):
+        return self.__finished
+
+    @property
+    def yielded_value(self):
+        return self.__yielded_value
+
+    @property
+    def return_value(self):
+        return self.__return_value
+
+    def start(self):
+        self.__started = True
+        self.__running = True
+        self.__suspended_frames = None
+
+    def suspend(self, frames, value):
+        self.__running = False
+        self.__suspended_frames = frames
+        self.__yielded_value = value
+
+    def finish(self, return_value=None):
+        self.__running = False
+        self.__finished = True
+        self.__suspended_frames = None
+        self.__yielded_value = None
+        self.__return_value = return_value
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+    def send(self, value):
+        if self.__finished:
+            raise StopIteration
+
+        if not self.__started and value is not None:
+            raise TypeError("can't send non-None value to a just-started generator")
+
+        return self.__vm.resume_generator(self, value)
+
+    def throw(self, exc_type, value=None, traceback=None):
+        # The VM doesn't implement exception handling blocks yet, so the guest can never catch what is thrown
+        # in. The generator is finished and the exception propagates to the caller.
+        self.close()
+        if value is None:
+            value = exc_type() if isinstance(exc_type, type) else exc_type
+
+        raise value
+
+    def close(self):
+        if self.__running:
+            raise ValueError("generator already executing")
+
+        self.finish()
+
+    def __str__(self):
+        return "Generator: %s" % self.__name
+
 
 class VMState(Enum):
     BUILD_CLASS = 1
@@ -244,7 +349,7 @@ class BuildClass:
 
     @property
     def name(self):
-        return self.__name
+        return self.__class_name
 
     @property
     def code(self):
@@ -266,10 +371,10 @@ class BuildClass:
 
         op = self.__code[self.__ip]
         ip += 1
-        opmethod = "execute_%s" % dis.opname[op]
+        opmethod = "execute_%s" % opname[op]
 
         oparg = None
-        if op >= dis.HAVE_ARGUMENT:
+        if op >= HAVE_ARGUMENT:
             low = self.__code[ip]
             high = self.__code[ip + 1]
             oparg = (high << 8) | low
@@ -354,8 +459,7 @@ class BuildClass:
         self.__vm_state = VMState.BUILD_FUNC
 
         if self.__config.show_disassembly:
-            draw_header("FUNCTION CODE: %s" % name)
-            dis.dis(code)
+            draw_disassembly("FUNCTION CODE: %s" % name, code)
 
     def execute_RETURN_VALUE(self):
         """
@@ -373,12 +477,15 @@ class Builtins:
         build_class_obj = args[0]
         build_class_obj.build()
 
+    def add_func(self, name, fn):
+        self.__funcs[name] = fn
+
     @property
     def funcs(self):
         return self.__funcs
 
 class ExecutionFrame:
-    def __init__(self, callable, globals, args, kwargs, parent_exec_frame = None, source="", filename="", ip=0):
+    def __init__(self, callable, globals, args, kwargs, parent_exec_frame = None, source="", filename="", ip=0, binding_plan=None):
         assert callable != None, "Code object has to be provided when creating a new code context"
 
         # Print the line numbers
@@ -401,8 +508,19 @@ class ExecutionFrame:
 
         self.__parent_exec_frame = parent_exec_frame
 
+        # Set on the frame of a generator function, and on a constructor's frame so RETURN_VALUE hands the new
+        # object to the caller instead of __init__'s None
+        self.__generator = None
+        self.__constructed_object = None
+
         self.__source = source
         self.__filename = filename
+        self.__id = next(frame_ids)
+
+        if binding_plan is not None:
+            # The VM precomputed how arguments map to locals for this code object
+            binding_plan.bind(self.__locals, callable.defaults, args, kwargs)
+            return
 
         # Set the default arguments. This could be optimized so we set it once in the function
         # itself. But then we don't pull from Function locals right now
@@ -433,10 +551,30 @@ class ExecutionFrame:
         for k, v in kwargs.items():
             self.__locals[k] = v
 
+    @property
+    def id(self):
+        return self.__id
+
     @property
     def parent_exec_frame(self):
         return self.__parent_exec_frame
 
+    @property
+    def generator(self):
+        return self.__generator
+
+    @generator.setter
+    def generator(self, gen):
+        self.__generator = gen
+
+    @property
+    def constructed_object(self):
+        return self.__constructed_object
+
+    @constructed_object.setter
+    def constructed_object(self, obj):
+        self.__constructed_object = obj
+
     @property
     def callable(self):
         return self.__callable
@@ -537,6 +675,10 @@ class ExecutionFrame:
     def vm_state(self, state):
         self.__vm_current_state = state
 
+    @property
+    def stack(self):
+        return self.__stack
+
     def top(self):
         return self.__stack[-1]
 
@@ -557,23 +699,161 @@ class ExecutionFrame:
     def __str__(self):
         return str(self.__callable)
 
+# Handlers of the trap instructions patched over guest instructions. Tools don't wrap them, the instruction
+# a trap replaced runs through the instrumented table once the trap is done.
+TRAP_OPMETHODS = ("execute_BREAKPOINT",)
+
+class DispatchTable(dict):
+    """
+    Maps an opmethod name to the bound VM method implementing it. Built once per VM so the dispatch loop
+    does a single dict lookup instead of hasattr + getattr for every instruction.
+    """
+    def __init__(self, vm=None):
+        dict.__init__(self)
+        if vm is None:
+            return
+
+        for attr in dir(vm):
+            if attr.startswith("execute_") and attr[len("execute_"):len("execute_") + 1].isupper():
+                self[attr] = getattr(vm, attr)
+
+    def copy(self):
+        table = DispatchTable()
+        table.update(self)
+        return table
+
+    def instrument(self, wrap, opmethods=None):
+        """
+        Returns a copy of the table with the handlers of opmethods, all of them by default, replaced by
+        wrap(opmethod, handler).
+        """
+        if opmethods is None:
+            opmethods = [opmethod for opmethod in self if opmethod not in TRAP_OPMETHODS]
+
+        table = self.copy()
+        for opmethod in opmethods:
+            table[opmethod] = wrap(opmethod, self[opmethod])
+
+        return table
+
+    def __missing__(self, opmethod):
+        raise NotImplementedError("Method %s not found." % (opmethod))
+
+class RunResult:
+    def __init__(self, return_value, instructions, elapsed):
+        self.__return_value = return_value
+        self.__instructions = instructions
+        self.__elapsed = elapsed
+
+    @property
+    def return_value(self):
+        return self.__return_value
+
+    @property
+    def instructions(self):
+        return self.__instructions
+
+    @property
+    def elapsed(self):
+        return self.__elapsed
+
+    def __str__(self):
+        return "Return Value: %s, Instructions: %s, Elapsed: %.6fs" % (self.__return_value, self.__instructions, self.__elapsed)
+
 class BytecodeVM:
-    def __init__(self, code, source, filename):
+    def __init__(self, code, source, filename, code_cache=None):
+        self.__builtins = sys.modules['builtins'].__dict__
+        self.__custom_builtins = Builtins()
+        self.__config = VMConfig()
+
+        # These survive across runs so a warm VM doesn't decode the same code objects again. The code cache
+        # is immutable and can be shared with other VMs, the instruction streams are this VM's own copies.
+        self.__code_cache = code_cache if code_cache is not None else CodeCache()
+        # code_key -> instruction stream
+        self.__instruction_streams = {}
+        # id(code) -> (code, decoded code) and id(code) -> (code, instruction stream). Code objects don't cache
+        # their hash, so calls and frame switches look code up by identity and code_key is only computed the
+        # first time this VM sees a code object. Holding on to the code keeps its id from being reused.
+        self.__decoded_by_id = {}
+        self.__streams_by_id = {}
+        # (code_key, offset after the trapped instruction) -> (offset, original entry, callbacks)
+        self.__traps = {}
+        self.__hooks = Hooks(self, DispatchTable(self))
+        self.__line_profiler = None
+        self.__dispatch = self.__hooks.dispatch
+        self.__instruction_count = 0
+
+        # Set by the asyncio runner to a predicate like inspect.isawaitable. Builtins returning awaitables then
+        # suspend the VM instead of handing the awaitable to the guest
+        self.__awaitable_check = None
+        self.__pending_awaitable = None
+
+        self.reset(code, source, filename)
+
+    def reset(self, code, source, filename, globals=None):
+        """
+        Prepares the VM to execute a new module. The code cache and the dispatch table are kept.
+        """
         self.__code_object = code
 
         self.__module = Module("main_module")
         self.__module.code = code
 
-        self.__module_frame = ExecutionFrame(self.__module, globals = {}, args = [], kwargs={}, source=source, filename=filename)
+        if globals is None:
+            globals = {}
+
+        self.__module_frame = ExecutionFrame(self.__module, globals = globals, args = [], kwargs={}, source=source, filename=filename)
         self.__exec_frame = self.__module_frame
         self.__exec_frame_stack = []
-        self.__builtins = sys.modules['builtins'].__dict__
-        self.__custom_builtins = Builtins()
         self.__source = source
         self.__filename = filename
-        self.__config = None
         self.__BUILD_CLASS_STATE = False
 
+        # (generator, frame stack depth it was resumed at) for every generator currently executing
+        self.__running_generators = []
+
+        self.__scheduler = Scheduler(self)
+        self.__custom_builtins.add_func("spawn", self.__scheduler.spawn)
+        self.__custom_builtins.add_func("yield_thread", self.__scheduler.yield_thread)
+        self.__custom_builtins.add_func("Channel", self.__scheduler.channel)
+        self.__custom_builtins.add_func("sleep", self.__sleep)
+
+    def __sleep(self, seconds, result=None):
+        """
+        The guest's sleep builtin. Under the asyncio runner it returns asyncio.sleep for the event loop to
+        await while other tasks run, otherwise it blocks.
+        """
+        if self.__awaitable_check is not None:
+            import asyncio
+            return asyncio.sleep(seconds, result)
+
+        time.sleep(seconds)
+        return result
+
+    def run(self, code, globals=None, source=None, filename=None):
+        """
+        Executes a module code object to completion and returns a RunResult instead of exiting the process.
+        The VM can be reused for any number of runs.
+        """
+        if source is None:
+            source = []
+        if filename is None:
+            filename = code.co_filename
+
+        self.reset(code, source, filename, globals)
+
+        start_count = self.__instruction_count
+        start = time.perf_counter()
+        timeline = self.timeline
+        if timeline is None:
+            return_value = self.execute()
+        else:
+            with timeline.phase("execute", filename=filename):
+                return_value = self.execute()
+        elapsed = time.perf_counter() - start
+
+        return RunResult(return_value, self.__instruction_count - start_count, elapsed)
+
     @property
     def exec_frame(self):
         return self.__exec_frame
@@ -582,6 +862,42 @@ class BytecodeVM:
     def exec_frame_stack(self):
         return self.__exec_frame_stack
 
+    @property
+    def module_frame(self):
+        return self.__module_frame
+
+    @property
+    def code_cache(self):
+        return self.__code_cache
+
+    @property
+    def source(self):
+        return self.__source
+
+    @property
+    def filename(self):
+        return self.__filename
+
+    @property
+    def scheduler(self):
+        return self.__scheduler
+
+    @property
+    def in_generator(self):
+        return len(self.__running_generators) > 0
+
+    @property
+    def awaitable_check(self):
+        return self.__awaitable_check
+
+    @awaitable_check.setter
+    def awaitable_check(self, check):
+        self.__awaitable_check = check
+
+    @property
+    def instruction_count(self):
+        return self.__instruction_count
+
     @property
     def config(self):
         return self.__config
@@ -590,6 +906,185 @@ class BytecodeVM:
     def config(self, conf):
         self.__config = conf
 
+    @property
+    def hooks(self):
+        """
+        Event callbacks and tools hooked into the dispatch table, see src.hooks.
+        """
+        return self.__hooks
+
+    @property
+    def opcode_profiler(self):
+        return self.__hooks.tool("opcode_profiler")
+
+    @opcode_profiler.setter
+    def opcode_profiler(self, profiler):
+        self.__hooks.use_tool("opcode_profiler", profiler)
+
+    @property
+    def line_profiler(self):
+        return self.__line_profiler
+
+    @line_profiler.setter
+    def line_profiler(self, profiler):
+        # Subscribes to line events instead of wrapping the dispatch table like the other profilers
+        if self.__line_profiler is not None:
+            self.__line_profiler.stop()
+        self.__line_profiler = profiler
+        if profiler is not None:
+            profiler.start(self)
+
+    @property
+    def call_profiler(self):
+        return self.__hooks.tool("call_profiler")
+
+    @call_profiler.setter
+    def call_profiler(self, profiler):
+        self.__hooks.use_tool("call_profiler", profiler)
+
+    @property
+    def tracer(self):
+        return self.__hooks.tool("tracer")
+
+    @tracer.setter
+    def tracer(self, tracer):
+        self.__hooks.use_tool("tracer", tracer)
+
+    @property
+    def timeline(self):
+        """
+        Records guest calls, class builds, code decoding and runs, see src.chrome_trace.
+        """
+        return self.__hooks.tool("timeline")
+
+    @timeline.setter
+    def timeline(self, timeline):
+        self.__hooks.use_tool("timeline", timeline)
+
+    def instructions_for(self, code):
+        """
+        Returns this VM's instruction stream for a code object. It starts out as a copy of the shared decoded
+        stream and is the place for per VM state: inline caches and patched instructions are written into it
+        without affecting other VMs sharing the code cache. With VMConfig.specialize the typed handlers the
+        inference pass picked are put in before the code first runs.
+        """
+        entry = self.__streams_by_id.get(id(code))
+        if entry is not None:
+            return entry[1]
+
+        key = code_key(code)
+        instructions = self.__instruction_streams.get(key)
+        if instructions is None:
+            # Timed here rather than in the shared code cache so each VM records its own timeline
+            timeline = self.timeline
+            if timeline is None:
+                instructions = list(self.decoded(code).instructions)
+            else:
+                with timeline.phase("decode", code=code.co_name):
+                    instructions = list(self.decoded(code).instructions)
+            if self.__config.specialize:
+                from src.inference import infer_types
+                for offset, opmethod in infer_types(code, code is self.__code_object).specializations.items():
+                    instructions[offset] = (opmethod,) + instructions[offset][1:]
+            self.__instruction_streams[key] = instructions
+
+        self.__streams_by_id[id(code)] = (code, instructions)
+        return instructions
+
+    def decoded(self, code):
+        """
+        Returns the shared DecodedCode of a code object, looked up by identity after the first time.
+        """
+        entry = self.__decoded_by_id.get(id(code))
+        if entry is None:
+            entry = self.__decoded_by_id[id(code)] = (code, self.__code_cache.decode(code))
+        return entry[1]
+
+    def set_trap(self, code, offset, callback):
+        """
+        Patches a trap over the instruction at offset in this VM's stream for code. Every time it's about
+        to execute callback(exec_frame, offset) is called first, nothing else is slowed down. Any number of
+        callbacks can share a trap.
+        """
+        instructions = self.instructions_for(code)
+        original = instructions[offset]
+        if original is None:
+            raise Exception("No instruction starts at offset %s of %s" % (offset, code.co_name))
+
+        # The trap keeps the original's size, so the dispatch loop moves past the trap just like past the
+        # instruction and the trap finds itself by the offset the loop moved to
+        key = (code_key(code), offset + original[2])
+        trap = self.__traps.get(key)
+        if trap is None:
+            self.__traps[key] = (offset, original, (callback,))
+            instructions[offset] = ("execute_BREAKPOINT", None, original[2])
+        elif callback not in trap[2]:
+            self.__traps[key] = (offset, trap[1], trap[2] + (callback,))
+
+    def clear_trap(self, code, offset, callback=None):
+        """
+        Removes callback, all of them by default, from the trap at offset. The original instruction is put
+        back once no callback is left.
+        """
+        instructions = self.instructions_for(code)
+        key = (code_key(code), offset + instructions[offset][2])
+        trap = self.__traps.get(key)
+        if trap is None:
+            return
+
+        callbacks = tuple(c for c in trap[2] if callback is not None and c != callback)
+        if callbacks:
+            self.__traps[key] = (offset, trap[1], callbacks)
+        else:
+            del self.__traps[key]
+            instructions[offset] = trap[1]
+
+    def new_frame(self, callable, args, kwargs):
+        """
+        Creates the frame for calling a guest function from the host side.
+        """
+        if not isinstance(callable, Function):
+            raise TypeError("%s is not a guest function" % callable)
+
+        binding_plan = self.decoded(callable.code).binding_plan
+        return ExecutionFrame(callable, self.__module_frame.globals, args, kwargs, source=self.__source, filename=self.__filename, binding_plan=binding_plan)
+
+    def call_function(self, fn, args, kwargs=None):
+        """
+        Calls a guest function from the host and returns its result.
+        """
+        if kwargs is None:
+            kwargs = {}
+
+        exec_frame = self.new_frame(fn, args, kwargs)
+        if exec_frame.code.co_flags & CO_GENERATOR:
+            return Generator(self, exec_frame)
+
+        self.__exec_frame_stack.append(self.__exec_frame)
+        self.__exec_frame = exec_frame
+        self.execute()
+        return self.__exec_frame.pop()
+
+    def parallel_map(self, func_name, iterable, processes=None, chunksize=None):
+        """
+        Maps the guest function func_name over iterable on a pool of worker processes. See
+        src.parallel.parallel_map.
+        """
+        # multiprocessing is only needed by programs that use this
+        from src.parallel import parallel_map
+
+        return parallel_map(self, func_name, iterable, processes, chunksize)
+
+    def vmap(self, func_name, *args, **kwargs):
+        """
+        Applies the guest function func_name elementwise to numpy arrays, vectorizing its bytecode when it
+        can. See src.vmap.vmap.
+        """
+        # numpy is optional, only programs that use this need it
+        from src.vmap import vmap
+
+        return vmap(self, func_name, *args, **kwargs)
+
     def print_members(self):
         co_methods = [method for method in dir(self.__code_object) if method.startswith("co_")]
 
@@ -601,29 +1096,19 @@ class BytecodeVM:
     def get_opcode(self):
         # Based on the settings decide to show the line-by-line trace
         # Get the current line being executed
-        current_lineno = self.__exec_frame.line_no_obj.line_number(self.__exec_frame.ip)
-
+        code = self.__exec_frame.code
         ip = self.__exec_frame.ip
-            # Update the line number only if the currently executing line has changed.
-        if self.__exec_frame.line_no_obj.currently_executing_line is None or \
-            self.__exec_frame.line_no_obj.currently_executing_line != current_lineno:
-            self.__exec_frame.line_no_obj.currently_executing_line = current_lineno
+        current_lineno = self.decoded(code).lines[ip]
+
+        # Update the line number only if the currently executing line has changed.
+        if self.__exec_frame.line_no_obj.currently_executing_line != current_lineno:
             self.__exec_frame.line_no_obj.currently_executing_line = current_lineno
 
         if self.__config.show_line_execution:
             current_line = self.__exec_frame.line_no_obj.get_source_line(current_lineno)
             print("Execution Line: %s" % current_line)
 
-        op = self.__exec_frame.program[self.__exec_frame.ip]
-        ip += 1
-        opmethod = "execute_%s" % dis.opname[op]
-
-        oparg = None
-        if op >= dis.HAVE_ARGUMENT:
-            low = self.__exec_frame.program[ip]
-            high = self.__exec_frame.program[ip + 1]
-            oparg = (high << 8) | low
-
+        opmethod, oparg, size = self.instructions_for(code)[ip]
         return opmethod, oparg, current_lineno
 
     def execute_opcode(self, opmethod, oparg):
@@ -632,13 +1117,11 @@ class BytecodeVM:
         if oparg is not None:
             self.__exec_frame.ip += 2
 
-        if (hasattr(self, opmethod)):
-            if oparg is not None:
-                terminate = getattr(self, opmethod)(oparg)
-            else:
-                terminate = getattr(self, opmethod)()
+        self.__instruction_count += 1
+        if oparg is not None:
+            terminate = self.__dispatch[opmethod](oparg)
         else:
-            raise NotImplementedError("Method %s not found." % (opmethod))
+            terminate = self.__dispatch[opmethod]()
 
         return terminate
 
@@ -651,20 +1134,236 @@ class BytecodeVM:
         return terminate, current_lineno
 
     def execute(self, config=None):
+        """
+        Runs the current frame until it returns. Returns the program's return value when the module frame
+        finishes and None when a function frame finishes.
+        """
         if config is not None:
             self.__config = config
 
+        # Calls don't recurse into execute, they push a frame and the loop carries on. This invocation is done
+        # once the frame it started with returns or yields, which drops the frame stack below this depth.
+        return self.__run(len(self.__exec_frame_stack))
+
+    def resume(self):
+        """
+        Runs the program on from the executing frame to its end, however deep the frame stack is. Used once
+        restore_frame put the VM back at an earlier point of the program.
+        """
+        return self.__run(0)
+
+    def restore_frame(self, exec_frame, instruction_count):
+        """
+        Makes exec_frame the executing frame and sets the instruction counter. The frame stack and the frames
+        themselves are restored by the caller, in place.
+        """
+        self.__exec_frame = exec_frame
+        self.__instruction_count = instruction_count
+
+    def __run(self, entry_depth):
+        if self.__config.show_line_execution:
+            while True:
+                terminate, current_lineno = self.execute_next_instruction()
+                if terminate is not None:
+                    if terminate == TerminateStates.TERMINATE_PROGRAM:
+                        return self.__finish_program(entry_depth)
+                    elif terminate == TerminateStates.TERMINATE_SWITCH and entry_depth == 0:
+                        return self.__execute_scheduled()
+                    elif len(self.__exec_frame_stack) < entry_depth:
+                        return
+
+        # Fast path: decode lookups only happen when the executing frame changes
+        dispatch = self.__dispatch
+        exec_frame = None
+        instructions = None
         while True:
-            terminate, current_lineno = self.execute_next_instruction()
-            if terminate == TerminateStates.TERMINATE_PROGRAM:
-                print("Program Terminated:")
-                return_val = self.__exec_frame.pop()
-                print("Program Return Value: %s" % return_val)
-                sys.exit(return_val)
-            elif terminate == TerminateStates.TERMINATE_FUNCTION:
-                return
+            if self.__exec_frame is not exec_frame:
+                exec_frame = self.__exec_frame
+                instructions = self.instructions_for(exec_frame.code)
+
+            ip = exec_frame.ip
+            opmethod, oparg, size = instructions[ip]
+            exec_frame.ip = ip + size
+
+            self.__instruction_count += 1
+            if oparg is not None:
+                terminate = dispatch[opmethod](oparg)
+            else:
+                terminate = dispatch[opmethod]()
+
+            if terminate is not None:
+                if terminate == TerminateStates.TERMINATE_PROGRAM:
+                    return self.__finish_program(entry_depth)
+                elif terminate == TerminateStates.TERMINATE_SWITCH and entry_depth == 0:
+                    # The program started green threads, from here on the scheduled loop runs everything
+                    return self.__execute_scheduled()
+                elif len(self.__exec_frame_stack) < entry_depth:
+                    return
+
+    def execute_slice(self, budget):
+        """
+        Runs at most budget instructions of the program and returns (state, value):
+            (TERMINATE_PROGRAM, return value) when the program finished
+            (TERMINATE_AWAIT, awaitable) when a builtin returned an awaitable. The call's result has to be
+                                         handed back with complete_await before the next slice
+            (None, None) when the budget ran out
+        Used by the asyncio runner to interleave guest programs with the event loop.
+        """
+        dispatch = self.__dispatch
+
+        exec_frame = None
+        remaining = budget
+        while remaining:
+            remaining -= 1
+            if self.__exec_frame is not exec_frame:
+                exec_frame = self.__exec_frame
+                instructions = self.instructions_for(exec_frame.code)
+
+            ip = exec_frame.ip
+            opmethod, oparg, size = instructions[ip]
+            exec_frame.ip = ip + size
+
+            if oparg is not None:
+                terminate = dispatch[opmethod](oparg)
             else:
-                pass
+                terminate = dispatch[opmethod]()
+
+            if terminate is not None:
+                if terminate == TerminateStates.TERMINATE_PROGRAM:
+                    self.__instruction_count += budget - remaining
+                    return terminate, self.__exec_frame.pop()
+                elif terminate == TerminateStates.TERMINATE_AWAIT:
+                    self.__instruction_count += budget - remaining
+                    awaitable = self.__pending_awaitable
+                    self.__pending_awaitable = None
+                    return terminate, awaitable
+                elif terminate == TerminateStates.TERMINATE_SWITCH:
+                    raise RuntimeError("Green threads can't be used with sliced execution")
+
+        self.__instruction_count += budget
+        return None, None
+
+    def complete_await(self, value):
+        """
+        Replaces the placeholder result of the call that returned an awaitable with what it resolved to.
+        """
+        self.__exec_frame.pop()
+        self.__exec_frame.append(value)
+
+    def __finish_program(self, entry_depth):
+        return_val = self.__exec_frame.pop()
+        if entry_depth == 0 and self.__scheduler.pending:
+            # Green threads spawned from inside a generator never got to run, the main thread is done but
+            # they still have to
+            self.__scheduler.finish(self.__scheduler.current, return_val)
+            return self.__execute_scheduled()
+
+        return return_val
+
+    def __execute_scheduled(self):
+        """
+        Dispatch loop used once green threads exist. Runs each runnable thread for up to green_thread_budget
+        instructions, or until it blocks or yields, then moves on to the next one round robin.
+        """
+        scheduler = self.__scheduler
+        dispatch = self.__dispatch
+        slice_budget = self.__config.green_thread_budget
+
+        thread = scheduler.current
+        thread.save(self.__exec_frame, self.__exec_frame_stack)
+        scheduler.requeue(thread)
+
+        while True:
+            thread = scheduler.next_thread()
+            if thread is None:
+                main_thread = scheduler.main_thread
+                self.__exec_frame = main_thread.exec_frame
+                self.__exec_frame_stack = main_thread.exec_frame_stack
+                return main_thread.result
+
+            self.__exec_frame = thread.exec_frame
+            self.__exec_frame_stack = thread.exec_frame_stack
+
+            exec_frame = None
+            budget = slice_budget
+            while budget:
+                budget -= 1
+                if self.__exec_frame is not exec_frame:
+                    exec_frame = self.__exec_frame
+                    instructions = self.instructions_for(exec_frame.code)
+
+                ip = exec_frame.ip
+                opmethod, oparg, size = instructions[ip]
+                exec_frame.ip = ip + size
+
+                if oparg is not None:
+                    terminate = dispatch[opmethod](oparg)
+                else:
+                    terminate = dispatch[opmethod]()
+
+                if terminate is not None:
+                    if terminate == TerminateStates.TERMINATE_PROGRAM:
+                        # The thread's first frame returned
+                        scheduler.finish(thread, self.__exec_frame.pop())
+                        break
+                    elif terminate == TerminateStates.TERMINATE_SWITCH:
+                        break
+
+            self.__instruction_count += slice_budget - budget
+            thread.save(self.__exec_frame, self.__exec_frame_stack)
+            scheduler.requeue(thread)
+
+    def resume_generator(self, generator, value):
+        """
+        Runs a suspended generator until it yields or returns. Called from the host side of the generator
+        protocol (next(), send(), FOR_ITER) so it runs a nested execute for just the generator's frames.
+        """
+        if generator.running:
+            raise ValueError("generator already executing")
+
+        caller_frame = self.__exec_frame
+        frames = generator.suspended_frames
+        was_started = generator.started
+
+        self.__exec_frame_stack.append(caller_frame)
+        entry_depth = len(self.__exec_frame_stack)
+        self.__exec_frame_stack.extend(frames[:-1])
+        self.__exec_frame = frames[-1]
+
+        # The value sent in is the result of the yield expression the generator is suspended at
+        if was_started:
+            self.__exec_frame.append(value)
+
+        generator.start()
+        self.__running_generators.append((generator, entry_depth))
+        try:
+            self.execute()
+        except BaseException as e:
+            # Drop whatever is left of the generator's frames and give control back to the caller
+            del self.__exec_frame_stack[entry_depth - 1:]
+            self.__exec_frame = caller_frame
+            generator.finish()
+            if isinstance(e, StopIteration):
+                raise RuntimeError("generator raised StopIteration")
+            raise
+        finally:
+            self.__running_generators.pop()
+
+        if generator.finished:
+            raise StopIteration(generator.return_value)
+
+        return generator.yielded_value
+
+    def __yield(self, value):
+        generator, entry_depth = self.__running_generators[-1]
+
+        frames = self.__exec_frame_stack[entry_depth:]
+        frames.append(self.__exec_frame)
+        del self.__exec_frame_stack[entry_depth:]
+        self.__exec_frame = self.__exec_frame_stack.pop()
+
+        generator.suspend(frames, value)
+        return TerminateStates.TERMINATE_YIELD
 
     def __jump(self, target):
         self.__exec_frame.ip = target
@@ -726,25 +1425,25 @@ class BytecodeVM:
         x = self.__exec_frame.pop()
         self.__exec_frame.append(lambda_op(x))
 
-    def execute_UNARY_POSITIVE(self, oparg):
+    def execute_UNARY_POSITIVE(self):
         """
         Implements TOS = +TOS.
         """
         self.__execute_unary('+')
 
-    def execute_UNARY_NEGATIVE(self, oparg):
+    def execute_UNARY_NEGATIVE(self):
         """
         Implements TOS = -TOS.
         """
         self.__execute_unary('-')
 
-    def execute_UNARY_NOT(self, oparg):
+    def execute_UNARY_NOT(self):
         """
         Implements TOS = not TOS.
         """
         self.__execute_unary('!')
 
-    def execute_UNARY_INVERT(self, oparg):
+    def execute_UNARY_INVERT(self):
         """
         Implements TOS = ~TOS.
         """
@@ -766,7 +1465,7 @@ class BytecodeVM:
         v = self.__exec_frame.pop()
         self.__exec_frame.append(lambda_op(v, w))
 
-    def execute_BINARY_POWER(self, oparg):
+    def execute_BINARY_POWER(self):
         """
         Implements TOS = TOS1 ** TOS.
         """
@@ -779,14 +1478,14 @@ class BytecodeVM:
         self.execute_binary_op('*')
 
 
-    def execute_BINARY_FLOOR_DIVIDE(self, oparg):
+    def execute_BINARY_FLOOR_DIVIDE(self):
         """
         Implements TOS = TOS1 // TOS.
         """
         self.execute_binary_op('//')
 
 
-    def execute_BINARY_TRUE_DIVIDE(self, oparg):
+    def execute_BINARY_TRUE_DIVIDE(self):
         """
         Implements TOS = TOS1 / TOS.
         """
@@ -945,6 +1644,46 @@ class BytecodeVM:
         """
         self.execute_binary_op("|")
 
+    # Typed handlers
+    # With VMConfig.specialize, instructions_for puts these in place of binary, in-place and compare operations
+    # whose operands src.inference proved to be ints, floats or strs. The host operator then gives what the
+    # generic handler would, so they apply it to the stack directly.
+
+    def execute_BINARY_ADD_TYPED(self):
+        stack = self.__exec_frame.stack
+        w = stack.pop()
+        stack[-1] = stack[-1] + w
+
+    def execute_BINARY_SUBTRACT_TYPED(self):
+        stack = self.__exec_frame.stack
+        w = stack.pop()
+        stack[-1] = stack[-1] - w
+
+    def execute_BINARY_MULTIPLY_TYPED(self):
+        stack = self.__exec_frame.stack
+        w = stack.pop()
+        stack[-1] = stack[-1] * w
+
+    def execute_BINARY_TRUE_DIVIDE_TYPED(self):
+        stack = self.__exec_frame.stack
+        w = stack.pop()
+        stack[-1] = stack[-1] / w
+
+    def execute_BINARY_FLOOR_DIVIDE_TYPED(self):
+        stack = self.__exec_frame.stack
+        w = stack.pop()
+        stack[-1] = stack[-1] // w
+
+    def execute_BINARY_MODULO_TYPED(self):
+        stack = self.__exec_frame.stack
+        w = stack.pop()
+        stack[-1] = stack[-1] % w
+
+    def execute_COMPARE_OP_TYPED(self, compare_op):
+        stack = self.__exec_frame.stack
+        w = stack.pop()
+        stack[-1] = COMPARE_OPERATORS[compare_op](stack[-1], w)
+
 
     def execute_STORE_SUBSCR(self):
         """
@@ -954,7 +1693,6 @@ class BytecodeVM:
         obj = self.__exec_frame.pop()
         val = self.__exec_frame.pop()
         obj[key] = val
-        self.__exec_frame.append(obj)
 
 
     def execute_DELETE_SUBSCR(self, oparg):
@@ -1018,37 +1756,60 @@ class BytecodeVM:
         """
         Returns with TOS to the caller of the function.
         """
-        terminate = False
         return_val = self.__exec_frame.top()
 
-        prev_exec_ctx = None
-        if len(self.__exec_frame_stack) > 0:
-            prev_exec_ctx = self.__exec_frame_stack.pop()
-
-        if prev_exec_ctx is not None:
-            self.__exec_frame = prev_exec_ctx
-
-        self.__exec_frame.append(return_val)
-
-        if prev_exec_ctx == None:
-            terminate = TerminateStates.TERMINATE_PROGRAM
+        # Returning from inside a loop leaves the loop blocks as well
+        returning_frame = self.__exec_frame
+        while isinstance(returning_frame.callable, Block) and len(self.__exec_frame_stack) > 0:
+            returning_frame = self.__exec_frame_stack.pop()
+
+        if len(self.__exec_frame_stack) == 0:
+            self.__exec_frame = returning_frame
+            self.__exec_frame.append(return_val)
+            return TerminateStates.TERMINATE_PROGRAM
+
+        self.__exec_frame = self.__exec_frame_stack.pop()
+
+        if returning_frame.generator is not None:
+            # The return value of a generator travels in StopIteration, nothing goes on the caller's stack
+            returning_frame.generator.finish(return_val)
+        elif returning_frame.constructed_object is not None:
+            # Init functions cannot return anything. They will return just NONE. However, the class object needs
+            # to be assigned to the caller.
+            self.__exec_frame.append(returning_frame.constructed_object)
         else:
-            terminate = TerminateStates.TERMINATE_FUNCTION
+            self.__exec_frame.append(return_val)
 
-        return terminate
+        return TerminateStates.TERMINATE_FUNCTION
 
     def execute_YIELD_VALUE(self):
         """
         Pops TOS and yields it from a generator.
         """
-        raise NotImplementedError("Method %s not implemented" % sys._getframe().f_code.co_name)
+        return self.__yield(self.__exec_frame.pop())
 
 
     def execute_YIELD_FROM(self):
         """
         Pops TOS and delegates to it as a subiterator from a generator.
         """
-        raise NotImplementedError("Method %s not implemented" % sys._getframe().f_code.co_name)
+        value = self.__exec_frame.pop()
+        receiver = self.__exec_frame.top()
+
+        try:
+            if value is None:
+                result = next(receiver)
+            else:
+                result = receiver.send(value)
+        except StopIteration as e:
+            # The subiterator is exhausted, its return value is the value of the yield from expression
+            self.__exec_frame.pop()
+            self.__exec_frame.append(e.value)
+            return
+
+        # Point back at this instruction so the value sent in on resume goes on to the subiterator
+        self.__exec_frame.ip -= 1
+        return self.__yield(result)
 
 
     # New in version 3.3.
@@ -1088,6 +1849,22 @@ class BytecodeVM:
         raise NotImplementedError("Method %s not implemented" % sys._getframe().f_code.co_name)
 
 
+    def execute_BREAKPOINT(self):
+        """
+        Not a CPython opcode. Patched over an instruction by set_trap: calls the trap's callbacks, then
+        executes the instruction it replaced.
+        """
+        exec_frame = self.__exec_frame
+        offset, original, callbacks = self.__traps[(code_key(exec_frame.code), exec_frame.ip)]
+        for callback in callbacks:
+            callback(exec_frame, offset)
+
+        opmethod, oparg, size = original
+        if oparg is not None:
+            return self.__dispatch[opmethod](oparg)
+        else:
+            return self.__dispatch[opmethod]()
+
     def execute_LOAD_BUILD_CLASS(self):
         """
         Pushes builtins.__build_class__() onto the stack. It is later called by CALL_FUNCTION to construct a class.
@@ -1221,9 +1998,7 @@ class BytecodeVM:
         """
         Works as BUILD_TUPLE, but creates a list.
         """
-        if count == 0:
-            var = []
-            self.__exec_frame.append(var)
+        self.__exec_frame.append(list(self.__exec_frame.popn(count)) if count else [])
 
 
     def execute_BUILD_SET(self, count):
@@ -1349,6 +2124,10 @@ class BytecodeVM:
         """
         name = self.__exec_frame.names[namei]
         global_v = self.__exec_frame.get_global(name)
+        if global_v is None:
+            # VM provided builtins (green threads, channels)
+            global_v = self.__custom_builtins.funcs.get(name)
+
         if global_v is None:
             # Check if the global is a builtin
             if name in self.__builtins:
@@ -1508,39 +2287,53 @@ class BytecodeVM:
             self.__exec_frame.append(callable)
             result = callable(*args)
             self.__exec_frame.pop()
+
+            if type(result) is ThreadSwitch:
+                # A scheduling builtin (spawn, yield_thread, Channel.recv, ...) wants the green thread switched
+                self.__exec_frame.append(result.result)
+                return TerminateStates.TERMINATE_SWITCH
+
+            if self.__awaitable_check is not None and self.__awaitable_check(result):
+                # Running under the asyncio runner: suspend and let the event loop resolve the awaitable
+                if self.in_generator:
+                    raise RuntimeError("Can't await %s while a generator is executing" % callable)
+
+                self.__pending_awaitable = result
+                self.__exec_frame.append(None)
+                return TerminateStates.TERMINATE_AWAIT
+
             self.__exec_frame.append(result)
             return
 
-        BUILD_CLASS = False
         if isinstance(callable, ClassImpl):
             # if the callable is the constructor of the class, then add the constructor to the top
             class_obj = callable
             callable = self.__exec_frame.pop()
 
-            func_name = callable.name
-            if func_name == "__init__":
-                BUILD_CLASS = True
-
             exec_frame = getattr(class_obj, class_exec_frame_attr)
             exec_frame.set_args(args)
             exec_frame.set_kwargs(kwargs)
             exec_frame.callable = callable
 
+            if callable.name == "__init__":
+                exec_frame.constructed_object = class_obj
+            else:
+                exec_frame.constructed_object = None
+
             # Reset the IP
             exec_frame.ip = 0
         else:
-            exec_frame = ExecutionFrame(callable, self.__exec_frame.globals, args, kwargs, source=self.__source, filename=self.__filename)
-        self.__exec_frame_stack.append(self.__exec_frame)
-        self.__exec_frame = exec_frame
+            binding_plan = self.decoded(callable.code).binding_plan
+            exec_frame = ExecutionFrame(callable, self.__exec_frame.globals, args, kwargs, source=self.__source, filename=self.__filename, binding_plan=binding_plan)
 
-        self.execute()
+        if exec_frame.code.co_flags & CO_GENERATOR:
+            # Calling a generator function only creates the generator, its frame runs on the first resume
+            self.__exec_frame.append(Generator(self, exec_frame))
+            return
 
-        if BUILD_CLASS == True:
-            # Init Function must have been called.
-            # Init functions cannot return anything. They will return just NONE. However, the class object needs to be
-            # assigned to the caller. So we will pop the stack for the NONE value and push the class object into the stack.
-            self.__exec_frame.pop()
-            self.__exec_frame.append(class_obj)
+        # No recursion into execute: the dispatch loop carries on in the new frame and RETURN_VALUE pops back
+        self.__exec_frame_stack.append(self.__exec_frame)
+        self.__exec_frame = exec_frame
 
     def execute_MAKE_FUNCTION(self, argc):
         """
@@ -1568,8 +2361,7 @@ class BytecodeVM:
             self.__exec_frame.vm_state = VMState.BUILD_FUNC
 
         if self.__config.show_disassembly:
-            draw_header("FUNCTION CODE: %s" % name)
-            dis.dis(code)
+            draw_disassembly("FUNCTION CODE: %s" % name, code)
 
     def execute_MAKE_CLOSURE(self, argc):
         """
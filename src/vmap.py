@@ -0,0 +1,366 @@
+"""
+The MIT License (MIT)
+
+Copyright (c) <2015> <sarangis>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+# Vectorized execution of numeric guest functions. Instead of running the function once per input, its
+# bytecode is interpreted once with numpy arrays on the stack and in the locals, so every instruction works
+# on all the inputs at the same time. A conditional jump on an array forks the execution: each side carries
+# the mask of the inputs that took it, and the values the paths return are merged with their masks.
+#
+# Functions with loops, calls or any opcode the vectorizer doesn't know, and inputs that would hit a Python
+# error or int overflow on the way, fall back to calling the function on every input in the VM.
+
+import numbers
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from src.vm import Function, CO_GENERATOR, BINARY_OPERATORS, UNARY_OPERATORS, COMPARE_OPERATORS
+
+# The VM operator and the numpy ufunc standing in for each binary opcode. The in-place forms behave the
+# same on immutable numbers.
+BINARY_UFUNCS = {
+    "ADD":          ("+", "add"),
+    "SUBTRACT":     ("-", "subtract"),
+    "MULTIPLY":     ("*", "multiply"),
+    "TRUE_DIVIDE":  ("/", "true_divide"),
+    "FLOOR_DIVIDE": ("//", "floor_divide"),
+    "MODULO":       ("%", "remainder"),
+    "POWER":        ("**", "power"),
+    "LSHIFT":       ("<<", "left_shift"),
+    "RSHIFT":       (">>", "right_shift"),
+    "AND":          ("&", "bitwise_and"),
+    "OR":           ("|", "bitwise_or"),
+    "XOR":          ("^", "bitwise_xor"),
+}
+
+UNARY_UFUNCS = {
+    "execute_UNARY_POSITIVE": ("+", "positive"),
+    "execute_UNARY_NEGATIVE": ("-", "negative"),
+    "execute_UNARY_INVERT":   ("~", "invert"),
+    "execute_UNARY_NOT":      ("!", "logical_not"),
+}
+
+# Indexed like COMPARE_OPERATORS in src.vm, only the ordering comparisons vectorize
+COMPARE_UFUNCS = ["less", "less_equal", "equal", "not_equal", "greater", "greater_equal"]
+
+# Python raises on a zero divisor where numpy quietly produces inf or 0
+DIVISIONS = ("true_divide", "floor_divide", "remainder")
+
+# Python ints grow without bound, int64 wraps around. Results past this are left to the VM.
+INT_LIMIT = 2.0 ** 62
+
+def is_array(x):
+    return isinstance(x, (numpy.ndarray, numpy.generic))
+
+class Unvectorizable(Exception):
+    """
+    Raised when a function, or a particular set of inputs, can't be executed with arrays.
+    """
+    pass
+
+class VectorPath:
+    """
+    One way through the function: its position, stack and locals, and the mask of the inputs taking it.
+    """
+    __slots__ = ("ip", "stack", "locals", "mask")
+
+    def __init__(self, ip, stack, locals, mask):
+        self.ip = ip
+        self.stack = stack
+        self.locals = locals
+        self.mask = mask
+
+    def fork(self, ip, stack, mask):
+        return VectorPath(ip, stack, dict(self.locals), mask)
+
+class Vectorizer:
+    """
+    Interprets the bytecode of one guest function over arrays of inputs.
+    """
+    def __init__(self, vm, fn, max_paths=64):
+        if numpy is None:
+            raise ImportError("vmap needs numpy, install it with: pip install numpy")
+
+        if not isinstance(fn, Function):
+            raise TypeError("%s is not a guest function" % fn)
+
+        self.__vm = vm
+        self.__fn = fn
+        self.__code = fn.code
+        self.__decoded = vm.code_cache.decode(fn.code)
+        self.__max_paths = max_paths
+
+    @property
+    def function(self):
+        return self.__fn
+
+    def run(self, args):
+        """
+        Returns fn applied to the broadcast args as one array. Raises Unvectorizable when the function or
+        these inputs need the VM.
+        """
+        if self.__code.co_flags & CO_GENERATOR:
+            raise Unvectorizable("%s is a generator" % self.__fn)
+
+        arrays = numpy.broadcast_arrays(*[numpy.asarray(arg) for arg in args])
+        for array in arrays:
+            if array.dtype.kind not in "biufc":
+                raise Unvectorizable("Inputs of dtype %s are not numeric" % array.dtype)
+
+        shape = arrays[0].shape if arrays else ()
+        locals = {}
+        self.__decoded.binding_plan.bind(locals, self.__fn.defaults, arrays, {})
+
+        paths = [VectorPath(0, [], locals, numpy.ones(shape, dtype=bool))]
+        num_paths = 1
+        results = []
+
+        with numpy.errstate(all="ignore"):
+            while paths:
+                path = paths.pop()
+                forked = self.__run_path(path, results)
+                num_paths += len(forked)
+                if num_paths > self.__max_paths:
+                    raise Unvectorizable("More than %s paths through %s" % (self.__max_paths, self.__fn))
+
+                paths.extend(forked)
+
+        return self.__merge(shape, results)
+
+    def __merge(self, shape, results):
+        values = [value for mask, value in results]
+        for value in values:
+            if not isinstance(value, (numbers.Number, numpy.ndarray, numpy.generic)):
+                raise Unvectorizable("%s returns %s" % (self.__fn, type(value).__name__))
+
+        out = numpy.empty(shape, dtype=numpy.result_type(*values))
+        for mask, value in results:
+            numpy.copyto(out, value, where=mask)
+
+        return out
+
+    def __run_path(self, path, results):
+        """
+        Runs path until it returns or forks. Returns the paths it forked into.
+        """
+        instructions = self.__decoded.instructions
+        while True:
+            opmethod, oparg, size = instructions[path.ip]
+            ip = path.ip
+            path.ip += size
+            stack = path.stack
+            op = opmethod[len("execute_"):]
+
+            if opmethod == "execute_LOAD_FAST":
+                name = self.__code.co_varnames[oparg]
+                if name not in path.locals:
+                    raise Unvectorizable("Local %s read before assignment" % name)
+                stack.append(path.locals[name])
+            elif opmethod == "execute_STORE_FAST":
+                path.locals[self.__code.co_varnames[oparg]] = stack.pop()
+            elif opmethod == "execute_LOAD_CONST":
+                stack.append(self.__code.co_consts[oparg])
+            elif opmethod == "execute_LOAD_GLOBAL":
+                stack.append(self.__load_global(self.__code.co_names[oparg]))
+            elif op.startswith("BINARY_") or op.startswith("INPLACE_"):
+                w = stack.pop()
+                v = stack.pop()
+                stack.append(self.__binary(op.split("_", 1)[1], v, w, path.mask))
+            elif opmethod in UNARY_UFUNCS:
+                symbol, ufunc_name = UNARY_UFUNCS[opmethod]
+                stack.append(self.__apply(UNARY_OPERATORS[symbol], ufunc_name, stack.pop()))
+            elif opmethod == "execute_COMPARE_OP":
+                if oparg >= len(COMPARE_UFUNCS):
+                    raise Unvectorizable("Compare op %s" % oparg)
+                w = stack.pop()
+                v = stack.pop()
+                stack.append(self.__apply(COMPARE_OPERATORS[oparg], COMPARE_UFUNCS[oparg], v, w))
+            elif opmethod == "execute_POP_TOP":
+                stack.pop()
+            elif opmethod == "execute_DUP_TOP":
+                stack.append(stack[-1])
+            elif opmethod == "execute_ROT_TWO":
+                stack[-1], stack[-2] = stack[-2], stack[-1]
+            elif opmethod == "execute_ROT_THREE":
+                stack[-1], stack[-2], stack[-3] = stack[-2], stack[-3], stack[-1]
+            elif opmethod == "execute_NOP":
+                pass
+            elif opmethod == "execute_JUMP_FORWARD":
+                path.ip += oparg
+            elif opmethod == "execute_JUMP_ABSOLUTE":
+                if oparg <= ip:
+                    raise Unvectorizable("%s loops" % self.__fn)
+                path.ip = oparg
+            elif opmethod in ("execute_POP_JUMP_IF_TRUE", "execute_POP_JUMP_IF_FALSE"):
+                cond = stack.pop()
+                forked = self.__branch(path, oparg, cond, op.endswith("TRUE"), False)
+                if forked is not None:
+                    return forked
+            elif opmethod in ("execute_JUMP_IF_TRUE_OR_POP", "execute_JUMP_IF_FALSE_OR_POP"):
+                forked = self.__branch(path, oparg, stack[-1], op.startswith("JUMP_IF_TRUE"), True)
+                if forked is not None:
+                    return forked
+            elif opmethod == "execute_RETURN_VALUE":
+                results.append((path.mask, stack.pop()))
+                return []
+            else:
+                raise Unvectorizable("%s is not vectorized" % op)
+
+    def __branch(self, path, target, cond, jump_if, keep_on_jump):
+        """
+        Conditional jump on cond. A scalar condition just picks a side. An array condition splits the mask
+        between the two sides; when both end up with inputs the path forks and they're returned, otherwise
+        path carries on down the only side that has any and None is returned.
+        """
+        if not is_array(cond):
+            if bool(cond) == jump_if:
+                path.ip = target
+            elif keep_on_jump:
+                path.stack.pop()
+            return None
+
+        truth = numpy.asarray(cond).astype(bool)
+        if not jump_if:
+            truth = ~truth
+
+        jump_mask = path.mask & truth
+        fall_mask = path.mask & ~truth
+
+        if not fall_mask.any():
+            path.ip = target
+            path.mask = jump_mask
+            return None
+
+        fall_stack = path.stack[:-1] if keep_on_jump else path.stack
+        if not jump_mask.any():
+            path.stack = fall_stack
+            path.mask = fall_mask
+            return None
+
+        return [path.fork(target, list(path.stack), jump_mask), path.fork(path.ip, list(fall_stack), fall_mask)]
+
+    def __load_global(self, name):
+        globals = self.__vm.module_frame.globals
+        if name not in globals:
+            raise Unvectorizable("Global %s" % name)
+
+        value = globals[name]
+        if not isinstance(value, numbers.Number):
+            raise Unvectorizable("Global %s is a %s" % (name, type(value).__name__))
+
+        return value
+
+    def __apply(self, scalar_op, ufunc_name, *operands):
+        """
+        Operations on plain Python values (constants, globals) go through the VM's own operators so they
+        keep Python's semantics exactly, anything involving an array goes through the ufunc.
+        """
+        try:
+            if not any(is_array(operand) for operand in operands):
+                return scalar_op(*operands)
+
+            return getattr(numpy, ufunc_name)(*operands)
+        except Exception as e:
+            raise Unvectorizable("%s: %s" % (ufunc_name, e))
+
+    def __binary(self, op, v, w, mask):
+        if op not in BINARY_UFUNCS:
+            raise Unvectorizable("%s is not vectorized" % op)
+
+        symbol, ufunc_name = BINARY_UFUNCS[op]
+        if not is_array(v) and not is_array(w):
+            return self.__apply(BINARY_OPERATORS[symbol], ufunc_name, v, w)
+
+        if ufunc_name in ("add", "subtract", "multiply", "true_divide", "floor_divide", "remainder", "power"):
+            # Python does arithmetic on bools as ints, numpy would keep them bools
+            v = self.__bool_to_int(v)
+            w = self.__bool_to_int(w)
+
+        if ufunc_name in DIVISIONS and numpy.any(numpy.logical_and(numpy.equal(w, 0), mask)):
+            raise Unvectorizable("Division by zero")
+
+        result = self.__apply(None, ufunc_name, v, w)
+        if result.dtype.kind in "iu" and ufunc_name in ("add", "subtract", "multiply", "power", "left_shift"):
+            self.__check_int_range(ufunc_name, v, w, mask)
+        elif result.dtype.kind == "f" and ufunc_name == "power":
+            # Python raises OverflowError instead of returning inf
+            if numpy.any(numpy.isinf(result) & numpy.isfinite(v) & numpy.isfinite(w) & mask):
+                raise Unvectorizable("Float overflow")
+
+        return result
+
+    def __bool_to_int(self, x):
+        if is_array(x) and x.dtype.kind == "b":
+            return x.astype(numpy.int64)
+        return x
+
+    def __check_int_range(self, ufunc_name, v, w, mask):
+        """
+        Redoes an int operation in floats to find the inputs whose result doesn't fit in an int64.
+        """
+        fv = numpy.asarray(v, dtype=numpy.float64)
+        fw = numpy.asarray(w, dtype=numpy.float64)
+        if ufunc_name == "left_shift":
+            approx = fv * numpy.power(2.0, fw)
+        else:
+            approx = getattr(numpy, ufunc_name)(fv, fw)
+
+        if numpy.any(~(numpy.abs(approx) < INT_LIMIT) & mask):
+            raise Unvectorizable("Int overflow")
+
+def vmap(vm, func_name, *args, **kwargs):
+    """
+    Applies the guest function func_name to numpy arrays (or anything numpy.asarray accepts) elementwise
+    and returns the results as an array. Arguments broadcast against each other. The function is
+    vectorized when it can be, otherwise, unless fallback=False, it's called once per element in the VM.
+    """
+    fallback = kwargs.pop("fallback", True)
+    max_paths = kwargs.pop("max_paths", 64)
+    if kwargs:
+        raise TypeError("Unexpected arguments: %s" % ", ".join(kwargs))
+
+    fn = vm.module_frame.globals.get(func_name)
+    if not isinstance(fn, Function):
+        raise Exception("Guest function %s is not defined" % func_name)
+
+    vectorizer = Vectorizer(vm, fn, max_paths)
+    try:
+        return vectorizer.run(args)
+    except Unvectorizable:
+        if not fallback:
+            raise
+
+    arrays = numpy.broadcast_arrays(*[numpy.asarray(arg) for arg in args])
+    shape = arrays[0].shape if arrays else ()
+    columns = [array.ravel().tolist() for array in arrays]
+    results = [vm.call_function(fn, list(elements)) for elements in zip(*columns)]
+
+    # Keep ints that outgrew int64 exact instead of letting numpy turn them into floats
+    dtype = None
+    if any(isinstance(result, int) and abs(result) >= 2 ** 63 for result in results):
+        dtype = object
+
+    return numpy.array(results, dtype=dtype).reshape(shape)
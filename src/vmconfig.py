@@ -24,5 +24,15 @@ THE SOFTWARE.
 
 class VMConfig:
     def __init__(self):
+        self.show_source = False
         self.show_disassembly = False
-        self.show_line_execution = False
\ No newline at end of file
+        self.show_line_execution = False
+
+        # Instructions a green thread runs before the scheduler switches to the next one
+        self.green_thread_budget = 1000
+
+        # Run the peephole optimizer over the code before executing it
+        self.optimize = False
+
+        # Run typed handlers where the type inference pass proved the operand types, see src.inference
+        self.specialize = False
\ No newline at end of file
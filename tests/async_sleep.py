@@ -0,0 +1,12 @@
+def fetch(key):
+    return sleep(0.01, key * 2)
+
+def main():
+    total = 0
+    for key in range(3):
+        value = fetch(key)
+        print("fetched", value)
+        total += value
+    print(total)
+
+main()
\ No newline at end of file
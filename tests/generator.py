@@ -0,0 +1,15 @@
+def countdown(n):
+    while n > 0:
+        yield n
+        n -= 1
+    yield "done"
+
+def main():
+    for value in countdown(3):
+        print(value)
+
+    gen = countdown(1)
+    print(next(gen))
+    print(next(gen))
+
+main()
\ No newline at end of file
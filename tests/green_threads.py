@@ -0,0 +1,22 @@
+def ping(to_pong, from_pong, rounds):
+    for i in range(rounds):
+        to_pong.send(i)
+        print("ping got", from_pong.recv())
+    to_pong.send(None)
+
+def pong(to_pong, from_pong):
+    value = to_pong.recv()
+    while value is not None:
+        from_pong.send(value * 10)
+        value = to_pong.recv()
+    return "pong done"
+
+def main():
+    to_pong = Channel()
+    from_pong = Channel()
+    pinger = spawn(ping, to_pong, from_pong, 3)
+    ponger = spawn(pong, to_pong, from_pong)
+    pinger.join()
+    print(ponger.join())
+
+main()
\ No newline at end of file